@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 import os
-import json
+from route_index import RouteIndex
 
 SAMPLE_RANGE = list(range(0, 15))
 
@@ -10,9 +10,9 @@ image_folder = "./panoids/"
 map_folder = "./maps/"
 
 if "test_positions" not in st.session_state:
-    with open("test_positions.json", "r") as f:
-        print("Loading test positions...")
-        test_positions = json.load(f)
+    # routes are read one at a time when a sample is shown, not all at start up
+    print("Indexing test positions...")
+    test_positions = RouteIndex("test_positions.json")
     st.session_state.test_positions = test_positions
 else:
     test_positions = st.session_state.test_positions
@@ -29,7 +29,7 @@ else:
     # Initialize annotations DataFrame
     annotations_df = pd.DataFrame({
         'sample_idx': SAMPLE_RANGE,
-        'route_id': [test_positions[i]['route_id'] for i in SAMPLE_RANGE],
+        'route_id': [test_positions.route_ids[i] for i in SAMPLE_RANGE],
         'Marker': [None] * len(SAMPLE_RANGE),
         'Turns': [''] * len(SAMPLE_RANGE),
         'Landmarks': [''] * len(SAMPLE_RANGE),
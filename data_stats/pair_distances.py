@@ -1,10 +1,10 @@
 import json
 import numpy as np
-from geopy.distance import geodesic
 import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from graph_loader import GraphLoader  # Replace with the correct module for GraphLoader
+from geodesy import distance as geodesic_distance
 import matplotlib.pyplot as plt
 
 # Constants
@@ -13,7 +13,9 @@ GRAPH_LINKS_FILE = "../graph/links.txt"
 
 # Function to calculate distances between points
 def calculate_distances(panoids, graph):
-    distances = []
+    pairs = []
+    starts = []
+    ends = []
     for i in range(len(panoids) - 1):
         # Get coordinates for each panoid
         node1 = graph.nodes.get(panoids[i])
@@ -23,14 +25,15 @@ def calculate_distances(panoids, graph):
             print(f"Error: Panoids {panoids[i]} or {panoids[i+1]} not found in graph.")
             continue
         
-        coord1 = node1.coordinate
-        coord2 = node2.coordinate
-        
-        # Calculate the geodesic distance
-        distance = geodesic(coord1, coord2).meters
+        pairs.append((panoids[i], panoids[i + 1]))
+        starts.append(node1.coordinate)
+        ends.append(node2.coordinate)
+
+    # Calculate the geodesic distances of all pairs at once
+    distances = geodesic_distance(starts, ends).tolist() if pairs else []
+    for (panoid1, panoid2), distance in zip(pairs, distances):
         if distance > 100:
-            print(f"Warning: Distance between {panoids[i]} and {panoids[i+1]} is unusually large: {distance:.2f} meters.")
-        distances.append(distance)
+            print(f"Warning: Distance between {panoid1} and {panoid2} is unusually large: {distance:.2f} meters.")
     
     return distances
 
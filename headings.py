@@ -0,0 +1,92 @@
+"""
+Vectorized bearings and circular smoothing of headings, in degrees.
+
+Bearings are initial great-circle bearings measured clockwise from north in
+[0, 360), the convention of the Google Street View `heading` parameter. All
+functions accept numpy arrays (or lists) of (lat, lng) points or headings and
+handle a whole path in one call.
+"""
+import numpy as np
+
+
+def bearings(points1, points2):
+    """Initial bearing from each (lat, lng) point of `points1` to the matching point of `points2`."""
+    points1 = np.radians(np.asarray(points1, dtype=np.float64))
+    points2 = np.radians(np.asarray(points2, dtype=np.float64))
+    lat1, lng1 = points1[..., 0], points1[..., 1]
+    lat2, lng2 = points2[..., 0], points2[..., 1]
+    delta_lng = lng2 - lng1
+    x = np.sin(delta_lng) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lng)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def calculate_bearing(pos1, pos2):
+    """Calculate the bearing (in degrees) between pos1 and pos2."""
+    return float(bearings(pos1, pos2))
+
+
+def path_bearings(points):
+    """Bearings of the n - 1 segments of an (n, 2) path."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return bearings(points[:-1], points[1:])
+
+
+def angle_difference(headings1, headings2):
+    """Signed smallest rotation from headings1 to headings2, in [-180, 180)."""
+    return (np.asarray(headings2, dtype=np.float64) - np.asarray(headings1, dtype=np.float64) + 180) % 360 - 180
+
+
+def circular_mean(headings, axis=-1, weights=None):
+    """Mean direction of headings along `axis`, in [0, 360)."""
+    radians = np.radians(np.asarray(headings, dtype=np.float64))
+    sin_sum = np.sum(np.sin(radians) if weights is None else np.sin(radians) * weights, axis=axis)
+    cos_sum = np.sum(np.cos(radians) if weights is None else np.cos(radians) * weights, axis=axis)
+    return np.degrees(np.arctan2(sin_sum, cos_sum)) % 360
+
+
+def circular_moving_average(headings, window_size=5, offsets=None):
+    """
+    Smooths headings with a centered circular moving average in O(n).
+    The window is truncated at both ends of the sequence, so the first and
+    last window_size // 2 headings average fewer values. Window sums come from
+    prefix sums of the sines and cosines.
+
+    `headings` may be several sequences laid end to end, sequence i being
+    headings[offsets[i]:offsets[i + 1]]; windows are then truncated at the
+    ends of every sequence, which smooths all of them in one call.
+    """
+    radians = np.radians(np.asarray(headings, dtype=np.float64))
+    n = len(radians)
+    if n == 0:
+        return np.zeros(0)
+    sin_prefix = np.concatenate([[0.0], np.cumsum(np.sin(radians))])
+    cos_prefix = np.concatenate([[0.0], np.cumsum(np.cos(radians))])
+    index = np.arange(n)
+    if offsets is None:
+        lower, upper = 0, n
+    else:
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sequence = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        lower, upper = offsets[sequence], offsets[sequence + 1]
+    start = np.maximum(lower, index - window_size // 2)
+    end = np.minimum(upper, index + window_size // 2 + 1)
+    sin_sum = sin_prefix[end] - sin_prefix[start]
+    cos_sum = cos_prefix[end] - cos_prefix[start]
+    return np.degrees(np.arctan2(sin_sum, cos_sum)) % 360
+
+
+def forward_average_bearings(points, window_size=3):
+    """
+    For every point but the last, the circular mean of the bearings from it to
+    each of the next window_size points (fewer near the end of the path).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = len(points)
+    sin_sum = np.zeros(max(n - 1, 0))
+    cos_sum = np.zeros(max(n - 1, 0))
+    for offset in range(1, min(window_size, n - 1) + 1):
+        radians = np.radians(bearings(points[:n - offset], points[offset:]))
+        sin_sum[:n - offset] += np.sin(radians)
+        cos_sum[:n - offset] += np.cos(radians)
+    return np.degrees(np.arctan2(sin_sum, cos_sum)) % 360
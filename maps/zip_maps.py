@@ -1,20 +1,20 @@
-import json
 import os
+import sys
 import zipfile
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from route_index import RouteIndex
+
 # Function to zip jpg files
 def zip_maps(json_file, maps_folder, output_zip):
-    # Load the JSON data
-    with open(json_file, 'r') as f:
-        test_positions = json.load(f)
+    # Only the route ids are needed, read from the index of the JSON file
+    route_ids = RouteIndex(json_file).route_ids
 
     # Create a list to store the files to zip
     files_to_zip = set()
 
     # Process the first 60 dictionaries in the JSON
-    for entry in test_positions:
-        route_id = entry.get("route_id", "")
-
+    for route_id in route_ids:
         png_file = os.path.join(maps_folder, f"test_easy_processed_maps_{route_id}.png")
         if os.path.exists(png_file):
             # Add the png file to the set
@@ -29,10 +29,11 @@ def zip_maps(json_file, maps_folder, output_zip):
 
     print(f"Zipped {len(files_to_zip)} files into {output_zip}")
 
-# Specify file paths
-json_file = '../data/test_positions_easy_processed_mapped_answered_v2.json'  # Replace with your JSON file path
-maps_folder = '/data/claireji/maps/easy_processed_maps_v2/'  # Replace with your thumbnails folder path
-output_zip = 'maps.zip'  # Replace with your desired output zip file path
+if __name__ == "__main__":
+    # Specify file paths
+    json_file = '../data/test_positions_easy_processed_mapped_answered_v2.json'  # Replace with your JSON file path
+    maps_folder = '/data/claireji/maps/easy_processed_maps_v2/'  # Replace with your thumbnails folder path
+    output_zip = 'maps.zip'  # Replace with your desired output zip file path
 
-# Zip the thumbnails
-zip_maps(json_file, maps_folder, output_zip)
+    # Zip the thumbnails
+    zip_maps(json_file, maps_folder, output_zip)
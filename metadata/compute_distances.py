@@ -1,22 +1,38 @@
 import os
-import json
-from geopy.distance import geodesic
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from geodesy import path_distances
+from route_io import iter_routes, iter_batches, RouteWriter
+from route_pool import pool_imap, report_errors
 
-def compute_path_distances(path):
+def segment_distances(paths):
+    """
+    Segment distances (meters) of many paths, computed with a single vectorized call.
+    Returns a list with n - 1 distances for each path of n points.
+    """
+    points = [(p['pano_lat'], p['pano_lng']) for path in paths for p in path]
+    # the distances between the last point of a path and the first of the next are dropped
+    dists = path_distances(points)
+    seg_dists = []
+    offset = 0
+    for path in paths:
+        seg_dists.append(dists[offset:offset + len(path) - 1].tolist())
+        offset += len(path)
+    return seg_dists
+
+def compute_path_distances(path, seg_dists=None):
     """
     Given a list of dicts each containing 'lat' and 'lng', compute:
       - distance_to_next and distance_to_prev (meters) for each element
       - a cumulative_distance list: distance along the path from the first point
+    seg_dists can pass precomputed segment distances (see segment_distances).
     Returns:
       cumulative: list of same length, cumulative[i] = distance from idx=0 to idx=i
     """
     n = len(path)
     # compute segment distances
-    seg_dists = [0.0] * (n - 1)
-    for i in range(n - 1):
-        p1 = (path[i]['pano_lat'], path[i]['pano_lng'])
-        p2 = (path[i+1]['pano_lat'], path[i+1]['pano_lng'])
-        seg_dists[i] = geodesic(p1, p2).meters
+    if seg_dists is None:
+        seg_dists = segment_distances([path])[0]
 
     # cumulative distances
     cumulative = [0.0] * n
@@ -50,21 +66,36 @@ def update_multiple_choice(mcp_list, cumulative):
             dist = abs(cumulative[j_idx] - cumulative[i_idx])
             item[f'distance_to_{j_mc}'] = dist
 
-def process_json(input_path: str, output_path: str) -> None:
-    data = json.load(open(input_path))
-    for route in data:
-        path = route.get('path', [])
-        if not path:
-            continue
-        # 1) compute path distances
-        cumulative = compute_path_distances(path)
-        # 2) update multiple_choice_positions
-        mcp = route.get('multiple_choice_positions', [])
-        if mcp:
-            update_multiple_choice(mcp, cumulative)
-    # write out
-    with open(output_path, 'w') as f:
-        json.dump(data, f, indent=2)
+def process_route(item):
+    """Add the distances to one (route, seg_dists) pair and return the route."""
+    route, seg_dists = item
+    path = route.get('path', [])
+    if not path:
+        return route
+    # 1) compute path distances
+    cumulative = compute_path_distances(path, seg_dists)
+    # 2) update multiple_choice_positions
+    mcp = route.get('multiple_choice_positions', [])
+    if mcp:
+        update_multiple_choice(mcp, cumulative)
+    return route
+
+def distance_batches(routes, batch_size=1024):
+    """Yield (route, seg_dists) pairs, computing the segment distances of each batch of routes in one call."""
+    for batch in iter_batches(routes, batch_size):
+        yield from zip(batch, segment_distances([route.get('path', []) for route in batch]))
+
+def process_json(input_path: str, output_path: str, processes=None) -> None:
+    # routes are streamed from the input to the output
+    errors = []
+    with RouteWriter(output_path) as writer:
+        for route, error in pool_imap(process_route, distance_batches(iter_routes(input_path)), processes):
+            if error is not None:
+                # failed routes are still written, as process_route left them
+                errors.append(error)
+                route = error.route[0]
+            writer.write(route)
+    report_errors(errors, "compute_distances")
 
 if __name__ == "__main__":
     import argparse
@@ -73,5 +104,6 @@ if __name__ == "__main__":
     # p.add_argument("--output_json", default="test_positions_easy_processed_mapped_answered_redistanced_v2.json", help="Output JSON file")
     p.add_argument("--input_json", default="../data/train_positions_processed_mapped_v2.json", help="Input JSON file")
     p.add_argument("--output_json", default="../data/train_positions_processed_mapped_redistanced_v2.json", help="Output JSON file")
+    p.add_argument("--processes", type=int, default=None, help="Worker processes (default: all cores)")
     args = p.parse_args()
-    process_json(args.input_json, args.output_json)
+    process_json(args.input_json, args.output_json, args.processes)
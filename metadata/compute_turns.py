@@ -1,58 +1,150 @@
-import json
-import math
-
-# Function to calculate the initial bearing between two points
-def calculate_bearing(lat1, lon1, lat2, lon2):
-    # Convert degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    delta_lon = lon2 - lon1
-
-    x = math.sin(delta_lon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta_lon)
-    initial_bearing = math.atan2(x, y)
-
-    # Convert radians to degrees and normalize
-    return (math.degrees(initial_bearing) + 360) % 360
-
-# Function to determine movement direction based on bearings
-def get_direction(bearing1, bearing2):
-    angle = bearing2 - bearing1
-    abs_angle = abs(angle)
-    # complementary_angle = 180 - bearing1 if bearing1 < 180 else 360 - bearing1
-    if abs_angle < 45:
-        return "Forward", angle
+import os
+import sys
+import traceback
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from headings import angle_difference, bearings, circular_moving_average
+from route_io import iter_routes, iter_batches, RouteWriter
+from route_pool import RouteError, report_errors, route_id_of
+
+# Smallest heading change, in degrees, that counts as a turn
+TURN_THRESHOLD = 45
+
+def segment_bearings(points, offsets):
+    """
+    Bearings of the segments of many paths laid end to end (see
+    detect_turns_flat), and the offsets of the segments of each path:
+    path i has the len(path) - 1 segments segment_offsets[i]:segment_offsets[i + 1].
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    path = np.repeat(np.arange(len(lengths)), lengths)
+    # the segments from each point to the next one of the same path
+    starts = np.flatnonzero(path[:-1] == path[1:])
+    segment_offsets = np.concatenate([[0], np.cumsum(np.maximum(lengths - 1, 0))])
+    return bearings(points[starts], points[starts + 1]), segment_offsets
+
+def detect_turns_flat(points, offsets, threshold=TURN_THRESHOLD, window_size=1, peaks=False, raw=None):
+    """
+    Turns of many paths at once. `points` holds the (lat, lng) points of all
+    paths end to end, path i being points[offsets[i]:offsets[i + 1]], as in
+    the columns of a route_store.RouteStore.
+
+    The turn at an inner point is the signed change of heading between the
+    segment before and the segment after it, wrapped to [-180, 180), positive
+    to the right. With window_size > 1 the segment headings of each path are
+    first smoothed by a circular moving average, and the angle of a turn is
+    the change between the unsmoothed headings entering and leaving its
+    window, so a turn spread over a few points is measured whole. A point is
+    a turn if that angle is at least `threshold` degrees; with peaks=True it
+    must also be a local maximum of the smoothed turn rate of its path, so
+    each bend gives one turn instead of every point of the bend.
+
+    raw can pass the segment bearings from segment_bearings if the caller
+    already has them.
+
+    Returns three arrays over all the turns found: the path of each turn,
+    the index of its point within the path and its signed angle.
+    """
+    if raw is None:
+        raw, segment_offsets = segment_bearings(points, offsets)
     else:
-        return "Turn", angle
-    # elif complementary_angle > bearing2:
-    #     return "Left", angle
-    # else:
-    #     return "Right", angle
-
-# Function to process a single dictionary
-def process_path(data):
+        lengths = np.diff(np.asarray(offsets, dtype=np.int64))
+        segment_offsets = np.concatenate([[0], np.cumsum(np.maximum(lengths - 1, 0))])
+    segment_path = np.repeat(np.arange(len(segment_offsets) - 1), np.diff(segment_offsets))
+    headings = raw if window_size <= 1 else circular_moving_average(raw, window_size, segment_offsets)
+
+    # pairs of consecutive segments of a path meet at an inner point
+    inner = np.flatnonzero(segment_path[:-1] == segment_path[1:])
+    rate = np.full(len(raw), -np.inf)
+    rate[inner] = np.abs(angle_difference(headings[inner], headings[inner + 1]))
+
+    if window_size <= 1:
+        angles = angle_difference(raw[inner], raw[inner + 1])
+    else:
+        half = window_size // 2
+        first = segment_offsets[segment_path[inner]]
+        last = segment_offsets[segment_path[inner] + 1] - 1
+        angles = angle_difference(raw[np.maximum(first, inner - half)], raw[np.minimum(last, inner + 1 + half)])
+
+    keep = np.abs(angles) >= threshold
+    if peaks:
+        # rate is -inf past the ends of each path, so neighbours never cross paths
+        before = np.concatenate([[-np.inf], rate[:-1]])[inner]
+        after = np.concatenate([rate[1:], [-np.inf]])[inner]
+        keep &= (rate[inner] >= before) & (rate[inner] > after)
+
+    turns = inner[keep]
+    turn_path = segment_path[turns]
+    # pair k joins segments k and k + 1, at point k + 1 - segment_offsets[path] of the path
+    return turn_path, turns + 1 - segment_offsets[turn_path], angles[keep]
+
+def detect_turns(paths, threshold=TURN_THRESHOLD, window_size=1, peaks=False):
+    """
+    detect_turns_flat for a list of paths of (lat, lng) points. Returns an
+    (indices, angles) pair of arrays for every path.
+    """
+    paths = [np.asarray(path, dtype=np.float64).reshape(-1, 2) for path in paths]
+    offsets = np.concatenate([[0], np.cumsum([len(path) for path in paths])]).astype(np.int64)
+    points = np.concatenate(paths) if paths else np.zeros((0, 2))
+    turn_path, indices, angles = detect_turns_flat(points, offsets, threshold, window_size, peaks)
+    bounds = np.searchsorted(turn_path, np.arange(len(paths) + 1))
+    return [(indices[bounds[i]:bounds[i + 1]], angles[bounds[i]:bounds[i + 1]]) for i in range(len(paths))]
+
+def turn_batches(routes, threshold=TURN_THRESHOLD, window_size=1, peaks=False, batch_size=1024):
+    """
+    Yield (route, bearings, changes, turns) for every route, detecting the
+    turns of each batch of routes in one detect_turns_flat call. bearings are
+    the segment bearings of the route, changes[i - 1] the wrapped change of
+    heading at path[i], and turns maps the index of each turn to its angle.
+    """
+    for batch in iter_batches(routes, batch_size):
+        paths = [route.get("path", []) for route in batch]
+        points = [(entry["pano_lat"], entry["pano_lng"]) for path in paths for entry in path]
+        offsets = np.concatenate([[0], np.cumsum([len(path) for path in paths])]).astype(np.int64)
+        raw, segment_offsets = segment_bearings(points, offsets)
+        turn_path, indices, angles = detect_turns_flat(points, offsets, threshold, window_size, peaks, raw)
+        # pair k joins segments k and k + 1, the pairs across two paths are never sliced out below
+        changes = angle_difference(raw[:-1], raw[1:]).tolist()
+        bounds = np.searchsorted(turn_path, np.arange(len(batch) + 1)).tolist()
+        segment_offsets = segment_offsets.tolist()
+        raw, indices, angles = raw.tolist(), indices.tolist(), angles.tolist()
+        for i, route in enumerate(batch):
+            first, last = segment_offsets[i], segment_offsets[i + 1]
+            turns = dict(zip(indices[bounds[i]:bounds[i + 1]], angles[bounds[i]:bounds[i + 1]]))
+            yield route, raw[first:last], changes[first:max(first, last - 1)], turns
+
+# Function to process a single dictionary, turn_data is its (bearings, changes, turns) from turn_batches
+def process_path(data, turn_data=None, threshold=TURN_THRESHOLD, window_size=1, peaks=False):
     path = data.get("path", [])
     
     if len(path) < 2:
-        return []
+        return [], []
 
     for i, entry in enumerate(path):
         entry["idx"] = i
 
+    if turn_data is None:
+        _, *turn_data = next(turn_batches([data], threshold, window_size, peaks))
+    # bearings[i] is the bearing from path[i] to path[i+1]
+    bearings, changes, turns = turn_data
+
     directions = []
     turn_list = []
     for i in range(len(path)-1):
         if i > 0:
-            lat1, lon1 = path[i-1]["pano_lat"], path[i-1]["pano_lng"]
-            lat2, lon2 = path[i]["pano_lat"], path[i]["pano_lng"]
-            lat3, lon3 = path[i + 1]["pano_lat"], path[i + 1]["pano_lng"]
-
-            bearing1 = calculate_bearing(lat1, lon1, lat2, lon2)
-            bearing2 = calculate_bearing(lat2, lon2, lat3, lon3)
+            bearing1 = bearings[i-1]
+            bearing2 = bearings[i]
 
-            turn, angle = get_direction(bearing1, bearing2) 
-
-            if turn != "Forward":
+            # a turn keeps the angle it was detected with, over its smoothing window
+            if i in turns:
+                turn, angle = "Turn", turns[i]
                 turn_list.append((i, turn))
+            else:
+                turn, angle = "Forward", changes[i-1]
 
             panoid_start = path[i-1]
             panoid_middle = path[i]
@@ -70,38 +162,48 @@ def process_path(data):
 
     return directions, turn_list
 
-# Function to read and process the JSON file
-def process_json_file(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    
-    results = []
-    for entry in data:
-        directions, turns = process_path(entry)
-        results.append({
-            "route_id": entry.get("route_id"),  # Add an identifier if available
-            "turns": turns,
-            "directions": directions,
-        })
-        entry["turns"] = turns
-
-    return results, data
-
-# Save results to a new JSON file
-def save_results_to_file(results, modified_data, input_file, output_file):
-    with open(input_file, 'w') as file:
-        json.dump(modified_data, file, indent=4)
-    with open(output_file, 'w') as file:
-        json.dump(results, file, indent=4)
+# Function to process one (route, bearings, changes, turns) item of turn_batches,
+# returns its result and the updated route
+def process_entry(item):
+    entry, *turn_data = item
+    directions, turns = process_path(entry, turn_data)
+    entry["turns"] = turns
+    result = {
+        "route_id": entry.get("route_id"),  # Add an identifier if available
+        "turns": turns,
+        "directions": directions,
+    }
+    return result, entry
+
+# Function to read and process the JSON file, streaming the routes to both outputs.
+# The routes with their turns go to modified_file, by default the input file itself;
+# RouteWriter only replaces it once it is complete.
+# The turns of each batch of routes are detected together, threshold, window_size and peaks
+# are passed to detect_turns_flat. What is left per route is cheaper than sending it to a
+# worker, so the routes are processed in this process; processes is kept for the pipeline.
+def process_json_file(input_file, output_file, processes=None, modified_file=None, threshold=TURN_THRESHOLD, window_size=1, peaks=False):
+    errors = []
+    routes = turn_batches(iter_routes(input_file), threshold, window_size, peaks)
+    with RouteWriter(modified_file or input_file) as modified, RouteWriter(output_file) as results:
+        for index, item in enumerate(routes):
+            try:
+                result, entry = process_entry(item)
+                results.write(result)
+            except Exception:
+                # failed routes keep their entry without turns
+                errors.append(RouteError(index, route_id_of(item), traceback.format_exc(), item))
+                entry = item[0]
+            modified.write(entry)
+    report_errors(errors, "compute_turns")
 
 # Example usage
-# input_file = "../data/test_positions_easy_processed_mapped_v2.json"
-# output_file = "test_positions_easy_processed_turns_v2.json"
+if __name__ == "__main__":
+    # input_file = "../data/test_positions_easy_processed_mapped_v2.json"
+    # output_file = "test_positions_easy_processed_turns_v2.json"
 
-input_file = "../data/train_positions_processed_mapped_v2.json"
-output_file = "train_positions_processed_turns_v2.json"
+    input_file = "../data/train_positions_processed_mapped_v2.json"
+    output_file = "train_positions_processed_turns_v2.json"
 
-results, modified_data = process_json_file(input_file)
-save_results_to_file(results, modified_data, input_file, output_file)
+    process_json_file(input_file, output_file)
 
-print("Processing complete. Results saved to", output_file)
+    print("Processing complete. Results saved to", output_file)
\ No newline at end of file
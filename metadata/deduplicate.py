@@ -1,9 +1,9 @@
-import json
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from route_io import iter_routes, RouteWriter
 
 file_path = '../data/test_positions_augmented.json'  
 write_file_path = '../data/test_positions_augmented_consolidated.json'
-with open(file_path, 'r') as file:
-    positions = json.load(file)
 
 def remove_consecutive_repeats(lst):
     idx_kept = [0]
@@ -25,11 +25,11 @@ def process_mapping(lst, mapping):
             result.append(item)
     return result
 
-for route in positions:
-    route['lat_lng_path'], mapping = remove_consecutive_repeats(route['lat_lng_path'])
-    route['route_panoids'] = process_mapping(route['route_panoids'], mapping)
-    del route['ground_truth_position']
-    del route['multiple_choice_positions']
-
-with open(write_file_path, 'w') as file:
-    json.dump(positions, file, indent=4)
+# routes are streamed from the input to the output
+with RouteWriter(write_file_path) as writer:
+    for route in iter_routes(file_path):
+        route['lat_lng_path'], mapping = remove_consecutive_repeats(route['lat_lng_path'])
+        route['route_panoids'] = process_mapping(route['route_panoids'], mapping)
+        del route['ground_truth_position']
+        del route['multiple_choice_positions']
+        writer.write(route)
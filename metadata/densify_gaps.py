@@ -1,11 +1,11 @@
-import json
 import requests
 import os
 import numpy as np
-from geopy.distance import geodesic
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from graph_loader import GraphLoader, GraphWriter
+from geodesy import distance as geodesic_distance
+from route_io import iter_routes, RouteWriter
 import pdb
 
 # Configuration
@@ -13,6 +13,12 @@ import pdb
 # OUTPUT_DIR = "/data/claireji/panoids/"
 OUTPUT_JSON = "dense_turns.json"
 DISTANCE = 10
+# Segments shorter than this, in meters, are not densified
+MIN_GAP = 15
+# Sampled points whose coordinates round to the same multiple of this, in degrees, are one node
+COORDINATE_QUANTUM = 1e-6
+# Prefix of the ids of the nodes added to the graph, numbered in order
+NODE_PREFIX = "aug_"
 DATA_FILE = "../data/test_positions.json"
 NEW_DATA_FILE = "../data/test_positions_augmented.json"
 
@@ -27,124 +33,202 @@ def fetch_lat_long(graph, panoid):
     else:
         raise ValueError(f"Panoid {panoid} not found in the graph.")
 
-def get_sampled_points(start, end, bearing_1, bearing_2, distance):
-    gap = geodesic(start, end).meters
-    if gap >= 15:
-        num_points = int(np.ceil(gap / distance))
-        
-        """Generate interpolated points between start and end coordinates."""
-        latitudes = np.linspace(start[0], end[0], num_points)
-        longitudes = np.linspace(start[1], end[1], num_points)
-        if bearing_2 < bearing_1:
-            bearing_2 += 360
-        bearings = np.linspace(bearing_1, bearing_2, num_points)
-        bearings = bearings % 360
-        # print(f"Distance between {start} and {end}: {gap:.2f} meters, sampling {num_points} points.")
-        return list(zip(latitudes, longitudes, bearings))
-    return None
-
-def add_to_graph(graph, sampled_points, start_end):
-    start_panoid, end_panoid, current_heading = start_end
-    current_panoid = start_panoid
-    for lat, lng, heading in sampled_points:
-        panoid = "panoid_" + f"{lat}_{lng}"
-        if panoid not in graph.nodes:
-            graph.add_node(panoid, heading, lat, lng)
-        while int(current_heading) in graph.nodes[current_panoid].neighbors:
-            current_heading += 1
-        graph.add_edge(current_panoid, panoid, current_heading)
-        current_panoid = panoid
-        current_heading = heading
-    while int(current_heading) in graph.nodes[current_panoid].neighbors:
-        current_heading += 1
-    graph.add_edge(current_panoid, end_panoid, current_heading)
-    return graph
-        
-def process_directions(input_file, graph_loader, graph_writer):
-    """Main processing function."""
-    # Load the input JSON
-    with open(input_file, 'r') as f:
-        data = json.load(f)
-    
-    with open(DATA_FILE, 'r') as f:
-        positions_data = json.load(f)
+def sample_segments(starts, ends, bearings_1, bearings_2, distance=DISTANCE, min_gap=MIN_GAP):
+    """
+    Interpolates points and headings along many segments at once, about one
+    sample every `distance` meters. starts and ends are (n, 2) arrays of
+    (lat, lng). Returns the segment of every sample, its (lat, lng) and its
+    heading, ordered by segment; segments shorter than min_gap meters have no
+    samples.
+    """
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    bearings_1 = np.asarray(bearings_1, dtype=np.float64)
+    bearings_2 = np.asarray(bearings_2, dtype=np.float64)
+    gaps = geodesic_distance(starts, ends)
+    counts = np.where(gaps >= min_gap, np.ceil(gaps / distance), 0).astype(np.int64)
+    segment = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    step = np.arange(len(segment)) - offsets[segment]
+    last = counts[segment] - 1
+    # the same values as np.linspace over each segment, whose last value is exactly the end
+    divisor = np.maximum(last, 1)
+    points = starts[segment] + step[:, None] * ((ends - starts)[segment] / divisor[:, None])
+    bearings_2 = np.where(bearings_2 < bearings_1, bearings_2 + 360, bearings_2)
+    headings = bearings_1[segment] + step * ((bearings_2 - bearings_1)[segment] / divisor)
+    at_end = (step == last) & (last > 0)
+    points[at_end] = ends[segment[at_end]]
+    headings[at_end] = bearings_2[segment[at_end]]
+    return segment, points, headings % 360
+
+def allocate_headings(occupied, sources, headings):
+    """
+    Integer headings for new edges so that no two edges of a node share one.
+    occupied is a (number of nodes, 360) boolean array of the headings already
+    used by each node, updated in place. Edge i leaves node sources[i] and gets
+    the first free heading from int(headings[i]) on, clockwise and modulo 360.
+    The edges of a node are served in their order, the first edge of every
+    node in one vectorized round, then the second, and so on.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    wanted = np.floor(np.asarray(headings, dtype=np.float64)).astype(np.int64) % 360
+    allocated = np.zeros(len(sources), dtype=np.int64)
+    order = np.argsort(sources, kind="stable")
+    # rank of every edge among the edges of its node
+    sorted_sources = sources[order]
+    group_start = np.ones(len(sources), dtype=bool)
+    group_start[1:] = sorted_sources[1:] != sorted_sources[:-1]
+    position = np.arange(len(sources))
+    rank = np.empty(len(sources), dtype=np.int64)
+    rank[order] = position - np.maximum.accumulate(np.where(group_start, position, 0))
+    for round_number in range(int(rank.max()) + 1 if len(rank) else 0):
+        edges = np.flatnonzero(rank == round_number)
+        nodes = sources[edges]
+        candidates = (wanted[edges, None] + np.arange(360)) % 360
+        free = ~occupied[nodes[:, None], candidates]
+        if not free.any(axis=1).all():
+            raise ValueError("A node has edges at all 360 headings")
+        chosen = candidates[np.arange(len(edges)), free.argmax(axis=1)]
+        occupied[nodes, chosen] = True
+        allocated[edges] = chosen
+    return allocated
+
+def augment_graph(graph, segments, distance=DISTANCE, min_gap=MIN_GAP):
+    """
+    Densifies many segments of the graph in one batch. segments lists
+    (start_panoid, end_panoid, bearing_1, bearing_2) tuples; a repeated
+    (start_panoid, end_panoid) pair is sampled once.
+
+    Samples of all segments are computed together and deduplicated by their
+    coordinates rounded to COORDINATE_QUANTUM, so segments sharing points
+    share nodes. New nodes get compact ids NODE_PREFIX + number, numbered on
+    from the largest number already in the graph. Each segment becomes a
+    chain of edges start -> samples -> end whose headings come from
+    allocate_headings, then the nodes and edges are added to the graph.
+
+    Returns {(start_panoid, end_panoid): [(panoid, lat, lng, heading), ...]}
+    for every segment that was densified.
+    """
+    unique = {}
+    for start_panoid, end_panoid, bearing_1, bearing_2 in segments:
+        unique.setdefault((start_panoid, end_panoid), (bearing_1, bearing_2))
+    pairs = list(unique)
+    if not pairs:
+        return {}
+    starts = [fetch_lat_long(graph, start_panoid) for start_panoid, _ in pairs]
+    ends = [fetch_lat_long(graph, end_panoid) for _, end_panoid in pairs]
+    bearings = np.array(list(unique.values()), dtype=np.float64).reshape(-1, 2)
+    segment, points, headings = sample_segments(starts, ends, bearings[:, 0], bearings[:, 1], distance, min_gap)
+
+    # one node per quantized coordinate, numbered in order of first appearance
+    keys = np.round(points / COORDINATE_QUANTUM).astype(np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(first)
+    number = np.empty(len(first), dtype=np.int64)
+    number[order] = np.arange(len(first))
+    numbers = [panoid[len(NODE_PREFIX):] for panoid in graph.nodes if panoid.startswith(NODE_PREFIX)]
+    base = max((int(suffix) + 1 for suffix in numbers if suffix.isdecimal()), default=0)
+    node_ids = [NODE_PREFIX + str(base + i) for i in range(len(first))]
+    first = first[order]
+    for panoid, (lat, lng), heading in zip(node_ids, points[first].tolist(), headings[first].tolist()):
+        graph.add_node(panoid, heading, lat, lng)
+    sample_ids = [node_ids[i] for i in number[inverse].tolist()]
+
+    # edges of every segment in order: start -> first sample -> ... -> last sample -> end
+    edges = {}
+    segment = segment.tolist()
+    headings = headings.tolist()
+    for i, (panoid, pair) in enumerate(zip(sample_ids, segment)):
+        if i == 0 or segment[i - 1] != pair:
+            edges.setdefault((pairs[pair][0], panoid), bearings[pair, 0])
+        else:
+            edges.setdefault((sample_ids[i - 1], panoid), headings[i - 1])
+        if i == len(segment) - 1 or segment[i + 1] != pair:
+            edges.setdefault((panoid, pairs[pair][1]), headings[i])
+
+    sources = list(dict.fromkeys(source for source, _ in edges))
+    source_index = {panoid: i for i, panoid in enumerate(sources)}
+    occupied = np.zeros((len(sources), 360), dtype=bool)
+    for i, panoid in enumerate(sources):
+        occupied[i, [heading % 360 for heading in graph.nodes[panoid].neighbors]] = True
+    allocated = allocate_headings(occupied, [source_index[source] for source, _ in edges], list(edges.values()))
+    for (source, target), heading in zip(edges, allocated.tolist()):
+        graph.add_edge(source, target, heading)
+
+    samples = {}
+    for panoid, pair, (lat, lng), heading in zip(sample_ids, segment, points.tolist(), headings):
+        samples.setdefault(pairs[pair], []).append((panoid, lat, lng, heading))
+    return samples
 
+def process_directions(input_file, graph_loader, graph_writer):
+    """Main processing function, streams the routes of input_file and DATA_FILE."""
     # Load the graph
     graph = graph_loader.construct_graph()
 
-    # Initialize image mapping dictionary
-    image_mapping = []
-    samples = {}
-
-    for i, route in enumerate(data[:]):
-        route_id = route["route_id"]
-        dense_turns = []
-        new_route_panoids = []
-        new_lat_lng_path = []
-        for index, direction in enumerate(route["directions"]):
-            new_route_panoids.append(direction["panoid_start"])
-            new_lat_lng_path.append(fetch_lat_long(graph, direction["panoid_start"]))
-            try:
-                # Get start and end coordinates
-                start_coords = fetch_lat_long(graph, direction["panoid_start"])
-                end_coords = fetch_lat_long(graph, direction["panoid_end"])
-                bearing_1 = direction["bearing_1"]
-                bearing_2 = direction["bearing_2"]
-
-                if samples.get((direction["panoid_start"], direction["panoid_end"])):
-                    sampled_points = samples[(direction["panoid_start"], direction["panoid_end"])]
-                else:
-                    # Get interpolated points
-                    sampled_points = get_sampled_points(start_coords, end_coords, bearing_1, bearing_2, DISTANCE)
-                    if sampled_points:
-                        samples[(direction["panoid_start"], direction["panoid_end"])] = sampled_points
-                        graph = add_to_graph(graph, sampled_points, (direction["panoid_start"], direction["panoid_end"], direction["bearing_1"]))
-
-                if not sampled_points:
+    # Densify the segments of all routes in one batch, a first pass over the input
+    segments = [(direction["panoid_start"], direction["panoid_end"], direction["bearing_1"], direction["bearing_2"])
+                for route in iter_routes(input_file) for direction in route["directions"]
+                if direction["panoid_start"] in graph.nodes and direction["panoid_end"] in graph.nodes]
+    samples = augment_graph(graph, segments, DISTANCE)
+
+    # The image mapping and the updated positions are written route by route
+    positions = iter_routes(DATA_FILE)
+    with RouteWriter(OUTPUT_JSON) as image_mapping, RouteWriter(NEW_DATA_FILE) as positions_writer:
+        for route, position in zip(iter_routes(input_file), positions):
+            route_id = route["route_id"]
+            dense_turns = []
+            new_route_panoids = []
+            new_lat_lng_path = []
+            for index, direction in enumerate(route["directions"]):
+                new_route_panoids.append(direction["panoid_start"])
+                new_lat_lng_path.append(fetch_lat_long(graph, direction["panoid_start"]))
+                try:
+                    # Check the end exists, the interpolated points come from the batch
+                    fetch_lat_long(graph, direction["panoid_end"])
+                    sampled_points = samples.get((direction["panoid_start"], direction["panoid_end"]))
+
+                    if not sampled_points:
+                        continue
+                    
+                    # Fetch and save images
+                    turn_images = []
+                    for idx, (file_name, lat, lng, heading) in enumerate(sampled_points):
+                        turn_images.append({'lat': lat, 'lng': lng, 'heading': heading, 'panoid': file_name, 'index': idx})
+                        new_route_panoids.append(file_name)
+                        new_lat_lng_path.append((lat, lng))
+
+                    # Add to dense turns
+                    dense_turns.append({
+                        "step": index,
+                        "direction": direction["direction"],
+                        "start_panoid": direction["panoid_start"],
+                        "end_panoid": direction["panoid_end"],
+                        "images": turn_images
+                    })
+
+                except Exception as e:
+                    print(f"Error processing route {route_id}, direction {direction}: {e}")
                     continue
                 
-                # Fetch and save images
-                turn_images = []
-                for idx, (lat, lng, heading) in enumerate(sampled_points):
-                    file_name = "panoid_" + f"{lat}_{lng}"
-                    turn_images.append({'lat': lat, 'lng': lng, 'heading': heading, 'panoid': file_name, 'index': idx})
-                    new_route_panoids.append(file_name)
-                    new_lat_lng_path.append((lat, lng))
-
-                # Add to dense turns
-                dense_turns.append({
-                    "step": index,
-                    "direction": direction["direction"],
-                    "start_panoid": direction["panoid_start"],
-                    "end_panoid": direction["panoid_end"],
-                    "images": turn_images
-                })
-
-            except Exception as e:
-                print(f"Error processing route {route_id}, direction {direction}: {e}")
-                continue
-            
-        # Add to image mapping
-        image_mapping.append({
-            "route_id": route_id,
-            "directions": dense_turns
-        })
-
-        new_route_panoids.append(direction["panoid_end"])
-        new_lat_lng_path.append(fetch_lat_long(graph, direction["panoid_end"]))
-
-        # Update route with new panoids
-        positions_data[i]["route_panoids"] = new_route_panoids
-        positions_data[i]["lat_lng_path"] = new_lat_lng_path
+            # Add to image mapping
+            image_mapping.write({
+                "route_id": route_id,
+                "directions": dense_turns
+            })
 
-    graph_writer.write_graph(graph)
+            new_route_panoids.append(direction["panoid_end"])
+            new_lat_lng_path.append(fetch_lat_long(graph, direction["panoid_end"]))
 
-    # Save the image mapping to a JSON file
-    with open(OUTPUT_JSON, 'w') as f:
-        json.dump(image_mapping, f, indent=4)
+            # Update route with new panoids
+            position["route_panoids"] = new_route_panoids
+            position["lat_lng_path"] = new_lat_lng_path
+            positions_writer.write(position)
 
-    with open(NEW_DATA_FILE, 'w') as f:
-        json.dump(positions_data, f, indent=4)
+        # positions after the last route of input_file are written as they are
+        positions_writer.write_all(positions)
+
+    graph_writer.write_graph(graph)
 
 if __name__ == "__main__":
     input_file = "turns.json"  # Replace with your actual file path
@@ -1,66 +1,17 @@
-import json
-import math
 import time
+import os
+import sys
 import numpy as np
-from geopy.distance import geodesic
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from geodesy import path_distances
+from headings import path_bearings, circular_moving_average
+from rdp import rdp_indices
+from route_io import iter_routes, iter_batches, RouteWriter
+from route_pool import pool_imap, report_errors
 
 # --- Configuration Parameters ---
 distance_threshold = 5  # Target maximum gap (in meters) between points after interpolation
-rdp_epsilon = 0.00005    # Tolerance for RDP simplification (in degrees, adjust as needed)
-
-# --- RDP Implementation ---
-def perpendicular_distance(point, line_start, line_end):
-    """Compute the perpendicular distance from `point` to the line defined by `line_start` and `line_end`."""
-    x0, y0 = point
-    x1, y1 = line_start
-    x2, y2 = line_end
-    # If line_start == line_end, return Euclidean distance.
-    if (x1, y1) == (x2, y2):
-        return math.hypot(x0 - x1, y0 - y1)
-    
-    # Compute area of triangle and then the distance:
-    area = abs(x1*(y2-y0) + x2*(y0-y1) + x0*(y1-y2))
-    base = math.hypot(x2 - x1, y2 - y1)
-    return area / base
-
-def rdp(points, epsilon):
-    """
-    Simplify a list of points using the Ramer-Douglas-Peucker (RDP) algorithm.
-    Returns a list of points that approximate the original path.
-    """
-    if len(points) < 3:
-        return points
-
-    start = points[0]
-    end = points[-1]
-    max_dist = 0
-    index = 0
-    for i in range(1, len(points)-1):
-        d = perpendicular_distance(points[i], start, end)
-        if d > max_dist:
-            max_dist = d
-            index = i
-
-    if max_dist > epsilon:
-        # Recursively simplify
-        rec_results1 = rdp(points[:index+1], epsilon)
-        rec_results2 = rdp(points[index:], epsilon)
-        # Avoid duplicate endpoint
-        return rec_results1[:-1] + rec_results2
-    else:
-        return [start, end]
-
-# --- Heading Calculation ---
-def calculate_bearing(pos1, pos2):
-    """Calculate the bearing (in degrees) between pos1 and pos2."""
-    lat1, lon1 = pos1
-    lat2, lon2 = pos2
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    delta_lon = lon2 - lon1
-    x = math.sin(delta_lon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1)*math.cos(lat2)*math.cos(delta_lon)
-    initial_bearing = math.atan2(x, y)
-    return (math.degrees(initial_bearing) + 360) % 360
+rdp_epsilon = 5.5    # Tolerance for RDP simplification (in meters, about the 0.00005 degrees used before)
 
 # --- Densification Function ---
 def densify_path(lat_lng_path, end_heading, distance=distance_threshold):
@@ -71,11 +22,13 @@ def densify_path(lat_lng_path, end_heading, distance=distance_threshold):
     """
     dense_path = [lat_lng_path[0]]
     headings = []
+    gaps = path_distances(lat_lng_path)
+    bearings = path_bearings(lat_lng_path).tolist()
     
     for i in range(len(lat_lng_path) - 1):
         start, end = lat_lng_path[i], lat_lng_path[i + 1]
-        gap = geodesic(start, end).meters
-        bearing = calculate_bearing(start, end)
+        gap = gaps[i]
+        bearing = bearings[i]
         headings.append(bearing)
         
         if gap > distance:
@@ -100,31 +53,23 @@ def smooth_headings(headings, window_size=5):
     window_size should be an odd number for a symmetric window.
     Returns a list of smoothed headings.
     """
-    n = len(headings)
-    smoothed = []
-    for i in range(n):
-        # Define window limits
-        start = max(0, i - window_size // 2)
-        end = min(n, i + window_size // 2 + 1)
-        window = headings[start:end]
-        sin_sum = sum(math.sin(math.radians(h)) for h in window)
-        cos_sum = sum(math.cos(math.radians(h)) for h in window)
-        avg_heading = math.degrees(math.atan2(sin_sum, cos_sum)) % 360
-        smoothed.append(round(avg_heading, 2))
-    return smoothed
+    return np.round(circular_moving_average(headings, window_size), 2).tolist()
 
 # --- Process Route ---
-def process_route(route):
+def process_route(route, simplified_indices=None):
     """
     Processes a route by:
       1. Simplifying the path with RDP,
       2. Densifying (interpolating) between key points,
       3. Computing and then smoothing the headings.
     Updates the route in-place by replacing 'lat_lng_path' and 'headings' with processed data.
+    simplified_indices can pass the RDP indices of the route computed beforehand.
     """
     original_path = route["lat_lng_path"]
     # Step 1: Simplify with RDP to remove small noisy fluctuations.
-    simplified_path = rdp(original_path, rdp_epsilon)
+    if simplified_indices is None:
+        simplified_indices = rdp_indices([original_path], rdp_epsilon)[0]
+    simplified_path = [original_path[i] for i in simplified_indices]
     
     # Step 2: Densify the simplified path.
     dense_path, headings = densify_path(simplified_path, route["end_heading"], distance=distance_threshold)
@@ -141,16 +86,29 @@ def process_route(route):
     del route['ground_truth_position']
     route["lat_lng_path"] = dense_path
     route["headings"] = smoothed_headings
-
-def process_positions(input_file, output_file):
-    with open(input_file, 'r') as f:
-        positions_data = json.load(f)
-    
-    for route in positions_data:
-        process_route(route)
-        
-    with open(output_file, 'w') as f:
-        json.dump(positions_data, f, indent=4)
+    return route
+
+def process_simplified_route(item):
+    """process_route for a (route, simplified_indices) pair, for pool_map."""
+    route, simplified_indices = item
+    return process_route(route, simplified_indices)
+
+def simplify_batches(routes, batch_size=1024):
+    """Yield (route, simplified_indices) pairs, simplifying each batch of routes in one call."""
+    for batch in iter_batches(routes, batch_size):
+        all_indices = rdp_indices([route["lat_lng_path"] for route in batch], rdp_epsilon)
+        yield from zip(batch, all_indices)
+
+def process_positions(input_file, output_file, processes=None):
+    # routes are streamed from the input to the output, failed routes are reported and left out
+    errors = []
+    with RouteWriter(output_file) as writer:
+        for route, error in pool_imap(process_simplified_route, simplify_batches(iter_routes(input_file)), processes):
+            if error is None:
+                writer.write(route)
+            else:
+                errors.append(error)
+    report_errors(errors, "full_positions_pipeline")
 
 if __name__ == "__main__":
     # input_file = "../data/test_positions_easy.json"
@@ -4,11 +4,13 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from graph_loader import GraphLoader
 from graph_loader import GraphWriter
 from graph_loader import Graph, Node
+from itertools import islice
+from route_io import iter_routes, RouteWriter
 import pdb
 
+# the routes are streamed from this file by consolidate_nodes
 file_path = '../data/test_positions_easy.json'  
-with open(file_path, 'r') as file:
-    positions = json.load(file)
+positions = iter_routes(file_path)
 
 file_path = '../metadata/test_easy_panoid_mapping.json'  
 with open(file_path, 'r') as file:
@@ -29,7 +31,8 @@ def remove_consecutive_repeats(lst):
         idx_mapping[i+1] = idx
     return result, idx_mapping
 
-def consolidate_nodes(graph, panoid_mapping, test_positions):
+# Writes each consolidated route of test_positions to writer, returns the consolidated graph
+def consolidate_nodes(graph, panoid_mapping, test_positions, writer):
     new_graph = Graph()
     # Step 1: Reverse mapping from panoid to node names
     panoid_to_nodes = {}
@@ -69,8 +72,7 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
         node.neighbors = new_neighbors
     
     # Step 3: Update test_positions route
-    new_positions = []
-    for route in test_positions[:60]:
+    for route in islice(test_positions, 60):
         new_route = [panoid_mapping[node] for node in route['route_panoids']]
 
         new_route, idx_mapping = remove_consecutive_repeats(new_route)
@@ -101,15 +103,13 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
         route['route_panoids'] = new_route
         route['lat_lng_path'] = new_lat_lng
         route['image_list'] = heading_route
-        new_positions.append(route)
-
-    return new_graph, new_positions
+        writer.write(route)
 
-new_graph, new_positions = consolidate_nodes(graph, panoid_mapping, positions)
+    return new_graph
 
 out_file_path = '../data/test_positions_easy_mapped.json'
-with open(file_path, 'w') as file:
-    json.dump(new_positions, file, indent=2)
+with RouteWriter(out_file_path) as writer:
+    new_graph = consolidate_nodes(graph, panoid_mapping, positions, writer)
 
 graph_writer = GraphWriter(node_file='../graph/easy_nodes_mapped.txt', edge_file='../graph/easy_links_mapped.txt')
 graph_writer.write_graph(new_graph)
\ No newline at end of file
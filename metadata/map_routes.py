@@ -1,16 +1,19 @@
-import json, math
+import json
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from graph_loader import GraphLoader
 from graph_loader import GraphWriter
 from graph_loader import Graph, Node
+from headings import calculate_bearing, path_bearings
+from itertools import islice
+from route_io import iter_routes, RouteWriter
 import pdb
 
 graph = GraphLoader("../graph/aug_nodes.txt", "../graph/aug_links.txt").construct_graph()
 
+# the routes are streamed from this file by consolidate_nodes
 file_path = '../data/test_positions_easy.json'  
-with open(file_path, 'r') as file:
-    positions = json.load(file)
+positions = iter_routes(file_path)
 
 file_path = '../metadata/test_easy_panoid_mapping.json'  
 with open(file_path, 'r') as file:
@@ -31,30 +34,15 @@ def remove_consecutive_repeats(panoids, lat_lng):
         idx_mapping[i+1] = idx
     return panoid_result, lat_lng_result, idx_mapping
 
-# Function to calculate the initial bearing between two points
-def calculate_bearing(pos1, pos2):
-    lat1, lon1 = pos1
-    lat2, lon2 = pos2
-    # Convert degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    delta_lon = lon2 - lon1
-
-    x = math.sin(delta_lon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta_lon)
-    initial_bearing = math.atan2(x, y)
-
-    # Convert radians to degrees and normalize
-    return (math.degrees(initial_bearing) + 360) % 360
-
-def consolidate_nodes(graph, panoid_mapping, test_positions):
+# Writes each consolidated route of test_positions to writer, returns the consolidated graph
+def consolidate_nodes(graph, panoid_mapping, test_positions, writer):
     new_graph = Graph()
-    new_positions = []
     # Step 1: Reverse mapping from panoid to node names
     panoid_to_nodes = {}
     for node_name, panoid in panoid_mapping.items():
         panoid_to_nodes.setdefault(panoid, []).append(node_name)
 
-    for route in test_positions[:60]:
+    for route in islice(test_positions, 60):
         new_route = [panoid_mapping[node] for node in route['route_panoids']]
 
         new_route, new_lat_lng, idx_mapping = remove_consecutive_repeats(new_route, route['lat_lng_path'])
@@ -66,6 +54,7 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
         route["ground_truth_position"]["panoid"] = panoid_mapping[route["ground_truth_position"]["panoid"]]
         route["ground_truth_position"]["path_index"] = idx_mapping[route["ground_truth_position"]["path_index"]]
 
+        route_bearings = path_bearings(new_lat_lng).tolist()
         heading_route = []
         for i, panoid in enumerate(new_route):
             current_coord = new_lat_lng[i]
@@ -76,7 +65,7 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
                 new_graph.nodes[panoid] = new_node
             next_coord = new_lat_lng[i+1] if i < len(new_route) - 1 else None
             if next_coord:
-                heading = int(calculate_bearing(current_coord, next_coord))
+                heading = int(route_bearings[i])
                 if heading in new_graph.nodes[panoid].neighbors:
                     print(f"Duplicate heading {heading} in node {panoid}")
                 new_graph.nodes[panoid].neighbors[heading] = new_route[i+1]
@@ -87,7 +76,7 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
         route['route_panoids'] = new_route
         route['lat_lng_path'] = new_lat_lng
         route['image_list'] = heading_route
-        new_positions.append(route)
+        writer.write(route)
 
     for node in new_graph.nodes.values():
         new_neighbors = {}
@@ -95,13 +84,11 @@ def consolidate_nodes(graph, panoid_mapping, test_positions):
             new_neighbors[heading] = new_graph.nodes[neighbor]
         node.neighbors = new_neighbors
 
-    return new_graph, new_positions
-
-new_graph, new_positions = consolidate_nodes(graph, panoid_mapping, positions)
+    return new_graph
 
 out_file_path = '../data/test_positions_easy_mapped.json'
-with open(out_file_path, 'w') as file:
-    json.dump(new_positions, file, indent=2)
+with RouteWriter(out_file_path) as writer:
+    new_graph = consolidate_nodes(graph, panoid_mapping, positions, writer)
 
 graph_writer = GraphWriter(node_file='../graph/easy_nodes_mapped.txt', edge_file='../graph/easy_links_mapped.txt')
 graph_writer.write_graph(new_graph)
\ No newline at end of file
@@ -1,11 +1,12 @@
 import os
-import json
+import sys
 from PIL import Image
 import pytesseract
 import requests
 import base64
 from tqdm import tqdm
-import pdb
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from route_io import iter_routes, RouteWriter
 
 # Adjust this path to your input file
 INPUT_JSON_FILE = "../../data-collection/test_positions_easy_processed_mapped_answered_redistanced_v2.json"
@@ -14,8 +15,10 @@ IMAGES_DIR = "../../data-collection/thumbnails_sharpened/"  # directory where yo
 
 API_KEY = os.getenv("GOOGLE_VISION_API_KEY")
 
-if not API_KEY:
-    raise ValueError("Please set the GOOGLE_VISION_API_KEY environment variable.")
+def check_api_key():
+    # checked when OCR runs rather than on import, so the pipeline can import this module
+    if not API_KEY:
+        raise ValueError("Please set the GOOGLE_VISION_API_KEY environment variable.")
 # Set the path to the Tesseract OCR executable
 # pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"  # Adjust this path if needed
 
@@ -44,7 +47,6 @@ def google_ocr(image_path):
         return ""
 
     result = response.json()
-    pdb.set_trace()
     try:
         return result["responses"][0]["textAnnotations"][0]["description"]
     except (KeyError, IndexError):
@@ -61,13 +63,13 @@ def pytesseract_ocr(filename):
         print(f"Error processing {filename}: {e}")
         return ""
 
-def process_routes(routes):
-    """Add OCR text to each path entry in the routes list."""
+def process_routes(routes, images_dir=IMAGES_DIR):
+    """Add OCR text to each path entry of the routes, yielding the routes one by one."""
     for route in tqdm(routes):
         for step in route.get("path", []):
             pano_id = step["pano_id"]
             pano_heading = step["pano_heading"]
-            image_filename = os.path.join(IMAGES_DIR, f"{pano_id}_{pano_heading}_sharpened.jpg")
+            image_filename = os.path.join(images_dir, f"{pano_id}_{pano_heading}_sharpened.jpg")
 
             if not os.path.exists(image_filename):
                 print(f"Image file not found: {image_filename}")
@@ -80,21 +82,18 @@ def process_routes(routes):
             google_ocr_text = google_ocr(image_filename)
             step["google_ocr_text"] = google_ocr_text
 
-    return routes
+        yield route
 
-def main():
-    # Load input JSON
-    with open(INPUT_JSON_FILE, "r") as f:
-        routes = json.load(f)
-
-    # Process with OCR
-    updated_routes = process_routes(routes)
+def process_file(input_file, output_file, images_dir=IMAGES_DIR):
+    """Stream the routes of input_file through OCR into output_file."""
+    check_api_key()
+    with RouteWriter(output_file) as writer:
+        writer.write_all(process_routes(iter_routes(input_file), images_dir))
 
-    # Save output JSON
-    with open(OUTPUT_JSON_FILE, "w") as f:
-        json.dump(updated_routes, f, indent=2)
+    print(f"OCR results saved to: {output_file}")
 
-    print(f"OCR results saved to: {OUTPUT_JSON_FILE}")
+def main():
+    process_file(INPUT_JSON_FILE, OUTPUT_JSON_FILE)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,376 @@
+"""
+Runs the route metadata stages as a DAG with a content-hashed cache.
+
+    train_positions.json
+      -> densify             full_positions_pipeline.py   RDP, densify and smooth headings   (_processed_v2)
+      -> map_panoids         full_thumbnail_pipeline.py   snap to Street View panoids         (_processed_mapped_v2, no turns)
+      -> turns               compute_turns.py             turns of every route                (_processed_mapped_v2)
+      -> choices             select_mc_choices.py         multiple choice positions           (_answered_v2)
+      -> redistance          compute_distances.py         distances along the path            (_redistanced_v2)
+      -> ocr                 perform_ocr.py               OCR of the thumbnails               (_ocr_v2)
+
+Every stage runs in a subprocess, in the directory of its script, by calling
+a function of the script with keyword arguments. Its outputs are written to
+<cache_dir>/<stage>/<key>/, where key hashes the stage source (and the shared
+root modules), its parameters and the keys or file contents of its inputs,
+and are then copied to their usual paths under data/. A stage whose key is
+already in the cache is not run again, so after changing one stage or one
+parameter only that stage and the stages downstream of it run. Stages whose
+inputs are ready run concurrently, for example the stages of different
+splits.
+
+    python pipeline.py --splits train test_easy --jobs 2
+    python pipeline.py --splits train --only redistance --dry_run
+    python pipeline.py --splits train --from choices
+
+--from starts the DAG at the given stages: their upstream outputs are read
+from the files under data/ that those stages last materialized, instead of
+being rebuilt from the raw split. A stage whose input file does not exist is
+reported as missing and the stages downstream of it are skipped.
+"""
+import argparse
+import errno
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# shared modules imported by the stages, a change to any of them reruns every stage
+SHARED_CODE = ['geodesy.py', 'headings.py', 'route_io.py', 'route_pool.py', 'route_store.py']
+# file name prefix of the routes of each split under data/
+SPLITS = {'train': 'train_positions', 'test_easy': 'test_positions_easy'}
+
+RUNNER = (
+    'import importlib, json, sys; '
+    'module, function = sys.argv[1:3]; '
+    'getattr(importlib.import_module(module), function)(**json.loads(sys.argv[3]))'
+)
+
+
+class Stage:
+    """
+    One step of the pipeline: `function` of the script `script` (relative to
+    the repository root) called with the input paths, the output paths,
+    `params` and `options` as keyword arguments.
+
+    inputs maps argument names to files under the root or to 'stage:output'
+    references to another stage. outputs maps argument names to the path
+    under the root the output is copied to, or None to keep it in the cache
+    only. params are part of the cache key, options (like the number of
+    processes) are not and must not change the outputs.
+    """
+    def __init__(self, name, script, function, inputs, outputs, params=None, options=None, code=()):
+        self.name = name
+        self.script = script
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+        self.options = options or {}
+        self.code = [script] + SHARED_CODE + list(code)
+
+    def dependencies(self):
+        return sorted({ref.split(':')[0] for ref in self.inputs.values() if ':' in ref})
+
+
+def build_stages(splits, processes=None, images_dir=None, cutoff=300):
+    """The stages of every split, named <split>/<stage>."""
+    stages = []
+    for split in splits:
+        prefix = 'data/' + SPLITS[split]
+        ref = lambda stage, output: '{}/{}:{}'.format(split, stage, output)
+        pool = {'processes': processes}
+        stages += [
+            Stage(split + '/densify', 'metadata/full_positions_pipeline.py', 'process_positions',
+                  inputs={'input_file': prefix + '.json'},
+                  outputs={'output_file': prefix + '_processed_v2.json'},
+                  options=pool, code=['metadata/rdp.py']),
+            Stage(split + '/map_panoids', 'panoids/full_thumbnail_pipeline.py', 'process_positions',
+                  inputs={'input_json': ref('densify', 'output_file')},
+                  outputs={'output_json': None},
+                  params={'cutoff': cutoff}),
+            Stage(split + '/turns', 'metadata/compute_turns.py', 'process_json_file',
+                  inputs={'input_file': ref('map_panoids', 'output_json')},
+                  outputs={'modified_file': prefix + '_processed_mapped_v2.json',
+                           'output_file': 'metadata/' + SPLITS[split] + '_processed_turns_v2.json'},
+                  options=pool),
+            Stage(split + '/choices', 'metadata/select_mc_choices.py', 'process_routes',
+                  inputs={'input_filename': ref('turns', 'modified_file')},
+                  outputs={'output_filename': prefix + '_processed_mapped_answered_v2.json'},
+                  params={'seed': 0}, options=pool),
+            Stage(split + '/redistance', 'metadata/compute_distances.py', 'process_json',
+                  inputs={'input_path': ref('choices', 'output_filename')},
+                  outputs={'output_path': prefix + '_processed_mapped_answered_redistanced_v2.json'},
+                  options=pool),
+            Stage(split + '/ocr', 'metadata/perform_ocr.py', 'process_file',
+                  inputs={'input_file': ref('redistance', 'output_path')},
+                  outputs={'output_file': prefix + '_processed_mapped_answered_redistanced_ocr_v2.json'},
+                  params={'images_dir': images_dir} if images_dir else {}),
+        ]
+    return stages
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages, cache_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.keys = {}
+        self.timings = []
+        # content hashes of source files, reused while their size and mtime do not change
+        self.hash_file = os.path.join(cache_dir, 'file_hashes.json')
+        self.file_hashes = json.load(open(self.hash_file)) if os.path.exists(self.hash_file) else {}
+        for stage in stages:
+            for dependency in stage.dependencies():
+                if dependency not in self.stages:
+                    raise ValueError('Stage {} depends on unknown stage {}'.format(stage.name, dependency))
+
+    def start_from(self, names):
+        """
+        Start the DAG at the stages named in `names` (or ending in /<name>):
+        their references to upstream stages are replaced by the files under
+        the root those upstream outputs are copied to, and the stages before
+        them are dropped from the pipeline.
+        """
+        starts = [name for name in self.stages if name in names or name.split('/')[-1] in names]
+        upstream_stages = set()
+        pending = [dependency for name in starts for dependency in self.stages[name].dependencies()]
+        while pending:
+            name = pending.pop()
+            if name not in upstream_stages:
+                upstream_stages.add(name)
+                pending += self.stages[name].dependencies()
+        for name in starts:
+            stage = self.stages[name]
+            for argument, ref in stage.inputs.items():
+                if ':' not in ref:
+                    continue
+                upstream, output = ref.split(':')
+                path = self.stages[upstream].outputs[output]
+                if path is None:
+                    raise ValueError('Stage {} cannot start from {}: output {} of {} is only kept in the cache'.format(
+                        stage.name, ref, output, upstream))
+                stage.inputs[argument] = path
+        for name in upstream_stages - set(starts):
+            del self.stages[name]
+
+    def file_hash(self, relative_path):
+        path = os.path.join(ROOT, relative_path)
+        if not os.path.exists(path):
+            raise FileNotFoundError(errno.ENOENT, 'Pipeline input not found', path)
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        cached = self.file_hashes.get(path)
+        if cached is None or cached[0] != signature:
+            self.file_hashes[path] = cached = [signature, sha256_file(path)]
+        return cached[1]
+
+    def key(self, name):
+        """Hash of the stage code, its parameters and its inputs, through the keys of upstream stages."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            inputs = {}
+            for argument, ref in sorted(stage.inputs.items()):
+                if ':' in ref:
+                    upstream, output = ref.split(':')
+                    inputs[argument] = [self.key(upstream), output]
+                else:
+                    inputs[argument] = self.file_hash(ref)
+            description = {
+                'function': stage.function,
+                'code': {path: self.file_hash(path) for path in stage.code},
+                'params': stage.params,
+                'inputs': inputs,
+            }
+            self.keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16]
+        return self.keys[name]
+
+    def stage_dir(self, name):
+        return os.path.join(self.cache_dir, name, self.key(name))
+
+    def output_path(self, name, output):
+        # outputs keep their file name, so route_io picks the same format
+        stage = self.stages[name]
+        filename = os.path.basename(stage.outputs[output] or output + '.json')
+        return os.path.join(self.stage_dir(name), filename)
+
+    def input_path(self, ref):
+        if ':' in ref:
+            return self.output_path(*ref.split(':'))
+        return os.path.join(ROOT, ref)
+
+    def is_cached(self, name):
+        return os.path.exists(os.path.join(self.stage_dir(name), 'done.json'))
+
+    def select(self, only=None):
+        """The stages to consider: all of them, or those named in `only` (or ending in /<name>) and their upstream stages."""
+        if not only:
+            return list(self.stages)
+        selected = set()
+        pending = [name for name in self.stages if name in only or name.split('/')[-1] in only]
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending += self.stages[name].dependencies()
+        return [name for name in self.stages if name in selected]
+
+    def run_stage(self, name):
+        """Run one stage in a subprocess, returns (returncode, seconds)."""
+        stage = self.stages[name]
+        stage_dir = self.stage_dir(name)
+        tmp_dir = stage_dir + '.tmp{}'.format(os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        kwargs = {argument: self.input_path(ref) for argument, ref in stage.inputs.items()}
+        for output in stage.outputs:
+            kwargs[output] = os.path.join(tmp_dir, os.path.basename(self.output_path(name, output)))
+        kwargs.update(stage.params)
+        kwargs.update(stage.options)
+
+        module = os.path.splitext(os.path.basename(stage.script))[0]
+        command = [sys.executable, '-c', RUNNER, module, stage.function, json.dumps(kwargs)]
+        start = time.perf_counter()
+        with open(os.path.join(tmp_dir, 'log.txt'), 'w') as log:
+            returncode = subprocess.call(command, cwd=os.path.join(ROOT, os.path.dirname(stage.script)),
+                                         stdout=log, stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+        missing = [output for output in stage.outputs if not os.path.exists(kwargs[output])]
+        if returncode == 0 and missing:
+            with open(os.path.join(tmp_dir, 'log.txt'), 'a') as log:
+                log.write('pipeline: outputs not written: {}\n'.format(', '.join(missing)))
+            returncode = 1
+        if returncode == 0:
+            with open(os.path.join(tmp_dir, 'done.json'), 'w') as f:
+                json.dump({'stage': name, 'key': self.key(name), 'seconds': seconds, 'kwargs': kwargs}, f, indent=2)
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            os.replace(tmp_dir, stage_dir)
+        else:
+            failed_dir = stage_dir + '.failed'
+            shutil.rmtree(failed_dir, ignore_errors=True)
+            os.replace(tmp_dir, failed_dir)
+        return returncode, seconds
+
+    def materialize(self, name):
+        """Copy the outputs of a stage from the cache to their paths under the root, if they differ."""
+        for output, path in self.stages[name].outputs.items():
+            if path is None:
+                continue
+            source = self.output_path(name, output)
+            target = os.path.join(ROOT, path)
+            if os.path.exists(target) and os.path.getsize(target) == os.path.getsize(source) \
+                    and sha256_file(target) == sha256_file(source):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target + '.tmp')
+            os.replace(target + '.tmp', target)
+
+    def run(self, only=None, jobs=1, force=(), dry_run=False):
+        names = self.select(only)
+        force = {name for name in names if name in force or name.split('/')[-1] in force}
+        # a forced stage invalidates nothing else, its outputs get the same key
+        # stages whose inputs (or upstream inputs) do not exist cannot be keyed or run
+        missing = {}
+        for name in names:
+            try:
+                self.key(name)
+            except FileNotFoundError as error:
+                missing[name] = error.filename
+        status = {name: 'missing' if name in missing else 'cached' if self.is_cached(name) and name not in force else 'pending'
+                  for name in names}
+        self.save_file_hashes()
+        for name in names:
+            if name in missing:
+                print('[Pipeline]: {} cannot run, input not found: {}'.format(name, missing[name]))
+        if dry_run:
+            for name in names:
+                print('{:<28} {:<8} {}'.format(name, {'pending': 'run'}.get(status[name], status[name]), self.keys.get(name, '-')))
+            return not missing
+
+        for name in names:
+            if status[name] == 'missing':
+                self.timings.append({'stage': name, 'status': 'missing', 'seconds': 0.0})
+
+        for name in names:
+            if status[name] == 'cached':
+                self.materialize(name)
+                self.timings.append({'stage': name, 'status': 'cached', 'seconds': 0.0})
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while True:
+                for name in names:
+                    if status[name] != 'pending':
+                        continue
+                    dependencies = [dependency for dependency in self.stages[name].dependencies() if dependency in status]
+                    if any(status[dependency] in ('failed', 'skipped', 'missing') for dependency in dependencies):
+                        status[name] = 'skipped'
+                        self.timings.append({'stage': name, 'status': 'skipped', 'seconds': 0.0})
+                    elif all(status[dependency] in ('cached', 'ran') for dependency in dependencies):
+                        print('[Pipeline]: running {} ({})'.format(name, self.key(name)))
+                        status[name] = 'running'
+                        running[executor.submit(self.run_stage, name)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    returncode, seconds = future.result()
+                    status[name] = 'ran' if returncode == 0 else 'failed'
+                    self.timings.append({'stage': name, 'status': status[name], 'seconds': seconds})
+                    if returncode == 0:
+                        self.materialize(name)
+                        print('[Pipeline]: {} finished in {:.1f}s'.format(name, seconds))
+                    else:
+                        print('[Pipeline]: {} failed, see {}'.format(name, os.path.join(self.stage_dir(name) + '.failed', 'log.txt')))
+
+        self.report()
+        return all(status[name] in ('cached', 'ran') for name in names)
+
+    def save_file_hashes(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.hash_file + '.tmp', 'w') as f:
+            json.dump(self.file_hashes, f)
+        os.replace(self.hash_file + '.tmp', self.hash_file)
+
+    def report(self):
+        print('| stage | status | seconds |')
+        print('|-------|--------|--------:|')
+        for timing in self.timings:
+            print('| {} | {} | {:.1f} |'.format(timing['stage'], timing['status'], timing['seconds']))
+        with open(os.path.join(self.cache_dir, 'timings.jsonl'), 'a') as f:
+            for timing in self.timings:
+                f.write(json.dumps(dict(timing, key=self.keys.get(timing['stage']), time=time.time())) + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the route metadata pipeline with cached stages")
+    parser.add_argument("--splits", nargs="+", default=["train"], choices=sorted(SPLITS), help="splits to build")
+    parser.add_argument("--only", nargs="+", default=None, help="run only these stages (and what they need), e.g. redistance or train/turns")
+    parser.add_argument("--from", dest="start", nargs="+", default=(),
+                        help="start at these stages, reading their inputs from the files under data/ instead of running the stages before them")
+    parser.add_argument("--force", nargs="+", default=(), help="rerun these stages even if they are cached")
+    parser.add_argument("--jobs", type=int, default=2, help="stages run at the same time")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes of each stage (default: all cores)")
+    parser.add_argument("--images_dir", default=None, help="thumbnails read by the OCR stage")
+    parser.add_argument("--cutoff", type=int, default=300, help="routes mapped to panoids per split")
+    parser.add_argument("--cache_dir", default=os.path.join(ROOT, "pipeline_cache"), help="where stage outputs are cached")
+    parser.add_argument("--dry_run", action="store_true", help="print which stages would run")
+    args = parser.parse_args()
+
+    stages = build_stages(args.splits, args.processes, args.images_dir, args.cutoff)
+    pipeline = Pipeline(stages, args.cache_dir)
+    pipeline.start_from(args.start)
+    sys.exit(0 if pipeline.run(args.only, args.jobs, args.force, args.dry_run) else 1)
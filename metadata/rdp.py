@@ -1,4 +1,3 @@
-# unmodified from GPT code yet
 """
 The Ramer-Douglas-Peucker (RDP) algorithm simplifies a polyline by removing points that do not significantly change its overall shape. The remaining points will be the ones where the path “turns” in a global sense.
 
@@ -24,61 +23,182 @@ Considerations
     Thresholds: You’ll need to set thresholds for what constitutes a “big turn” versus small fluctuations. Adjust the smoothing window size and peak detection parameters accordingly.
     Handling Angle Wraparound: When dealing with angles, remember that they wrap around (e.g. from 359° back to 0°). Ensure you adjust your differences accordingly (e.g. by working in a circular space).
 """
+import argparse
+import json
 import math
-from typing import List, Tuple
+import os
+import sys
+import time
+from itertools import chain
+from typing import List, Sequence, Tuple
 
-def rdp(points: List[Tuple[float, float]], epsilon: float) -> Tuple[List[Tuple[float, float]], List[int]]:
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from geodesy import local_meters
+# compute_heading(p1, p2) is the bearing (in degrees) from p1 to p2
+from headings import calculate_bearing as compute_heading, path_bearings, angle_difference
+
+
+def line_distances(points: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """
+    Distances from each point to the line through start and end, which are
+    broadcast against points. Where start and end coincide, the distance to start.
+    """
+    direction = end - start
+    offset = points - start
+    length = np.hypot(direction[..., 0], direction[..., 1])
+    cross = np.abs(direction[..., 0] * offset[..., 1] - direction[..., 1] * offset[..., 0])
+    return np.where(length > 0, cross / np.where(length > 0, length, 1.0), np.hypot(offset[..., 0], offset[..., 1]))
+
+
+def rdp_indices(paths: Sequence[Sequence[Tuple[float, float]]], epsilon: float, projected: bool = False) -> List[np.ndarray]:
+    """
+    Ramer-Douglas-Peucker simplification of many paths at once.
+
+    paths are (lat, lng) paths, projected to local meters around their first
+    point so epsilon is in meters; with projected=True they are used as given.
+    Returns the sorted indices of the points kept in each path.
+
+    Instead of recursing, a stack of (start, end) spans to split is kept for
+    all paths together. Every pass pops all pending spans, finds the farthest
+    point of each with a few numpy calls, and pushes the two halves of every
+    span whose farthest point is more than epsilon away. So the number of
+    passes is the recursion depth, not the number of spans, and no list is
+    sliced or copied.
+    """
+    lengths = np.array([len(path) for path in paths], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    if offsets[-1] == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in paths]
+    # one flat conversion for all paths, converting path by path costs more than the simplification
+    points = np.fromiter(chain.from_iterable(chain.from_iterable(paths)), dtype=np.float64, count=2 * offsets[-1]).reshape(-1, 2)
+    if not projected:
+        origins = np.repeat(points[offsets[:-1][lengths > 0]], lengths[lengths > 0], axis=0)
+        points = local_meters(points, origins)
+
+    keep = np.zeros(len(points), dtype=bool)
+    nonempty = lengths > 0
+    keep[offsets[:-1][nonempty]] = True
+    keep[offsets[1:][nonempty] - 1] = True
+
+    # spans are global (start, end) index pairs with at least one point between them
+    spans = np.stack([offsets[:-1], offsets[1:] - 1], axis=1)[lengths >= 3]
+    while len(spans):
+        starts, ends = spans[:, 0], spans[:, 1]
+        counts = ends - starts - 1
+        span_ids = np.repeat(np.arange(len(spans)), counts)
+        first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # global index of every interior point of every span
+        interior = starts[span_ids] + 1 + np.arange(counts.sum()) - first[span_ids]
+        dists = line_distances(points[interior], points[starts[span_ids]], points[ends[span_ids]])
+
+        max_dists = np.maximum.reduceat(dists, first)
+        # the first point at the maximum distance, as in the recursive version
+        candidates = np.where(dists == max_dists[span_ids], interior, len(points))
+        splits = np.minimum.reduceat(candidates, first)
+
+        split = max_dists > epsilon
+        keep[splits[split]] = True
+        halves = np.concatenate([
+            np.stack([starts[split], splits[split]], axis=1),
+            np.stack([splits[split], ends[split]], axis=1)
+        ])
+        spans = halves[halves[:, 1] - halves[:, 0] >= 2]
+
+    kept = np.flatnonzero(keep)
+    bounds = np.searchsorted(kept, offsets)
+    return [kept[bounds[i]:bounds[i + 1]] - offsets[i] for i in range(len(paths))]
+
+
+def rdp(points: List[Tuple[float, float]], epsilon: float, projected: bool = False) -> Tuple[List[Tuple[float, float]], List[int]]:
     """
-    A simple recursive implementation of the Ramer-Douglas-Peucker algorithm.
+    Simplify a single path with rdp_indices.
     Returns a tuple (simplified_points, indices) where 'indices' are the positions in the
     original list corresponding to the simplified_points.
     """
+    indices = rdp_indices([points], epsilon, projected)[0].tolist()
+    return [points[i] for i in indices], indices
+
+
+def _rdp_recursive(points: np.ndarray, epsilon: float, first: int = 0) -> List[int]:
+    """Reference recursive implementation on projected points, used to check rdp_indices."""
     if len(points) < 3:
-        return points, list(range(len(points)))
-    
-    # Line from start to end
-    start, end = points[0], points[-1]
+        return list(range(first, first + len(points)))
+    dists = line_distances(points[1:-1], points[0], points[-1])
+    index = int(np.argmax(dists)) + 1
+    if dists[index - 1] > epsilon:
+        first_half = _rdp_recursive(points[:index + 1], epsilon, first)
+        second_half = _rdp_recursive(points[index:], epsilon, first + index)
+        return first_half[:-1] + second_half
+    return [first, first + len(points) - 1]
+
+
+def _rdp_degrees(points, epsilon):
+    """The previous list based recursive version from full_positions_pipeline, in degrees."""
+    if len(points) < 3:
+        return points
+    (x1, y1), (x2, y2) = points[0], points[-1]
+    base = math.hypot(x2 - x1, y2 - y1)
     max_dist = 0
     index = 0
-    for i in range(1, len(points)-1):
-        # Compute perpendicular distance from point to the line (start, end).
-        dist = perpendicular_distance(points[i], start, end)
-        if dist > max_dist:
+    for i in range(1, len(points) - 1):
+        x0, y0 = points[i]
+        if base == 0:
+            d = math.hypot(x0 - x1, y0 - y1)
+        else:
+            d = abs(x1*(y2-y0) + x2*(y0-y1) + x0*(y1-y2)) / base
+        if d > max_dist:
+            max_dist = d
             index = i
-            max_dist = dist
-
     if max_dist > epsilon:
-        # Recursively simplify
-        first_half, indices_first = rdp(points[:index+1], epsilon)
-        second_half, indices_second = rdp(points[index:], epsilon)
-        # Remove duplicate at the junction
-        return (first_half[:-1] + second_half, indices_first[:-1] + [i + index for i in indices_second])
-    else:
-        return [start, end], [0, len(points)-1]
-
-def perpendicular_distance(point: Tuple[float, float], start: Tuple[float, float], end: Tuple[float, float]) -> float:
-    """Compute the perpendicular distance from point to the line defined by start and end."""
-    # If start and end are the same, return the Euclidean distance.
-    if start == end:
-        return math.hypot(point[0]-start[0], point[1]-start[1])
-    
-    num = abs((end[1]-start[1])*point[0] - (end[0]-start[0])*point[1] + end[0]*start[1] - end[1]*start[0])
-    den = math.hypot(end[1]-start[1], end[0]-start[0])
-    return num / den
-
-def compute_heading(p1: Tuple[float, float], p2: Tuple[float, float]) -> float:
-    """Compute the bearing (in degrees) from p1 to p2."""
-    lat1, lon1 = map(math.radians, p1)
-    lat2, lon2 = map(math.radians, p2)
-    dlon = lon2 - lon1
-    x = math.sin(dlon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
-    bearing = math.atan2(x, y)
-    bearing_deg = (math.degrees(bearing) + 360) % 360
-    return bearing_deg
+        return _rdp_degrees(points[:index + 1], epsilon)[:-1] + _rdp_degrees(points[index:], epsilon)
+    return [points[0], points[-1]]
+
+
+def densify(path, factor):
+    """Linear interpolation of a path to `factor` times as many points, for benchmarking."""
+    path = np.asarray(path, dtype=np.float64)
+    steps = np.linspace(0, len(path) - 1, factor * len(path))
+    positions = np.arange(len(path))
+    return list(zip(np.interp(steps, positions, path[:, 0]).tolist(), np.interp(steps, positions, path[:, 1]).tolist()))
+
+
+def benchmark(input_file, epsilon=5.5, repeats=3, factor=10):
+    """Time the per-route recursive versions against one rdp_indices call over a split."""
+    with open(input_file) as f:
+        routes = json.load(f)
+    paths = [[(p['pano_lat'], p['pano_lng']) for p in route['path']] for route in routes]
+
+    def best_time(fn):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+        return min(times) * 1000, result
+
+    print('| paths | points | kept | recursive lists, degrees (old) ms | recursive numpy, per route ms | rdp_indices, all routes ms |')
+    print('|-------|-------:|-----:|----:|----:|----:|')
+    for name, case in [('split', paths), ('split at {}x density'.format(factor), [densify(path, factor) for path in paths])]:
+        projected = [local_meters(path) for path in case]
+        degrees_ms, _ = best_time(lambda: [_rdp_degrees(path, 0.00005) for path in case])
+        recursive_ms, reference = best_time(lambda: [_rdp_recursive(path, epsilon) for path in projected])
+        batched_ms, indices = best_time(lambda: rdp_indices(case, epsilon))
+        assert all(ref == kept.tolist() for ref, kept in zip(reference, indices))
+        print('| {} | {} | {} | {:.1f} | {:.1f} | {:.1f} |'.format(
+            name, sum(map(len, case)), sum(map(len, indices)), degrees_ms, recursive_ms, batched_ms))
+
 
 # Example usage:
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RDP simplification example and benchmark")
+    parser.add_argument("--benchmark", default=None, help="time the implementations on a split, e.g. ../data/train_positions_processed_mapped_v2.json")
+    parser.add_argument("--epsilon", type=float, default=5.5, help="tolerance in meters")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.epsilon)
+        sys.exit()
+
     # Replace with your actual lat/lon list.
     path = [
         (40.733685, -74.00278),
@@ -90,20 +210,14 @@ if __name__ == "__main__":
         (40.733365, -74.002579),
     ]
     
-    # Set a tolerance; this will depend on the scale of your coordinates.
-    tolerance = 0.00005  # Adjust accordingly
-    simplified_path, indices = rdp(path, tolerance)
+    # Set a tolerance in meters; 5.5 m is about the 0.00005 degrees used on raw lat/lon before.
+    simplified_path, indices = rdp(path, args.epsilon)
     print("Simplified Path:", simplified_path)
     print("Indices in original path:", indices)
     
     # Optionally, compute turn angles at the simplified vertices
-    turns = []
-    for i in range(1, len(simplified_path)-1):
-        heading_before = compute_heading(simplified_path[i-1], simplified_path[i])
-        heading_after = compute_heading(simplified_path[i], simplified_path[i+1])
-        turn_angle = (heading_after - heading_before + 360) % 360
-        # Adjust for turns > 180 degrees.
-        if turn_angle > 180:
-            turn_angle = 360 - turn_angle
-        turns.append({"index": indices[i], "turn_angle": turn_angle})
+    segment_headings = path_bearings(simplified_path)
+    # turn angles are the unsigned wrapped differences, in [0, 180]
+    turn_angles = abs(angle_difference(segment_headings[:-1], segment_headings[1:]))
+    turns = [{"index": indices[i], "turn_angle": float(turn_angle)} for i, turn_angle in enumerate(turn_angles, start=1)]
     print("Detected Turns:", turns)
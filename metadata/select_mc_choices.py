@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
-import json
 import math
 import random
 import pdb
-import geopy.distance
+import os
+import sys
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from route_io import iter_routes, RouteWriter
+from route_pool import pool_imap, report_errors
 
 def select_candidate_indices(turns, path_length):
     """
@@ -56,6 +59,7 @@ def compute_multiple_choice_positions(route):
     path = route.get("path", [])
     turns = route.get("turns", [])
     if len(path) < 20:
+        print(f"Route with insufficient path length skipped: {route.get('route_id', 'unknown')}, len= {len(path)}")
         return None
 
     # Determine candidate indices
@@ -88,24 +92,18 @@ def compute_multiple_choice_positions(route):
     route["multiple_choice_positions"] = mc_positions
     return route
 
-def process_routes(input_filename, output_filename):
-    # Load the input JSON.
-    with open(input_filename, "r") as infile:
-        data = json.load(infile)
-    
-    # Expecting data to be a list of routes.
-    processed_routes = []
-    for route in data:
-        new_route = compute_multiple_choice_positions(route)
-        if new_route:
-            processed_routes.append(new_route)
-        else:
-            print(f"Route with insufficient path length skipped: {route.get('route_id', 'unknown')}, len= {len(route.get('path', []))}")
-    
-    # Write the updated data to the output file.
-    with open(output_filename, "w") as outfile:
-        json.dump(processed_routes, outfile, indent=2)
-    print(f"Processed {len(processed_routes)} routes. Output written to {output_filename}")
+def process_routes(input_filename, output_filename, processes=None, seed=0):
+    # Routes are streamed from the input to the output.
+    # Each route is seeded from its route_id and the seed, so the choices are reproducible.
+    errors = []
+    with RouteWriter(output_filename) as writer:
+        for new_route, error in pool_imap(compute_multiple_choice_positions, iter_routes(input_filename), processes, seed=seed):
+            if error is not None:
+                errors.append(error)
+            elif new_route:
+                writer.write(new_route)
+    report_errors(errors, "select_mc_choices")
+    print(f"Processed {writer.count} routes. Output written to {output_filename}")
 
 if __name__ == "__main__":
     # input_file = "../data/test_positions_easy_processed_mapped_v2.json"
@@ -7,7 +7,9 @@ import hmac
 import base64
 import urllib.parse as urlparse
 import pdb
-import math
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from headings import forward_average_bearings, circular_moving_average
 
 # Configuration
 OVERRIDE = True
@@ -23,53 +25,6 @@ REQUEST_DELAY = 0.1  # To avoid hitting API limits
 if not API_KEY or not SIGNATURE:
     raise ValueError("API key or URL signature not found. Set the environment variables.")
 
-# Compute heading for Google Maps
-def calculate_bearing(pos1, pos2):
-    import math
-    lat1, lon1, lat2, lon2 = map(math.radians, [*pos1, *pos2])
-    
-    delta_lon = lon2 - lon1
-    x = math.sin(delta_lon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(delta_lon)
-    
-    return (math.degrees(math.atan2(x, y)) + 360) % 360
-
-def compute_average_bearing(pos, subsequent_positions, window_size=3):
-    """
-    Given the current position `pos` and a list of subsequent positions,
-    compute the circular (angular) mean of the bearings from pos to each of the next few points.
-    """
-    import math
-    bearings = []
-    for i in range(min(window_size, len(subsequent_positions))):
-        bearing = calculate_bearing(pos, subsequent_positions[i])
-        bearings.append(bearing)
-    if not bearings:
-        return 0
-    sin_sum = sum(math.sin(math.radians(b)) for b in bearings)
-    cos_sum = sum(math.cos(math.radians(b)) for b in bearings)
-    avg = math.degrees(math.atan2(sin_sum, cos_sum)) % 360
-    return avg
-
-def smooth_headings(headings, window_size=5):
-    """
-    Smooths a list of headings (in degrees) using a circular moving average.
-    window_size should be an odd number for a symmetric window.
-    Returns a list of smoothed headings.
-    """
-    n = len(headings)
-    smoothed = []
-    for i in range(n):
-        # Define window limits
-        start = max(0, i - window_size // 2)
-        end = min(n, i + window_size // 2 + 1)
-        window = headings[start:end]
-        sin_sum = sum(math.sin(math.radians(h)) for h in window)
-        cos_sum = sum(math.cos(math.radians(h)) for h in window)
-        avg_heading = math.degrees(math.atan2(sin_sum, cos_sum)) % 360
-        smoothed.append(avg_heading)
-    return smoothed
-
 def circular_diff(a, b):
     """Return the smallest difference between two angles (in degrees)."""
     return min((a - b) % 360, (b - a) % 360)
@@ -242,11 +197,9 @@ def process_route(route, total_metadata = {}, total_tile_metadata = {}):
     if pano_id2 not in total_tile_metadata:
         total_tile_metadata[pano_id2] = metadata_tile
 
-    # Calculate heading for each position
-    for i in range(len(processed_positions) - 1):
-        pos1 = (processed_positions[i]["pano_lat"], processed_positions[i]["pano_lng"])
-        subsequent_positions = [(p["pano_lat"], p["pano_lng"]) for p in processed_positions[i+1:]]
-        computed_heading = compute_average_bearing(pos1, subsequent_positions, window_size=3)
+    # Calculate heading for each position: the circular mean of the bearings to the next 3 positions
+    computed_headings = forward_average_bearings([(p["pano_lat"], p["pano_lng"]) for p in processed_positions], window_size=3)
+    for i, computed_heading in enumerate(computed_headings.tolist()):
         processed_positions[i]["pano_heading"] = computed_heading
     processed_positions[-1]["pano_heading"] = processed_positions[-2]["pano_heading"]
 
@@ -262,7 +215,7 @@ def process_route(route, total_metadata = {}, total_tile_metadata = {}):
 
     # Smooth headings
     headings = [pos["pano_heading"] for pos in processed_positions]
-    smoothed_headings = smooth_headings(headings, window_size=3)
+    smoothed_headings = circular_moving_average(headings, window_size=3).tolist()
     for i in range(len(processed_positions)):
         processed_positions[i]["pano_heading"] = smoothed_headings[i]
 
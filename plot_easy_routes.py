@@ -2,31 +2,30 @@ import json
 from graph_loader import GraphLoader
 import gmplot
 import random
-import geopy.distance
 import os
 import pdb
 import numpy as np
+from geodesy import distance as geodesic_distance
+from geodesy import pairwise_distances
 import sys
 sys.path.append('./maps/')
 from create_html import update_html_markers, CustomGoogleMapPlotter
 
 from pdb import set_trace as dbg
 
+def lat_lngs(positions):
+    return np.reshape([(pos["latitude"], pos["longitude"]) for pos in positions], (-1, 2))
+
 def compute_min_dist(positions):
-    min_dist = float('inf')
-    for i in range(len(positions)):
-        for j in range(i+1, len(positions)):
-            dist = geopy.distance.distance((positions[i]["latitude"], positions[i]["longitude"]), 
-                                           (positions[j]["latitude"], positions[j]["longitude"])).m
-            if dist < min_dist:
-                min_dist = dist
-    return min_dist
+    if len(positions) < 2:
+        return float('inf')
+    dists = pairwise_distances(lat_lngs(positions))
+    return float(dists[np.triu_indices(len(positions), k=1)].min())
 
 def assert_min_dist(positions, min_dist):
     new_positions = [positions[0]]
     for pos in positions[1:]:
-        if all(geopy.distance.distance((pos["latitude"], pos["longitude"]), 
-                                       (pt["latitude"], pt["longitude"])).m >= min_dist for pt in new_positions):
+        if np.all(geodesic_distance((pos["latitude"], pos["longitude"]), lat_lngs(new_positions)) >= min_dist):
             new_positions.append(pos)
     return new_positions
 
@@ -157,7 +156,7 @@ class RouteProcessor:
             longitude = ground_truth_position["longitude"] + lng_variation
             latitude = ground_truth_position["latitude"] + lat_variation
 
-            if all(geopy.distance.distance((latitude, longitude), (pt["latitude"], pt["longitude"])).m >= min_distance_m for pt in positions):
+            if np.all(geodesic_distance((latitude, longitude), lat_lngs(positions)) >= min_distance_m):
                 positions.append({
                     "panoid": None,
                     "latitude": latitude,
@@ -166,11 +165,10 @@ class RouteProcessor:
                 })
         
         # Combine on-path and off-path positions with the ground truth
-        for pos in positions:
-            pos["distance_from_correct"] = geopy.distance.distance((pos["latitude"], 
-                                                       pos["longitude"]), 
-                                                      (ground_truth_position["latitude"], 
-                                                       ground_truth_position["longitude"])).m
+        distances = geodesic_distance(lat_lngs(positions),
+                                      (ground_truth_position["latitude"], ground_truth_position["longitude"]))
+        for pos, dist in zip(positions, distances.tolist()):
+            pos["distance_from_correct"] = dist
         idx_shuffle = list(range(len(positions)))
         random.shuffle(idx_shuffle)
 
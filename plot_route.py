@@ -1,9 +1,12 @@
+import argparse
 import json
 from graph_loader import GraphLoader
 import gmplot
 import random
-import geopy.distance
 import os
+import numpy as np
+from geodesy import distance as geodesic_distance
+from route_index import RouteIndex
 
 from pdb import set_trace as dbg
 
@@ -126,7 +129,8 @@ class RouteProcessor:
             longitude = ground_truth_position["longitude"] + lng_variation
             latitude = ground_truth_position["latitude"] + lat_variation
 
-            if all(geopy.distance.distance((latitude, longitude), (pt["latitude"], pt["longitude"])).m >= min_distance_m for pt in positions):
+            taken = [(pt["latitude"], pt["longitude"]) for pt in positions]
+            if np.all(geodesic_distance((latitude, longitude), np.reshape(taken, (-1, 2))) >= min_distance_m):
                 positions.append({
                     "panoid": None,
                     "latitude": latitude,
@@ -135,11 +139,10 @@ class RouteProcessor:
         
         # Combine on-path and off-path positions with the ground truth
         random.shuffle(positions)
-        for pos in positions:
-            pos["distance_from_correct"] = geopy.distance.distance((pos["latitude"], 
-                                                       pos["longitude"]), 
-                                                      (ground_truth_position["latitude"], 
-                                                       ground_truth_position["longitude"])).m
+        distances = geodesic_distance(np.reshape([(pos["latitude"], pos["longitude"]) for pos in positions], (-1, 2)),
+                                      (ground_truth_position["latitude"], ground_truth_position["longitude"]))
+        for pos, dist in zip(positions, distances.tolist()):
+            pos["distance_from_correct"] = dist
         i = random.randint(0, len(positions))
         positions.insert(i, ground_truth_position)  # Insert ground truth
         ground_truth_position["mc_index"] = i
@@ -178,16 +181,27 @@ class RouteProcessor:
         print(f"Updated routes data saved to {output_file}")
         return updated_routes
     
-    def load_positions(self, path):
+    def load_positions(self, path, route_ids=None):
+        """
+        The routes of a positions file, read lazily through a RouteIndex, or
+        only the routes in route_ids, so plotting one route reads one route.
+        """
         self.partition = path.split('.')[0].split('/')[-1].split('_')[0]
-        with open(path, 'r') as f:
-            self.positions = json.load(f)
+        self.positions = RouteIndex(path)
+        if route_ids is not None:
+            return [self.positions.get(route_id) for route_id in route_ids]
         return self.positions
 
 # Usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select the multiple choice positions of a split and plot its routes")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--route_ids", nargs="+", type=int, default=None,
+                        help="only plot these routes of the existing positions file, without selecting positions again")
+    args = parser.parse_args()
+
     # Google Maps API key
-    split = "train"
+    split = args.split
     api_key = os.getenv("MAPS_API_KEY")
     if api_key is None:
         raise ValueError("API key not found. Please set the MAPS_API_KEY environment variable.")
@@ -200,10 +214,11 @@ if __name__ == "__main__":
     
     # Process routes from JSON file
     route_processor = RouteProcessor(graph, api_key)
-    routes = route_processor.load_routes(f'data/{split}.json')
-    routes = route_processor.save_positions(routes, f'data/{split}_positions.json')
+    if args.route_ids is None:
+        routes = route_processor.load_routes(f'data/{split}.json')
+        routes = route_processor.save_positions(routes, f'data/{split}_positions.json')
 
-    routes = route_processor.load_positions(f'data/{split}_positions.json')
+    routes = route_processor.load_positions(f'data/{split}_positions.json', args.route_ids)
     
     plotted_routes = routes
     route_processor.plot_routes(plotted_routes)
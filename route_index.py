@@ -0,0 +1,157 @@
+"""
+Random access to the routes of a route file by row or route_id.
+
+The first time a file is opened its routes are located once: the byte span
+of every route (a line of a .jsonl file, an element of a .json array) and its
+route_id are saved next to it in <file>.idx. Later opens only read that small
+index, and each route is read and parsed on its own when it is accessed, so
+looking at a few routes of a large file does not parse the whole file. The
+index is rebuilt when the size or modification time of the file changes.
+
+    routes = RouteIndex('data/test_positions_easy_processed_mapped_answered_v2.json')
+    route = routes.get(route_id)      # one route, parsed on demand
+    route = routes[3]                 # by row
+    ids = routes.route_ids            # without reading any route
+
+.npz stores are random access already and are served by route_store.RouteStore.
+Compressed .jsonl.zst files cannot be read at an offset and are not supported.
+"""
+import json
+import os
+import re
+
+from route_io import ZSTD_SUFFIX
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+SEPARATORS = re.compile(r"[\s,]*")
+
+
+def _scan_json_lines(path):
+    """(route_id, start, end) byte spans of the lines of a .jsonl file."""
+    spans = []
+    with open(path, "rb") as f:
+        start = 0
+        for line in f:
+            if line.strip():
+                spans.append((json.loads(line).get("route_id"), start, start + len(line)))
+            start += len(line)
+    return spans
+
+
+def _scan_json_array(path):
+    """(route_id, start, end) byte spans of the elements of a .json array."""
+    with open(path, "rb") as f:
+        data = f.read()
+    text = data.decode("utf-8")
+    decoder = json.JSONDecoder()
+    position = SEPARATORS.match(text, 0).end()
+    if text[position:position + 1] != "[":
+        raise ValueError("Expected a JSON array of routes in {}".format(path))
+    position += 1
+    spans = []
+    while True:
+        position = SEPARATORS.match(text, position).end()
+        if position >= len(text):
+            raise ValueError("Unterminated JSON array of routes in {}".format(path))
+        if text[position] == "]":
+            break
+        route, end = decoder.raw_decode(text, position)
+        spans.append((route.get("route_id"), position, end))
+        position = end
+    if len(text) != len(data):
+        # non ASCII text: character offsets are converted to byte offsets
+        byte_offsets = {}
+        previous_char, previous_byte = 0, 0
+        for offset in sorted({offset for _, start, end in spans for offset in (start, end)}):
+            previous_byte += len(text[previous_char:offset].encode("utf-8"))
+            previous_char = offset
+            byte_offsets[offset] = previous_byte
+        spans = [(route_id, byte_offsets[start], byte_offsets[end]) for route_id, start, end in spans]
+    return spans
+
+
+class RouteIndex:
+    """Lazy, list-like access to the routes of a .json or .jsonl route file."""
+    def __init__(self, path, index_path=None):
+        if path.endswith(ZSTD_SUFFIX):
+            raise ValueError("Compressed route files cannot be indexed, convert {} to .jsonl first".format(path))
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        stat = os.stat(path)
+        self.signature = [stat.st_size, stat.st_mtime_ns]
+        index = self._load_index()
+        if index is None:
+            index = self.build()
+        self.route_ids = index["route_ids"]
+        self.starts = index["starts"]
+        self.ends = index["ends"]
+        self._rows = None
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except ValueError:
+            return None
+        if index.get("version") != INDEX_VERSION or index.get("signature") != self.signature:
+            return None
+        return index
+
+    def build(self):
+        """Locate every route of the file and save the index, returns it."""
+        scan = _scan_json_lines if self.path.endswith(".jsonl") else _scan_json_array
+        spans = scan(self.path)
+        index = {
+            "version": INDEX_VERSION,
+            "signature": self.signature,
+            "route_ids": [route_id for route_id, _, _ in spans],
+            "starts": [start for _, start, _ in spans],
+            "ends": [end for _, _, end in spans],
+        }
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # a read only data directory still works, the index is just not kept
+            pass
+        return index
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        with open(self.path, "rb") as f:
+            f.seek(self.starts[row])
+            return json.loads(f.read(self.ends[row] - self.starts[row]))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def row_of(self, route_id):
+        """Row of a route_id, the first one if it appears more than once."""
+        if self._rows is None:
+            self._rows = {}
+            for row, key in enumerate(self.route_ids):
+                self._rows.setdefault(key, row)
+        return self._rows[route_id]
+
+    def get(self, route_id):
+        """The route with this route_id."""
+        return self[self.row_of(route_id)]
+
+    def __contains__(self, route_id):
+        try:
+            self.row_of(route_id)
+        except KeyError:
+            return False
+        return True
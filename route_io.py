@@ -0,0 +1,195 @@
+"""
+Streaming reading and writing of route files.
+
+Route files are lists of route dicts. Four formats are supported, chosen by
+the file name:
+
+- `.jsonl`: JSON Lines, one route per line.
+- `.jsonl.zst`: JSON Lines compressed with zstandard (`pip install zstandard`).
+- `.json`: a JSON array, as written by the original stages. It is read
+  incrementally, one route at a time, and written with one compact route per
+  line, so `json.load` still reads it.
+- `.npz`: the columnar store of route_store, read only here (write it with
+  route_store.write_store).
+
+`iter_routes` yields one route at a time and `RouteWriter` writes one route
+at a time, so a stage that streams from one to the other holds a single route
+(or batch of routes) in memory instead of the whole split. Writes go to a
+temporary file that replaces the output when it is closed, so a stage can
+write back to the file it reads.
+
+Convert existing files with `python route_io.py input.json output.jsonl.zst`.
+"""
+import argparse
+import io
+import json
+import os
+from itertools import islice
+
+ZSTD_SUFFIX = ".zst"
+READ_SIZE = 1 << 16
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing .zst route files needs the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def open_text(path, mode="r", level=10):
+    """Open a text file for reading ('r') or writing ('w'), compressed with zstandard if it ends with .zst."""
+    if not path.endswith(ZSTD_SUFFIX):
+        return open(path, mode, encoding="utf-8")
+    zstandard = _zstandard()
+    if mode == "r":
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    else:
+        stream = zstandard.ZstdCompressor(level=level).stream_writer(open(path, "wb"), closefd=True)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def is_json_lines(path):
+    return path.endswith(".jsonl") or path.endswith(".jsonl" + ZSTD_SUFFIX)
+
+
+def _iter_json_array(f):
+    """Yield the elements of the JSON array in text file f, reading it in blocks."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_SIZE).lstrip()
+    if not buffer.startswith("["):
+        raise ValueError("Expected a JSON array of routes")
+    buffer = buffer[1:]
+    position = 0
+    while True:
+        # skip whitespace and the separating comma, reading more when the buffer runs out
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer):
+                break
+            buffer, position = f.read(READ_SIZE), 0
+            if not buffer:
+                raise ValueError("Unterminated JSON array of routes")
+        if buffer[position] == "]":
+            return
+        while True:
+            try:
+                route, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                # the element continues past the buffer
+                more = f.read(READ_SIZE)
+                if not more:
+                    raise
+                buffer, position = buffer[position:] + more, 0
+        yield route
+        position = end
+
+
+def iter_routes(path):
+    """Yield the routes of a .json, .jsonl, .jsonl.zst or .npz file one by one."""
+    if path.endswith(".npz"):
+        from route_store import RouteStore
+        yield from RouteStore(path).routes()
+        return
+    with open_text(path) as f:
+        if is_json_lines(path):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f)
+
+
+def read_routes(path):
+    """All the routes of a file, as a list."""
+    return list(iter_routes(path))
+
+
+def iter_batches(routes, batch_size):
+    """Group an iterable of routes into lists of at most batch_size routes."""
+    routes = iter(routes)
+    while True:
+        batch = list(islice(routes, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class RouteWriter:
+    """
+    Writes routes one by one to a .json, .jsonl or .jsonl.zst file.
+    The file only replaces `path` when the writer is closed without an error.
+    """
+    def __init__(self, path, level=10):
+        if path.endswith(".npz"):
+            raise ValueError("Columnar .npz route files are written with route_store.write_store, not streamed")
+        self.path = path
+        self.tmp_path = "{}.{}.tmp{}".format(path, os.getpid(), ZSTD_SUFFIX if path.endswith(ZSTD_SUFFIX) else "")
+        self.json_lines = is_json_lines(path)
+        self.file = open_text(self.tmp_path, "w", level)
+        self.count = 0
+        if not self.json_lines:
+            self.file.write("[")
+
+    def write(self, route):
+        line = json.dumps(route, separators=(",", ":"))
+        if self.json_lines:
+            self.file.write(line + "\n")
+        else:
+            self.file.write(("," if self.count else "") + "\n" + line)
+        self.count += 1
+
+    def write_all(self, routes):
+        for route in routes:
+            self.write(route)
+
+    def close(self):
+        if self.file is None:
+            return
+        if not self.json_lines:
+            self.file.write("\n]\n")
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """Close and delete the temporary file, leaving `path` untouched."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_routes(path, routes):
+    """Write an iterable of routes to path, returns the number of routes written."""
+    with RouteWriter(path) as writer:
+        writer.write_all(routes)
+    return writer.count
+
+
+def convert(input_path, output_path):
+    """Convert a route file between formats, one route at a time."""
+    count = write_routes(output_path, iter_routes(input_path))
+    print("Converted {} routes: {} ({} bytes) -> {} ({} bytes)".format(
+        count, input_path, os.path.getsize(input_path), output_path, os.path.getsize(output_path)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert route files between .json, .jsonl and .jsonl.zst")
+    parser.add_argument("input", help="route file to read")
+    parser.add_argument("output", help="route file to write, the format follows the extension")
+    args = parser.parse_args()
+    convert(args.input, args.output)
@@ -0,0 +1,126 @@
+"""
+Map a function over routes in a process pool.
+
+Routes are independent, so the metadata stages hand their per-route work to
+`pool_map`, which:
+
+- sends the routes to the workers in chunks and returns the results in the
+  input order,
+- catches the exception of a failing route and reports it instead of
+  stopping the whole stage,
+- seeds `random` and `np.random` before every route from a crc32 of the
+  route id, so the result of a route does not depend on the number of
+  processes, the chunking or the order in which the routes run.
+
+The function must be defined at module level so it can be pickled.
+`pool_imap` streams an iterable of routes, `pool_map` maps a list.
+"""
+import os
+import random
+import traceback
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from route_io import iter_batches
+
+
+class RouteError:
+    """
+    A route whose function raised: its position in the input, its id, the
+    traceback and the route itself, as the function left it.
+    """
+    def __init__(self, index, route_id, error, route=None):
+        self.index = index
+        self.route_id = route_id
+        self.error = error
+        self.route = route
+
+    def __repr__(self):
+        return "RouteError(index={}, route_id={!r})".format(self.index, self.route_id)
+
+
+def route_id_of(route):
+    """The route_id of a route dict, or of the first element of a (route, ...) tuple."""
+    if isinstance(route, tuple):
+        route = route[0]
+    return route.get("route_id") if isinstance(route, dict) else None
+
+
+def route_seed(route_id, seed=0):
+    """Deterministic 32 bit seed of a route, independent of PYTHONHASHSEED."""
+    return zlib.crc32("{}:{}".format(seed, route_id).encode("utf-8"))
+
+
+def _run(task):
+    fn, index, route_id, seed, route = task
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    try:
+        return index, fn(route), None
+    except Exception:
+        return index, None, RouteError(index, route_id, traceback.format_exc(), route)
+
+
+def pool_imap(fn, routes, processes=None, chunksize=None, seed=0, route_id=route_id_of, batch_size=1024):
+    """
+    Apply fn to every route of the iterable `routes` with `processes` workers
+    (default: all cores; 1 runs in this process), yielding (result, error)
+    pairs in the input order. error is None, or a RouteError and result None.
+
+    Routes are read from the iterable batch_size at a time, so only about
+    one batch is in memory however long the input is. Routes without an id
+    are seeded by their index; seed=None leaves the random generators alone.
+    """
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        # a few chunks per worker balances uneven routes without much IPC overhead
+        chunksize = max(1, batch_size // (processes * 4))
+
+    def tasks():
+        for index, route in enumerate(routes):
+            key = route_id(route)
+            key = index if key is None else key
+            yield fn, index, key, None if seed is None else route_seed(key, seed), route
+
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        # Pool.imap reads its whole input ahead, so it is fed one batch at a time
+        for batch in iter_batches(tasks(), batch_size):
+            outputs = pool.imap(_run, batch, chunksize=chunksize) if pool else map(_run, batch)
+            for index, result, error in outputs:
+                yield result, error
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def pool_map(fn, routes, processes=None, chunksize=None, seed=0, route_id=route_id_of):
+    """
+    pool_map(fn, routes) is pool_imap for a list of routes, with the workers
+    capped at the number of routes. Returns (results, errors): results[i] is
+    fn(routes[i]), or None if it raised, and errors lists a RouteError for
+    every failed route.
+    """
+    routes = list(routes)
+    processes = min(processes or os.cpu_count() or 1, max(len(routes), 1))
+    if chunksize is None:
+        chunksize = max(1, len(routes) // (processes * 4))
+    results = []
+    errors = []
+    for result, error in pool_imap(fn, routes, processes, chunksize, seed, route_id, batch_size=max(len(routes), 1)):
+        results.append(result)
+        if error is not None:
+            errors.append(error)
+    return results, errors
+
+
+def report_errors(errors, stage=""):
+    """Print the failed routes of a stage with their tracebacks."""
+    for error in errors:
+        print("{}route {} (index {}) failed:\n{}".format(stage + ": " if stage else "", error.route_id, error.index, error.error))
+    if errors:
+        print("{}{} routes failed".format(stage + ": " if stage else "", len(errors)))
@@ -0,0 +1,277 @@
+"""
+Columnar storage of route files in a single .npz.
+
+In the JSON route files every step of a route's `path` is a dict that repeats
+the same keys. Here each path field is one flat typed array over all the
+steps of all the routes, and `offsets` gives the steps of each route:
+route i owns rows offsets[i]:offsets[i + 1] of every column. Whole-split work
+is then plain numpy over the flat columns, and a single route is a set of
+views into them.
+
+Layout of the .npz:
+
+- `offsets`: int64, number of routes + 1.
+- `route_id`: int64, or unicode if the ids are not all integers.
+- `path.<field>`: float64, int64 or bool column of a numeric path field;
+  None and missing values of float fields are NaN.
+- `path.<field>.data` and `path.<field>.offsets`: utf-8 bytes and int64
+  offsets of a text field (or of the JSON of a field holding lists or dicts).
+- `path.<field>.state`: uint8, only stored if some steps have None (1),
+  lack the field (2) or hold an int in a float field (3), so routes are
+  rebuilt exactly, with 1 and not 1.0 where the source had an int.
+- `routes`: utf-8 JSON of the route dicts without their paths.
+- `schema`: utf-8 JSON of the path fields and their kinds.
+
+Convert with `python route_store.py input.json output.npz`. route_io reads
+.npz files too, so the stages can take them as input.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 2
+# version 1 stores have no INTEGER states and read the same way
+READ_VERSIONS = (1, 2)
+PRESENT, NONE, MISSING, INTEGER = 0, 1, 2, 3
+# ints above this are not exact as float64, a float field holding one is kept as JSON
+MAX_EXACT_INT = 2 ** 53
+# longer text columns are loaded as object arrays
+MAX_UNICODE_LENGTH = 64
+
+
+def _kind(values):
+    """Storage kind of a path field from its non-None values."""
+    types = {type(value) for value in values}
+    if not types:
+        return 'float'
+    if types == {bool}:
+        return 'bool'
+    if types == {int}:
+        return 'int'
+    if types <= {int, float}:
+        if int in types and any(type(value) is int and abs(value) > MAX_EXACT_INT for value in values):
+            return 'json'
+        return 'float'
+    if types == {str}:
+        return 'str'
+    return 'json'
+
+
+def _encode_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(data, offsets):
+    blob = data.tobytes()
+    return [blob[start:end].decode('utf-8') for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def _encode_json(obj):
+    return np.frombuffer(json.dumps(obj, separators=(',', ':')).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode_json(array):
+    return json.loads(array.tobytes().decode('utf-8'))
+
+
+def write_store(path, routes, compress=True):
+    """Write an iterable of route dicts to a columnar .npz, returns the number of routes."""
+    routes = list(routes)
+    steps = [step for route in routes for step in route.get('path') or []]
+    fields = list(dict.fromkeys(key for step in steps for key in step))
+    lengths = [len(route.get('path') or []) for route in routes]
+    arrays = {'offsets': np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])}
+
+    route_ids = [route.get('route_id') for route in routes]
+    if all(type(route_id) is int for route_id in route_ids):
+        arrays['route_id'] = np.array(route_ids, dtype=np.int64)
+    else:
+        arrays['route_id'] = np.array([str(route_id) for route_id in route_ids])
+
+    schema = {'version': FORMAT_VERSION, 'fields': {}}
+    for field in fields:
+        values = [step.get(field) for step in steps]
+        kind = _kind([value for value in values if value is not None])
+        state = np.array([MISSING if field not in step else NONE if step[field] is None
+                          else INTEGER if kind == 'float' and type(step[field]) is int else PRESENT
+                          for step in steps], dtype=np.uint8)
+        if kind in ('int', 'bool') and state.any():
+            # integers have no NaN, a column with gaps is kept as JSON text
+            kind = 'json'
+        schema['fields'][field] = kind
+        name = 'path.' + field
+        if kind == 'float':
+            arrays[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        elif kind in ('int', 'bool'):
+            arrays[name] = np.array(values, dtype=np.int64 if kind == 'int' else bool)
+        else:
+            strings = ['' if value is None else value if kind == 'str' else json.dumps(value, separators=(',', ':')) for value in values]
+            arrays[name + '.data'], arrays[name + '.offsets'] = _encode_strings(strings)
+        if state.any():
+            arrays[name + '.state'] = state
+
+    # route level fields keep their order, with the path as a placeholder
+    arrays['routes'] = _encode_json([{key: (None if key == 'path' else value) for key, value in route.items()} for route in routes])
+    arrays['schema'] = _encode_json(schema)
+    save = np.savez_compressed if compress else np.savez
+    tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+    save(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return len(routes)
+
+
+class RouteStore:
+    """
+    Read access to a columnar route file. Columns are loaded on first use and
+    kept, so opening a store and reading a few columns is cheap.
+
+        store = RouteStore('data/train_positions_processed_mapped_v2.npz')
+        lat, lng = store['pano_lat'], store['pano_lng']      # all steps of the split
+        path = store.path(3)                                  # numpy views of route 3
+        route = store.route(store.index_of(route_id))         # the original dict
+    """
+    def __init__(self, path):
+        self.file = np.load(path, allow_pickle=False)
+        self.schema = _decode_json(self.file['schema'])
+        if self.schema['version'] not in READ_VERSIONS:
+            raise ValueError('Unsupported route store version {} in {}'.format(self.schema['version'], path))
+        self.fields = list(self.schema['fields'])
+        self.offsets = self.file['offsets']
+        self.route_ids = self.file['route_id']
+        self._columns = {}
+        self._states = {}
+        self._meta = None
+        self._ids = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_steps(self):
+        return int(self.offsets[-1])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def route_index(self):
+        """Route of every step, to group the flat columns by route (np.bincount, np.add.reduceat, ...)."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    @property
+    def segment_mask(self):
+        """
+        Mask of the num_steps - 1 pairs of consecutive rows that are a step and
+        the next step of the same route, e.g. to keep the segments of all routes
+        from geodesy.path_distances over the flat columns.
+        """
+        mask = np.ones(max(self.num_steps - 1, 0), dtype=bool)
+        # the pair from the last step of a route to the first step of the next one,
+        # routes that start at 0 or past the last step (empty paths) have none
+        starts = self.offsets[1:-1]
+        mask[starts[(starts > 0) & (starts < self.num_steps)] - 1] = False
+        return mask
+
+    def column(self, field):
+        """
+        The flat column of a path field over all steps. Short text fields (ids)
+        are numpy unicode arrays, long ones (OCR text) object arrays, since a
+        unicode array takes the width of its longest string.
+        """
+        if field not in self._columns:
+            kind = self.schema['fields'][field]
+            name = 'path.' + field
+            if kind in ('str', 'json'):
+                strings = _decode_strings(self.file[name + '.data'], self.file[name + '.offsets'])
+                max_length = max(map(len, strings), default=0)
+                self._columns[field] = np.array(strings, dtype=str if max_length <= MAX_UNICODE_LENGTH else object)
+            else:
+                self._columns[field] = self.file[name]
+        return self._columns[field]
+
+    __getitem__ = column
+
+    def state(self, field):
+        """Per step PRESENT, NONE, MISSING or INTEGER (an int stored in a float column) of a field."""
+        if field not in self._states:
+            name = 'path.{}.state'.format(field)
+            self._states[field] = self.file[name] if name in self.file.files else np.zeros(self.num_steps, dtype=np.uint8)
+        return self._states[field]
+
+    def path(self, i, fields=None):
+        """Views of the columns of route i, as {field: array}."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {field: self.column(field)[start:end] for field in (fields or self.fields)}
+
+    def index_of(self, route_id):
+        """Row of a route_id."""
+        if self._ids is None:
+            self._ids = {route_id: i for i, route_id in enumerate(self.route_ids.tolist())}
+        return self._ids[route_id]
+
+    def route(self, i):
+        """Route i as the dict it was written from."""
+        if self._meta is None:
+            self._meta = _decode_json(self.file['routes'])
+        route = dict(self._meta[i])
+        if 'path' in route:
+            route['path'] = self._steps(i)
+        return route
+
+    def routes(self):
+        for i in range(len(self)):
+            yield self.route(i)
+
+    def _steps(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        steps = [{} for _ in range(end - start)]
+        for field, kind in self.schema['fields'].items():
+            values = self.column(field)[start:end].tolist()
+            state = self.state(field)[start:end].tolist()
+            for step, value, value_state in zip(steps, values, state):
+                if value_state == PRESENT:
+                    step[field] = json.loads(value) if kind == 'json' else value
+                elif value_state == INTEGER:
+                    step[field] = int(value)
+                elif value_state == NONE:
+                    step[field] = None
+        return steps
+
+
+def convert(input_path, output_path, compress=True):
+    """Convert a route file readable by route_io to a columnar store and report sizes and load times."""
+    from route_io import read_routes
+
+    routes = read_routes(input_path)
+    write_store(output_path, routes, compress)
+
+    start = time.perf_counter()
+    read_routes(input_path)
+    json_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    store = RouteStore(output_path)
+    for field in store.fields:
+        store.column(field)
+    store_seconds = time.perf_counter() - start
+    assert [store.route(i) for i in range(len(store))] == routes
+    print('{} routes, {} steps'.format(len(store), store.num_steps))
+    print('| file | bytes | load ms |')
+    print('|------|------:|--------:|')
+    print('| {} | {} | {:.1f} |'.format(input_path, os.path.getsize(input_path), json_seconds * 1000))
+    print('| {} | {} | {:.1f} |'.format(output_path, os.path.getsize(output_path), store_seconds * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a route file to a columnar .npz store")
+    parser.add_argument("input", help="route file (.json, .jsonl or .jsonl.zst)")
+    parser.add_argument("output", help=".npz file to write")
+    parser.add_argument("--no_compress", action="store_true", help="write an uncompressed .npz, larger but faster to load")
+    args = parser.parse_args()
+    convert(args.input, args.output, not args.no_compress)
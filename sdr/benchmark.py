@@ -0,0 +1,221 @@
+import torch
+import numpy as np
+
+import argparse
+import time
+
+import model as sdr_model
+from model import ConcatConv
+from model import RNN2Conv
+from model import LingUNet
+
+
+parser = argparse.ArgumentParser(description='SDR microbenchmarks')
+parser.add_argument('bench', type=str, choices=['rnn2conv', 'lingunet_checkpoint', 'equivalence'],
+                    help='benchmark to run, or equivalence to check the fast paths against their references')
+parser.add_argument('--batch_sizes', type=str, default='1,4,10,16',
+                    help='comma separated batch sizes')
+parser.add_argument('--num_layers', type=str, default='1,2',
+                    help='comma separated numbers of rnn2conv or lingunet layers')
+parser.add_argument('--height', type=int, default=100,
+                    help='height of the image features')
+parser.add_argument('--width', type=int, default=464,
+                    help='width of the image features')
+parser.add_argument('--repeats', type=int, default=5,
+                    help='timed iterations per configuration')
+parser.add_argument('--seed', type=int, default=42,
+                    help='random seed')
+
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def random_batch(batch_size, height, width, vocab_size=100, max_length=20, image_channels=128):
+    images = torch.randn(batch_size, image_channels, height, width, device=device)
+    seq_lengths = torch.randint(1, max_length + 1, (batch_size,))
+    texts = torch.randint(2, vocab_size, (batch_size, int(seq_lengths.max())), device=device)
+    return images, texts, seq_lengths
+
+
+def time_forward(model, inputs, repeats):
+    '''Median wall time of `repeats` forward passes, in milliseconds.'''
+    timings = []
+    with torch.no_grad():
+        model(*inputs)  # warm up
+        for _ in range(repeats):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            out = model(*inputs)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings.append((time.perf_counter() - start) * 1000)
+    return np.median(timings), out
+
+
+def bench_rnn2conv(args):
+    rnn_args = {
+        'input_size': 100,
+        'embed_size': 300,
+        'rnn_hidden_size': 300,
+        'num_rnn_layers': 1,
+        'embed_dropout': 0.0,
+        'bidirectional': False,
+        'reduce': 'last'
+    }
+    cnn_args = {'kernel_size': 5, 'padding': 2, 'conv_dropout': 0.0}
+    out_layer_args = {'linear_hidden_size': 128, 'num_hidden_layers': 1}
+
+    print('| layers | batch | loop (ms) | grouped (ms) | speedup | max abs diff |')
+    print('|-------:|------:|----------:|-------------:|--------:|-------------:|')
+    for num_layers in [int(n) for n in args.num_layers.split(',')]:
+        model = RNN2Conv(dict(rnn_args, num_rnn_layers=num_layers), cnn_args, out_layer_args, num_layers)
+        model = model.to(device).eval()
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            inputs = random_batch(batch_size, args.height, args.width)
+
+            model.batched_conv = False
+            loop_ms, loop_out = time_forward(model, inputs, args.repeats)
+            model.batched_conv = True
+            grouped_ms, grouped_out = time_forward(model, inputs, args.repeats)
+
+            max_diff = (loop_out - grouped_out).abs().max().item()
+            print('| {:6d} | {:5d} | {:9.2f} | {:12.2f} | {:6.2f}x | {:12.2e} |'.format(
+                num_layers, batch_size, loop_ms, grouped_ms, loop_ms / grouped_ms, max_diff))
+
+
+def check_dynamic_conv2d():
+    '''dynamic_conv2d matches looped_dynamic_conv2d over a few batch, channel and kernel shapes.'''
+    for batch_size, in_channels, out_channels, kernel_size, padding in [
+            (1, 3, 2, 1, 0), (4, 8, 4, 3, 1), (10, 16, 8, 5, 2), (3, 5, 7, 3, 0)]:
+        images = torch.randn(batch_size, in_channels, 12, 17, device=device, dtype=torch.float64)
+        filters = torch.randn(batch_size, out_channels, in_channels, kernel_size, kernel_size,
+                              device=device, dtype=torch.float64)
+        torch.testing.assert_close(
+            sdr_model.dynamic_conv2d(images, filters, padding),
+            sdr_model.looped_dynamic_conv2d(images, filters, padding))
+    print('dynamic_conv2d matches looped_dynamic_conv2d')
+
+
+def check_concat_conv():
+    '''ConcatConv scores the same with and without broadcast_free, through one or two conv layers.'''
+    rnn_args = {
+        'input_size': 100,
+        'embed_size': 16,
+        'rnn_hidden_size': 6,
+        'num_rnn_layers': 1,
+        'embed_dropout': 0.0,
+        'bidirectional': True,
+        'reduce': 'last'
+    }
+    out_layer_args = {'linear_hidden_size': 10, 'num_hidden_layers': 1}
+    for num_conv_layers, kernel_size, padding in [(1, 5, 2), (2, 3, 1), (2, 3, 0)]:
+        cnn_args = {'kernel_size': kernel_size, 'padding': padding, 'num_conv_layers': num_conv_layers}
+        model = ConcatConv(rnn_args, cnn_args, out_layer_args, image_channels=8)
+        model = model.to(device).double().eval()
+        images, texts, seq_lengths = random_batch(3, 9, 14, image_channels=8)
+        with torch.no_grad():
+            model.broadcast_free = True
+            split_out = model(images.double(), texts, seq_lengths)
+            model.broadcast_free = False
+            concat_out = model(images.double(), texts, seq_lengths)
+        torch.testing.assert_close(split_out, concat_out)
+    print('ConcatConv matches with and without broadcast_free')
+
+
+def check_equivalence(args):
+    '''Fails with an AssertionError if a fast path drifts from its reference.'''
+    check_dynamic_conv2d()
+    check_concat_conv()
+
+
+def saved_activation_bytes(model, inputs):
+    '''Bytes of distinct non-parameter tensors kept alive for backward after one forward pass.
+
+    Counts tensors saved by autograd plus the inputs held by checkpointed stages,
+    which are not saved through autograd hooks.
+    '''
+    param_storages = set(p.untyped_storage().data_ptr() for p in model.parameters())
+    storages = {}
+
+    def record(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in param_storages:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    original_checkpoint = sdr_model.checkpoint
+
+    def recording_checkpoint(function, *args, **kwargs):
+        for arg in args:
+            if torch.is_tensor(arg):
+                record(arg)
+        return original_checkpoint(function, *args, **kwargs)
+
+    sdr_model.checkpoint = recording_checkpoint
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(record, lambda tensor: tensor):
+            out = model(*inputs)
+    finally:
+        sdr_model.checkpoint = original_checkpoint
+    del out
+    return sum(storages.values())
+
+
+def time_train_step(model, inputs, repeats):
+    '''Median wall time of forward plus backward in milliseconds, and the peak CUDA memory in bytes.'''
+    timings = []
+    model(*inputs).sum().backward()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    for _ in range(repeats):
+        model.zero_grad()
+        start = time.perf_counter()
+        model(*inputs).sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings.append((time.perf_counter() - start) * 1000)
+    peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else float('nan')
+    return np.median(timings), peak
+
+
+def bench_lingunet_checkpoint(args):
+    rnn_args = {
+        'input_size': 100,
+        'embed_size': 300,
+        'rnn_hidden_size': 300,
+        'num_rnn_layers': 1,
+        'embed_dropout': 0.0,
+        'bidirectional': True,
+        'reduce': 'mean'
+    }
+    cnn_args = {'kernel_size': 5, 'padding': 2, 'deconv_dropout': 0.0}
+    out_layer_args = {'linear_hidden_size': 128, 'num_hidden_layers': 1}
+
+    print('| layers | batch | checkpoint | saved activations (MB) | peak cuda (MB) | fwd+bwd (ms) |')
+    print('|-------:|------:|:----------:|-----------------------:|---------------:|-------------:|')
+    for num_layers in [int(n) for n in args.num_layers.split(',')]:
+        model = LingUNet(rnn_args, cnn_args, out_layer_args, m=num_layers).to(device).train()
+        for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+            inputs = random_batch(batch_size, args.height, args.width)
+            for checkpoint_activations in [False, True]:
+                model.checkpoint_activations = checkpoint_activations
+                saved = saved_activation_bytes(model, inputs)
+                step_ms, peak = time_train_step(model, inputs, args.repeats)
+                print('| {:6d} | {:5d} | {:^10} | {:22.1f} | {:14.1f} | {:12.2f} |'.format(
+                    num_layers, batch_size, 'yes' if checkpoint_activations else 'no',
+                    saved / 2 ** 20, peak / 2 ** 20, step_ms))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    print('Device:', device)
+
+    if args.bench == 'rnn2conv':
+        bench_rnn2conv(args)
+    elif args.bench == 'lingunet_checkpoint':
+        bench_lingunet_checkpoint(args)
+    elif args.bench == 'equivalence':
+        check_equivalence(args)
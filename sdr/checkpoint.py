@@ -0,0 +1,94 @@
+import torch
+
+import os
+import queue
+import threading
+
+
+def copy_to_host(obj, buffers, path=()):
+    '''Copy every tensor of a nested state (dicts, lists, tuples) into reusable CPU buffers.
+
+    Buffers are allocated in pinned memory when CUDA is available, so device
+    tensors are copied asynchronously; synchronize before reading them.
+    '''
+    if torch.is_tensor(obj):
+        buffer = buffers.get(path)
+        if buffer is None or buffer.size() != obj.size() or buffer.dtype != obj.dtype:
+            buffer = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=torch.cuda.is_available())
+            buffers[path] = buffer
+        buffer.copy_(obj.detach(), non_blocking=True)
+        return buffer
+    elif isinstance(obj, dict):
+        return {k: copy_to_host(v, buffers, path + (k,)) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_host(v, buffers, path + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+class AsyncCheckpointer:
+    '''Snapshot model and optimizer states to CPU memory and write them to disk in a background thread.
+
+    Each tag (e.g. 'best', 'last') owns one set of host buffers that is reused
+    by every snapshot with that tag, so taking a snapshot costs a device to
+    host copy and no device memory.
+    '''
+    def __init__(self):
+        self.buffers = {}
+        self.requests = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self._write, daemon=True)
+        self.worker.start()
+
+    def snapshot(self, tag, model, optimizer=None):
+        '''Copy the states to the host buffers of `tag` and return them as {'state_dict', 'optimizer'}.'''
+        # a pending write may still read the buffers that are about to be overwritten
+        self.wait()
+        buffers = self.buffers.setdefault(tag, {})
+        snapshot = {'state_dict': copy_to_host(model.state_dict(), buffers, ('state_dict',))}
+        if optimizer is not None:
+            snapshot['optimizer'] = copy_to_host(optimizer.state_dict(), buffers, ('optimizer',))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return snapshot
+
+    def save(self, state, path):
+        '''Queue `state` to be written to `path`, returns immediately.'''
+        self._raise_error()
+        self.requests.put((state, path))
+
+    def wait(self):
+        '''Block until every queued state has been written.'''
+        self.requests.join()
+        self._raise_error()
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.requests.task_done()
+                return
+            state, path = request
+            try:
+                # write to a temporary file first so a crash never leaves a truncated checkpoint
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.error = e
+            self.requests.task_done()
@@ -0,0 +1,318 @@
+import torch
+import numpy as np
+
+import argparse
+import json
+import queue
+import threading
+import time
+import warnings
+from concurrent.futures import Future
+
+from loader import Loader
+from model import build_model
+from model import quantize_dynamic_int8
+
+
+parser = argparse.ArgumentParser(description='SDR inference')
+parser.add_argument('checkpoint', type=str,
+                    help='checkpoint saved by train.py, or a TorchScript file written by --export')
+parser.add_argument('--torchscript', action='store_true',
+                    help='the checkpoint is a TorchScript export')
+parser.add_argument('--quantized', action='store_true',
+                    help='the checkpoint is an int8 model written by quantize.py (CPU only, trusted files only)')
+parser.add_argument('--device', type=str, default='cpu',
+                    help='device to run on')
+parser.add_argument('--num_threads', type=int, default=None,
+                    help='number of intra-op CPU threads')
+parser.add_argument('--data_dir', type=str, default=None,
+                    help='folder with train.json and dev.json, used to rebuild the vocabulary of old checkpoints '
+                         'and as the source of benchmark texts')
+parser.add_argument('--image_dir', type=str, default=None,
+                    help='path to `image_features`, used by --panoid')
+
+# single prediction
+parser.add_argument('--panoid', type=str, default=None,
+                    help='predict the location of Touchdown in this panorama')
+parser.add_argument('--text', type=str, default=None,
+                    help='td_location_text used with --panoid')
+
+# export
+parser.add_argument('--export', type=str, default=None,
+                    help='write a TorchScript version of the model to this path')
+
+# serving benchmark
+parser.add_argument('--benchmark', action='store_true',
+                    help='report latency and throughput of dynamically batched requests')
+parser.add_argument('--num_requests', type=int, default=200,
+                    help='number of benchmark requests')
+parser.add_argument('--concurrency', type=int, default=8,
+                    help='number of client threads sending requests')
+parser.add_argument('--max_batch_size', type=int, default=16,
+                    help='largest batch the server runs at once')
+parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                    help='how long the server waits to fill a batch')
+parser.add_argument('--height', type=int, default=100,
+                    help='height of the image features')
+parser.add_argument('--width', type=int, default=464,
+                    help='width of the image features')
+parser.add_argument('--image_channels', type=int, default=128,
+                    help='channels of the image features')
+
+
+def checkpoint_num_layers(saved_args):
+    '''Architecture specific layer count stored in the training arguments.'''
+    if saved_args['model'] == 'rnn2conv':
+        return saved_args['num_rnn2conv_layers']
+    elif saved_args['model'] == 'lingunet':
+        return saved_args['num_lingunet_layers']
+    return None
+
+
+def rebuild_vocab(data_dir):
+    '''Rebuild the training vocabulary for checkpoints saved without one.'''
+    loader = Loader(data_dir=data_dir, image_dir=None, target_dir=None)
+    for mode in ['train', 'dev']:
+        texts = loader.load_texts(loader.load_json('{}.json'.format(mode)))
+        loader.build_vocab(texts, mode)
+    return loader.vocab.word2idx
+
+
+def load_checkpoint(path, device=torch.device('cpu'), data_dir=None, quantized=False):
+    '''Rebuild a model from a state written by `convert_model_to_state`.
+
+    Quantized checkpoints written by quantize.py hold packed int8 parameters,
+    which can only be unpickled with `quantized=True` (weights_only=False), so
+    only load those from trusted sources.
+    Returns the model in eval mode, the word2idx vocabulary and the saved state.
+    '''
+    state = torch.load(path, map_location='cpu', weights_only=not quantized)
+    model = build_model(
+        state['args']['model'],
+        state['rnn_args'],
+        state['cnn_args'],
+        state['out_layer_args'],
+        checkpoint_num_layers(state['args'])
+    )
+    if state.get('quantization') == 'dynamic_int8':
+        model = quantize_dynamic_int8(model.eval())
+    model.load_state_dict(state['state_dict'])
+    model = model.to(device).eval()
+
+    word2idx = state.get('vocab')
+    if word2idx is None:
+        if data_dir is None:
+            raise ValueError('Checkpoint has no vocabulary, please pass data_dir to rebuild it.')
+        word2idx = rebuild_vocab(data_dir)
+    return model, word2idx, state
+
+
+def build_eval_dataset(data_dir, image_dir, target_dir, eval_file, word2idx, gaussian_target=True, sample_used=1.0):
+    '''Dataset of `eval_file` encoded with the vocabulary of a checkpoint.'''
+    loader = Loader(data_dir=data_dir, image_dir=image_dir, target_dir=target_dir)
+    # reuse the training vocabulary so the word ids match the embedding
+    loader.vocab.word2idx = dict(word2idx)
+    loader.vocab.idx2word = {idx: word for word, idx in word2idx.items()}
+    loader.build_dataset(file=eval_file, gaussian_target=gaussian_target, sample_used=sample_used)
+    mode = eval_file.split('.')[0]
+    return loader.datasets[mode]
+
+
+class SDRPredictor:
+    '''Predict the most likely Touchdown location of panoramas given `td_location_text`.'''
+    def __init__(self, model, word2idx, device=torch.device('cpu')):
+        self.model = model
+        self.word2idx = word2idx
+        self.device = device
+
+    @classmethod
+    def from_checkpoint(cls, path, device=torch.device('cpu'), data_dir=None, quantized=False):
+        model, word2idx, _ = load_checkpoint(path, device, data_dir, quantized)
+        return cls(model, word2idx, device)
+
+    @classmethod
+    def from_torchscript(cls, path, device=torch.device('cpu')):
+        extra_files = {'vocab.json': ''}
+        model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        return cls(model.eval(), json.loads(extra_files['vocab.json']), device)
+
+    def encode_texts(self, texts):
+        '''Tokenize like `Loader.build_vocab` in test mode, unknown words map to <unk>.'''
+        ids = []
+        for text in texts:
+            words = text.lower().split()
+            ids.append([self.word2idx.get(word, self.word2idx['<unk>']) for word in words])
+        seq_lengths = torch.LongTensor([len(line_ids) for line_ids in ids])
+        text_ids = torch.zeros(len(ids), int(seq_lengths.max()), dtype=torch.long)
+        for i, line_ids in enumerate(ids):
+            text_ids[i, :len(line_ids)] = torch.LongTensor(line_ids)
+        return text_ids, seq_lengths
+
+    def predict(self, images, texts):
+        '''Predict the heatmap argmax for a batch.
+
+        images: list of (H, W, C) feature arrays, as stored in `image_features`
+        texts: list of `td_location_text` strings
+        Returns a list of dicts with the pixel coordinates and the click position
+        `{x: width_ratio, y: height_ratio}` in the format of the `*_center` fields.
+        '''
+        images = torch.from_numpy(np.stack(images).transpose(0, 3, 1, 2)).float().to(self.device)
+        text_ids, seq_lengths = self.encode_texts(texts)
+        with torch.inference_mode():
+            preds = self.model(images, text_ids.to(self.device), seq_lengths)
+
+        batch_size, height, width = preds.size()
+        pixel_ids = preds.view(batch_size, -1).argmax(1).cpu()
+        results = []
+        for pixel_id in pixel_ids.tolist():
+            y, x = divmod(pixel_id, width)
+            results.append({'y': y, 'x': x, 'center': {'x': x / width, 'y': y / height}})
+        return results
+
+    def predict_panoids(self, panoids, texts, image_dir):
+        images = [np.load('{}{}.npy'.format(image_dir, panoid)) for panoid in panoids]
+        return self.predict(images, texts)
+
+    def export_torchscript(self, path, height=100, width=464, image_channels=128):
+        '''Trace the model on a dummy batch and save it with the vocabulary attached.'''
+        images = torch.zeros(2, image_channels, height, width, device=self.device)
+        text_ids, seq_lengths = self.encode_texts(['<unk> <unk> <unk>', '<unk>'])
+        with warnings.catch_warnings():
+            # packed sequences and data-dependent shapes trigger harmless tracer warnings
+            warnings.simplefilter('ignore')
+            traced = torch.jit.trace(self.model, (images, text_ids.to(self.device), seq_lengths), check_trace=False)
+        torch.jit.save(traced, path, _extra_files={'vocab.json': json.dumps(self.word2idx)})
+        return traced
+
+
+class BatchingServer:
+    '''Group requests from many threads into dynamic batches for one predictor.
+
+    A request waits at most `max_wait_ms` for other requests to join its batch.
+    '''
+    def __init__(self, predictor, max_batch_size=16, max_wait_ms=5.0):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = []
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, text):
+        '''Queue one (H, W, C) image and its text, returns a Future of the prediction.'''
+        future = Future()
+        self.requests.put((image, text, future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_batch(self):
+        request = self.requests.get()
+        if request is None:
+            return None, True
+        batch = [request]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _serve(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch:
+                continue
+            images, texts, futures = zip(*batch)
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.predictor.predict(list(images), list(texts))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+def benchmark(predictor, texts, args):
+    '''Send `num_requests` requests from `concurrency` threads and report latency and throughput.'''
+    rng = np.random.RandomState(0)
+    images = [rng.randn(args.height, args.width, args.image_channels).astype(np.float32) for _ in range(4)]
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_id, num_requests):
+        for i in range(num_requests):
+            start = time.perf_counter()
+            server.submit(images[i % len(images)], texts[(client_id + i) % len(texts)]).result()
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    # warm up outside the measurement
+    predictor.predict(images[:1], texts[:1])
+
+    with BatchingServer(predictor, args.max_batch_size, args.max_wait_ms) as server:
+        per_client = [args.num_requests // args.concurrency] * args.concurrency
+        per_client[0] += args.num_requests % args.concurrency
+        clients = [threading.Thread(target=client, args=(i, n)) for i, n in enumerate(per_client)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    print('Requests:       {}'.format(len(latencies)))
+    print('Concurrency:    {}'.format(args.concurrency))
+    print('Mean batch:     {:.2f}'.format(np.mean(server.batch_sizes)))
+    print('Latency p50:    {:.2f} ms'.format(np.percentile(latencies, 50)))
+    print('Latency p99:    {:.2f} ms'.format(np.percentile(latencies, 99)))
+    print('Throughput:     {:.2f} requests/s'.format(len(latencies) / elapsed))
+
+
+def benchmark_texts(data_dir, num_texts=100):
+    if data_dir is None:
+        return ['the bear is on the left of the door', 'look for the red awning above the shop window']
+    loader = Loader(data_dir=data_dir, image_dir=None, target_dir=None)
+    return loader.load_texts(loader.load_json('dev.json'))[:num_texts]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.torchscript:
+        predictor = SDRPredictor.from_torchscript(args.checkpoint, device)
+    else:
+        predictor = SDRPredictor.from_checkpoint(args.checkpoint, device, args.data_dir, args.quantized)
+
+    if args.export:
+        predictor.export_torchscript(args.export, args.height, args.width, args.image_channels)
+        print('TorchScript model saved to', args.export)
+
+    if args.panoid:
+        assert args.image_dir is not None and args.text is not None
+        print(predictor.predict_panoids([args.panoid], [args.text], args.image_dir)[0])
+
+    if args.benchmark:
+        benchmark(predictor, benchmark_texts(args.data_dir), args)
@@ -1,13 +1,13 @@
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Sampler
 import numpy as np
 
 import json
 import os
 from collections import defaultdict
 
-gpu = torch.device('cuda')
 cpu = torch.device('cpu')
 
 class Loader:
@@ -144,11 +144,11 @@ class TDLocationDataset(Dataset):
     def __getitem__(self, index):
         route_id = self.route_ids[index]
         center = self.centers[index]
-        text = torch.cuda.LongTensor(self.texts[index])
+        text = torch.LongTensor(self.texts[index])
         seq_length = np.array(self.seq_lengths[index])
         target = torch.FloatTensor(np.load(self.target_paths[index]))
         image = np.load(self.image_paths[index]).transpose(2, 0, 1)
-        image = torch.cuda.FloatTensor(image)
+        image = torch.FloatTensor(image)
 
         if not self.gaussian_target:
             # concentrate the prob mass to the peak of the gaussian
@@ -158,9 +158,35 @@ class TDLocationDataset(Dataset):
             target = torch.zeros(flat_target.size())
             target[:, target_pixel_idx] = 1
             target = target.view(target_shape)
-        target = target.to(gpu)
 
         return image, text, seq_length, target, center, route_id
 
     def __len__(self):
         return len(self.image_paths)
+
+
+class ResumableSubsetSampler(Sampler):
+    """Shuffle a subset of indices with a permutation fixed by (seed, epoch).
+
+    The order of an epoch can be reproduced and continued from any position,
+    which lets an interrupted run resume with the same batches.
+    """
+    def __init__(self, indices, seed=0):
+        self.indices = list(indices)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Use the permutation of `epoch` and skip its first `start` samples."""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.indices), generator=generator).tolist()
+        return iter([self.indices[i] for i in order[self.start:]])
+
+    def __len__(self):
+        return len(self.indices) - self.start
@@ -0,0 +1,53 @@
+import torch
+
+
+def argmax_coords(maps):
+    """Row and column of the maximum of each (H, W) map in a batch, computed on the maps' device."""
+    batch_size, height, width = maps.size()
+    pixel_ids = maps.reshape(batch_size, -1).argmax(1)
+    return pixel_ids // width, pixel_ids % width
+
+
+def distance_metric(preds, targets):
+    """Calculate distances between model predictions and targets within a batch.
+
+    Returns a tensor of B pixel distances on the device of `preds`.
+    """
+    pred_y, pred_x = argmax_coords(preds)
+    target_y, target_x = argmax_coords(targets)
+    return torch.sqrt(((target_y - pred_y) ** 2 + (target_x - pred_x) ** 2).float())
+
+def accuracy(distances, margin=10):
+    """Calculating accuracy at 80 pixel by default"""
+    distances = torch.as_tensor(distances)
+    return (distances < margin).float().mean().item()
+
+
+class DistanceMeter:
+    """Streaming mean distance and accuracy.
+
+    Sums stay on the device of the predictions, so updating the meter never
+    waits for the GPU; the host only syncs when the results are read.
+    """
+    def __init__(self, margin=10):
+        self.margin = margin
+        self.reset()
+
+    def reset(self):
+        self.total_dist = 0
+        self.num_correct = 0
+        self.count = 0
+
+    def update(self, preds, targets):
+        distances = distance_metric(preds, targets)
+        self.total_dist = self.total_dist + distances.sum()
+        self.num_correct = self.num_correct + (distances < self.margin).sum()
+        self.count += distances.numel()
+        return distances
+
+    def compute(self):
+        """Mean distance and accuracy of everything seen since the last reset."""
+        if self.count == 0:
+            return float('nan'), float('nan')
+        total_dist, num_correct = torch.stack([self.total_dist.float(), self.num_correct.float()]).tolist()
+        return total_dist / self.count, num_correct / self.count
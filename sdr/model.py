@@ -6,14 +6,12 @@ import torchvision.models as models
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-import numpy as np
+from torch.utils.checkpoint import checkpoint
 
 import copy
 
 from loader import Loader
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 
 class RNN(nn.Module):
     def __init__(self, input_size, embed_size, hidden_size, num_layers, 
@@ -33,33 +31,34 @@ class RNN(nn.Module):
         # transpose so the text data has shape=(seq_length, batch_size)
         x = x.t().contiguous()
 
-        # prepare all the indices for sorting
-        sorted_indices = np.argsort(-seq_lengths) # descending order
-        unsort_indices = np.argsort(sorted_indices)
+        # packing needs the lengths on the CPU, the reductions use a copy on the device
+        if not torch.is_tensor(seq_lengths):
+            seq_lengths = torch.as_tensor(seq_lengths)
+        lengths = seq_lengths.to(x.device)
+        batch_indices = torch.arange(x.size(1), device=x.device)
 
         embed = self.embedding(x)
         embed = self.dropout(embed)
 
-        sorted_seq_lengths = seq_lengths[sorted_indices]
-        sorted_embed = embed[:, sorted_indices] # sort by sequence lengths 
-        embed_packed = pack_padded_sequence(sorted_embed, sorted_seq_lengths)
+        # pack without sorting the batch, packing keeps track of the permutation
+        embed_packed = pack_padded_sequence(embed, seq_lengths.cpu(), enforce_sorted=False)
 
         outputs = []
         out_packed = embed_packed
         for i in range(self.num_layers):
-            self.lstm.flatten_parameters()
+            if hasattr(self.lstm, 'flatten_parameters'):
+                # not available on dynamically quantized LSTMs
+                self.lstm.flatten_parameters()
             out_packed, _ = self.lstm(out_packed)
 
-            # unpack and unsort the sequence
+            # unpack the sequence, in the original batch order
             out, _ = pad_packed_sequence(out_packed)
-            out = out[:, unsort_indices]
 
             # reduce the dimension
             if self.reduce == 'last':
-                out = out[seq_lengths - 1, np.arange(len(seq_lengths)), :]
+                out = out[lengths - 1, batch_indices, :]
             elif self.reduce == 'mean':
-                seq_lengths_ = torch.cuda.FloatTensor(seq_lengths.numpy()).unsqueeze(-1)
-                out = torch.sum(out[:, np.arange(len(seq_lengths_)), :], 0) / seq_lengths_
+                out = torch.sum(out, 0) / lengths.unsqueeze(-1).to(out.dtype)
             outputs.append(out)
 
         return outputs
@@ -87,15 +86,137 @@ class LinearProjectionLayers(nn.Module):
     def forward(self, x):
         return self.out_layers(x)
 
+    def forward_split(self, image_embed, text_embed):
+        '''Same as forward(cat(image_embed, text_embed broadcast over H x W), -1).
+
+        image_embed: (batch_size, H, W, image_channels)
+        text_embed: (batch_size, rnn_hidden_size)
+        The first linear layer is additive over the two parts, so the text is
+        projected once per sample and broadcast-added to the image projection.
+        '''
+        if isinstance(self.out_layers, nn.Linear):
+            first_layer, rest_layers = self.out_layers, []
+        else:
+            first_layer, rest_layers = self.out_layers[0], self.out_layers[1:]
+
+        if not isinstance(first_layer, nn.Linear):
+            # e.g. a dynamically quantized layer, which has no float weight to split
+            H, W = image_embed.size()[1:3]
+            text_embed = text_embed[:, None, None, :].expand(-1, H, W, -1)
+            return self.forward(torch.cat((image_embed, text_embed), -1))
+
+        image_channels = image_embed.size(-1)
+        weight = first_layer.weight
+        out = F.linear(image_embed, weight[:, :image_channels], first_layer.bias)
+        text_proj = F.linear(text_embed, weight[:, image_channels:])
+        out = out + text_proj[:, None, None, :]
+        for layer in rest_layers:
+            out = layer(out)
+        return out
+
 
 def clones(module, N):
     '''Produce N identical layers'''
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
 
+class FactorizedText2Conv(nn.Module):
+    '''Generate conv filters from a text vector as a sum of rank-1 separable terms.
+
+    filter[o, i, kh, kw] = sum_r out_r[o] * in_r[i] * spatial_r[kh, kw], where the
+    factors are linear in the text vector. The output is flattened the same way as
+    nn.Linear(text_size, out_channels * in_channels * kernel_size ** 2), so it can
+    replace that layer with (out_channels + in_channels + kernel_size ** 2) * rank
+    outputs instead.
+    '''
+    def __init__(self, text_size, out_channels, in_channels, kernel_size, rank):
+        super(FactorizedText2Conv, self).__init__()
+        self.out_channels = out_channels
+        self.in_channels = in_channels
+        self.kernel_size = kernel_size
+        self.rank = rank
+
+        self.to_out = nn.Linear(text_size, rank * out_channels)
+        self.to_in = nn.Linear(text_size, rank * in_channels)
+        # 1x1 filters have no spatial factor to learn
+        if kernel_size > 1:
+            self.to_spatial = nn.Linear(text_size, rank * kernel_size * kernel_size)
+        else:
+            self.to_spatial = None
+
+    def forward(self, x):
+        batch_size = x.size(0)
+        out_factors = self.to_out(x).view(batch_size, self.rank, self.out_channels)
+        in_factors = self.to_in(x).view(batch_size, self.rank, self.in_channels)
+        if self.to_spatial is None:
+            filters = torch.einsum('bro,bri->boi', out_factors, in_factors)
+        else:
+            spatial_factors = self.to_spatial(x).view(batch_size, self.rank, -1)
+            filters = torch.einsum('bro,bri,brk->boik', out_factors, in_factors, spatial_factors)
+        return filters.reshape(batch_size, -1)
+
+
+def text2conv_layer(text_size, out_channels, in_channels, kernel_size, rank=None):
+    '''Map a text vector to flattened conv filters, fully (rank=None) or factorized.'''
+    if rank is None:
+        return nn.Linear(text_size, kernel_size * kernel_size * in_channels * out_channels)
+    return FactorizedText2Conv(text_size, out_channels, in_channels, kernel_size, rank)
+
+
+def split_conv2d(conv, images, text_embed):
+    '''Same as conv(cat(images, text_embed broadcast over H x W), 1).
+
+    images: (batch_size, image_channels, H, W)
+    text_embed: (batch_size, rnn_hidden_size)
+    The text contributes a constant per kernel tap, so its part of the conv
+    reduces to convolving a ones map (zero padded like the images) with
+    per-sample kernels of a single input channel.
+    '''
+    batch_size, image_channels, H, W = images.size()
+    out = F.conv2d(images, conv.weight[:, :image_channels], conv.bias,
+                   stride=conv.stride, padding=conv.padding, dilation=conv.dilation)
+
+    text_taps = torch.einsum('otij,bt->boij', conv.weight[:, image_channels:], text_embed)
+    out_channels, kernel_h, kernel_w = text_taps.size()[1:]
+    ones = images.new_ones(1, 1, H, W)
+    text_out = F.conv2d(ones, text_taps.reshape(batch_size * out_channels, 1, kernel_h, kernel_w),
+                        stride=conv.stride, padding=conv.padding, dilation=conv.dilation)
+    return out + text_out.view(out.size())
+
+
+@torch.jit.script_if_tracing
+def dynamic_conv2d(images, filters, padding: int = 0):
+    '''Convolve each image with its own filters using one grouped convolution.
+
+    images: (batch_size, in_channels, H, W)
+    filters: (batch_size, out_channels, in_channels, kH, kW)
+    Scripted when traced so the number of groups follows the batch size.
+    '''
+    batch_size, in_channels, H, W = images.size()
+    _, out_channels, _, kernel_h, kernel_w = filters.size()
+    out = F.conv2d(
+        images.reshape(1, batch_size * in_channels, H, W),
+        filters.reshape(batch_size * out_channels, in_channels, kernel_h, kernel_w),
+        padding=padding,
+        groups=batch_size
+    )
+    return out.view(batch_size, out_channels, out.size(-2), out.size(-1))
+
+
+def looped_dynamic_conv2d(images, filters, padding=0):
+    '''Reference implementation of `dynamic_conv2d` looping over the batch.'''
+    conv_outs = []
+    for conv_filter, image in zip(filters, images):
+        conv_out = F.conv2d(image.unsqueeze(0), conv_filter, padding=padding)
+        conv_outs.append(conv_out)
+    return torch.cat(conv_outs, 0)
+
+
 class Concat(nn.Module):
-    def __init__(self, rnn_args, out_layer_args, image_channels=128):
+    def __init__(self, rnn_args, out_layer_args, image_channels=128, broadcast_free=True):
         super(Concat, self).__init__()
+        # False materializes the concatenated features, kept as a reference
+        self.broadcast_free = broadcast_free
 
         if not rnn_args['bidirectional']:
             rnn_hidden_size = rnn_args['rnn_hidden_size']
@@ -110,7 +231,7 @@ class Concat(nn.Module):
             rnn_args['embed_dropout'],
             rnn_args['bidirectional'],
             rnn_args['reduce']
-        ).to(device)
+        )
 
         self.out_layers = LinearProjectionLayers(
             image_channels=image_channels, 
@@ -124,17 +245,22 @@ class Concat(nn.Module):
         image_embed = images
         image_embed = image_embed.permute([0, 2, 3, 1])
         batch_size, H, W, d = image_embed.size()
-        
-        text_embed = text_embed.repeat(1, H * W).view(batch_size, H, W, -1)
-        concat_embed = torch.cat((image_embed, text_embed), -1)
-        out = self.out_layers(concat_embed).squeeze(-1)
-        out = F.log_softmax(out.view(batch_size, -1), 1).view(batch_size, H, W)
+
+        if self.broadcast_free:
+            out = self.out_layers.forward_split(image_embed, text_embed).squeeze(-1)
+        else:
+            text_embed = text_embed.repeat(1, H * W).view(batch_size, H, W, -1)
+            concat_embed = torch.cat((image_embed, text_embed), -1)
+            out = self.out_layers(concat_embed).squeeze(-1)
+        out = F.log_softmax(out.view(batch_size, -1).float(), 1).view(batch_size, H, W)
         return out
 
 
 class ConcatConv(nn.Module):
-    def __init__(self, rnn_args, cnn_args, out_layer_args, image_channels=128):
+    def __init__(self, rnn_args, cnn_args, out_layer_args, image_channels=128, broadcast_free=True):
         super(ConcatConv, self).__init__()
+        # False materializes the concatenated features, kept as a reference
+        self.broadcast_free = broadcast_free
         if not rnn_args['bidirectional']:
             rnn_hidden_size = rnn_args['rnn_hidden_size']
         else:
@@ -148,7 +274,7 @@ class ConcatConv(nn.Module):
             rnn_args['embed_dropout'],
             rnn_args['bidirectional'],
             rnn_args['reduce']
-        ).to(device)
+        )
 
         conv = nn.Conv2d(
             in_channels=image_channels + rnn_hidden_size, 
@@ -170,24 +296,35 @@ class ConcatConv(nn.Module):
         image_embed = images
         image_embed = image_embed.permute([0, 2, 3, 1])
         batch_size, H, W, d = image_embed.size()
-        
-        text_embed = text_embed.repeat(1, H * W).view(batch_size, H, W, -1)
-        concat_embed = torch.cat((image_embed, text_embed), -1)
-        conv_embed = concat_embed.permute([0, 3, 1, 2])
-        for conv_layer in self.conv_layers:
-            conv_embed = conv_layer(conv_embed)
+
+        if self.broadcast_free:
+            conv_embed = None
+            for i, conv_layer in enumerate(self.conv_layers):
+                if i == 0:
+                    conv_embed = split_conv2d(conv_layer, images, text_embed)
+                else:
+                    conv_embed = conv_layer(conv_embed)
+        else:
+            text_embed = text_embed.repeat(1, H * W).view(batch_size, H, W, -1)
+            concat_embed = torch.cat((image_embed, text_embed), -1)
+            conv_embed = concat_embed.permute([0, 3, 1, 2])
+            for conv_layer in self.conv_layers:
+                conv_embed = conv_layer(conv_embed)
         conv_embed = conv_embed.permute([0, 2, 3, 1])
-        out = self.out_layers(concat_embed).squeeze(-1)
-        out = F.log_softmax(out.view(batch_size, -1), 1).view(batch_size, H, W)
+        H, W = conv_embed.size()[1:3]
+        out = self.out_layers(conv_embed).squeeze(-1)
+        out = F.log_softmax(out.view(batch_size, -1).float(), 1).view(batch_size, H, W)
         return out
 
 
 class RNN2Conv(nn.Module):
-    def __init__(self, rnn_args, cnn_args, out_layer_args, num_layers, image_channels=128):
+    def __init__(self, rnn_args, cnn_args, out_layer_args, num_layers, image_channels=128, batched_conv=True):
         super(RNN2Conv, self).__init__()
         self.cnn_args = cnn_args
         self.rnn_args = rnn_args
         self.num_layers = num_layers
+        # False falls back to the per-sample loop, kept as a reference
+        self.batched_conv = batched_conv
         
         self.image_channels = image_channels
         self.out_channels = self.image_channels // 2
@@ -206,16 +343,19 @@ class RNN2Conv(nn.Module):
             rnn_args['embed_dropout'],
             rnn_args['bidirectional'],
             rnn_args['reduce']
-        ).to(device)
+        )
 
         self.conv_dropout = nn.Dropout(p=cnn_args['conv_dropout'])
 
         self.text2convs = nn.ModuleList([])
         for i in range(num_layers):
             in_channels = self.image_channels if i == 0 else self.out_channels
-            self.text2convs.append(nn.Linear(
+            self.text2convs.append(text2conv_layer(
                 rnn_hidden_size, 
-                kernel_size * kernel_size * in_channels * self.out_channels
+                self.out_channels,
+                in_channels,
+                kernel_size,
+                rank=cnn_args.get('text2conv_rank')
             ))
 
         self.out_layers = LinearProjectionLayers(
@@ -228,6 +368,7 @@ class RNN2Conv(nn.Module):
     def forward(self, images, texts, seq_lengths):
         text_embeds = self.rnn(texts, seq_lengths)
         batch_size, image_channels, H, W = images.size()
+        dynamic_conv = dynamic_conv2d if self.batched_conv else looped_dynamic_conv2d
 
         for i, (text_embed, text2conv) in enumerate(zip(text_embeds, self.text2convs)):
             in_channels = image_channels if i == 0 else self.out_channels
@@ -240,26 +381,25 @@ class RNN2Conv(nn.Module):
                 self.cnn_args['kernel_size']
             )
             conv_filters = self.conv_dropout(conv_filters)
-
-            conv_outs = []
-            for conv_filter, image in zip(conv_filters, images):
-                conv_out = F.conv2d(image.unsqueeze(0), conv_filter, padding=self.cnn_args['padding'])
-                conv_outs.append(conv_out)
-            images = torch.cat(conv_outs, 0)
+            images = dynamic_conv(images, conv_filters, padding=self.cnn_args['padding'])
 
         convolved_images = images
         convolved_images = convolved_images.permute([0, 2, 3, 1])
         out = self.out_layers(convolved_images).squeeze(-1)
-        out = F.log_softmax(out.view(batch_size, -1), 1).view(batch_size, H, W)
+        out = F.log_softmax(out.view(batch_size, -1).float(), 1).view(batch_size, H, W)
         return out
 
 
 class LingUNet(nn.Module):
-    def __init__(self, rnn_args, cnn_args, out_layer_args, image_channels=128, m=None):
+    def __init__(self, rnn_args, cnn_args, out_layer_args, image_channels=128, m=None, batched_conv=True):
         super(LingUNet, self).__init__()
         self.cnn_args = cnn_args
         self.rnn_args = rnn_args
         self.m = m
+        # False falls back to the per-sample loop, kept as a reference
+        self.batched_conv = batched_conv
+        # trade recompute for memory by checkpointing the conv and deconv stages
+        self.checkpoint_activations = cnn_args.get('checkpoint_activations', False)
         self.image_channels = image_channels
 
         if not rnn_args['bidirectional']:
@@ -274,11 +414,17 @@ class LingUNet(nn.Module):
                        rnn_args['num_rnn_layers'], 
                        rnn_args['embed_dropout'],
                        rnn_args['bidirectional'],
-                       rnn_args['reduce']).to(device)
+                       rnn_args['reduce'])
 
         sliced_text_vector_size = self.rnn_hidden_size // self.m
-        flattened_conv_filter_size = 1 * 1 * self.image_channels * self.image_channels
-        self.text2convs = clones(nn.Linear(sliced_text_vector_size, flattened_conv_filter_size), self.m)
+        text2conv = text2conv_layer(
+            sliced_text_vector_size,
+            self.image_channels,
+            self.image_channels,
+            1,
+            rank=cnn_args.get('text2conv_rank')
+        )
+        self.text2convs = clones(text2conv, self.m)
 
         conv = nn.Conv2d(
             in_channels=self.image_channels, 
@@ -313,6 +459,30 @@ class LingUNet(nn.Module):
             num_hidden_layers=out_layer_args['num_hidden_layers']
         )
 
+    def conv_stage(self, i, image_embeds, text_slice):
+        batch_size = image_embeds.size(0)
+        image_embeds = self.conv_layers[i](image_embeds)
+
+        conv_kernel_shape = (batch_size, self.image_channels, self.image_channels, 1, 1)
+        text_conv_filters = self.text2convs[i](text_slice).view(conv_kernel_shape)
+
+        dynamic_conv = dynamic_conv2d if self.batched_conv else looped_dynamic_conv2d
+        G = dynamic_conv(image_embeds, text_conv_filters)
+        return image_embeds, G
+
+    def deconv_stage(self, i, H, G=None):
+        if i == 0:
+            H = self.deconv_dropout(H)
+            return self.deconv_layers[i](H)
+        concated = torch.cat((H, G), 1)
+        return self.deconv_layers[i](concated)
+
+    def run_stage(self, stage, *inputs):
+        """Run a stage, recomputing its activations in backward if checkpointing is on."""
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            return checkpoint(stage, *inputs, use_reentrant=False)
+        return stage(*inputs)
+
     def forward(self, images, texts, seq_lengths):
         batch_size, image_channels, height, width = images.size()
 
@@ -322,33 +492,39 @@ class LingUNet(nn.Module):
         Gs = []
         image_embeds = images
         for i in range(self.m): 
-            image_embeds = self.conv_layers[i](image_embeds)
             text_slice = text_embed[:, i * sliced_size:(i + 1) * sliced_size]
-
-            conv_kernel_shape = (batch_size, self.image_channels, self.image_channels, 1, 1)
-            text_conv_filters = self.text2convs[i](text_slice).view(conv_kernel_shape)
-
-            # looping over batch TODO: this is very inefficient, need to optimize
-            outputs = []
-            for image_embed, text_conv_filter in zip(image_embeds, text_conv_filters):
-                output = F.conv2d(image_embed.unsqueeze(0), text_conv_filter)
-                outputs.append(output)
-            G = torch.cat(outputs, 0)
+            image_embeds, G = self.run_stage(self.conv_stage, i, image_embeds, text_slice)
             Gs.append(G)
 
         # deconvolution operations, from the bottom up
         H = Gs.pop()
         for i in range(self.m):
             if i == 0:
-                H = self.deconv_dropout(H)
-                H = self.deconv_layers[i](H)
+                H = self.run_stage(self.deconv_stage, i, H)
             else:
                 G = Gs.pop()
-                concated = torch.cat((H, G), 1)
-                H = self.deconv_layers[i](concated)
+                H = self.run_stage(self.deconv_stage, i, H, G)
 
         H = H.permute([0, 2, 3, 1])
         out = self.out_layers(H).squeeze(-1)
-        out = F.log_softmax(out.view(batch_size, -1), 1).view(batch_size, height, width)
+        out = F.log_softmax(out.view(batch_size, -1).float(), 1).view(batch_size, height, width)
         return out
 
+
+
+def build_model(model_name, rnn_args, cnn_args, out_layer_args, num_layers=None):
+    """Construct one of the SDR models from the argument dicts saved with checkpoints."""
+    if model_name == 'concat':
+        return Concat(rnn_args, out_layer_args)
+    elif model_name == 'concat_conv':
+        return ConcatConv(rnn_args, cnn_args, out_layer_args)
+    elif model_name == 'rnn2conv':
+        return RNN2Conv(rnn_args, cnn_args, out_layer_args, num_layers)
+    elif model_name == 'lingunet':
+        return LingUNet(rnn_args, cnn_args, out_layer_args, m=num_layers)
+    raise ValueError('Please specify model.')
+
+
+def quantize_dynamic_int8(model):
+    """Dynamically quantize the LSTM and linear layers of a model to int8 for CPU inference."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
@@ -0,0 +1,174 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torch.utils.data import Subset
+import numpy as np
+
+import argparse
+import glob
+import os
+import time
+
+from metrics import argmax_coords
+from metrics import distance_metric
+from inference import load_checkpoint
+from inference import build_eval_dataset
+
+
+parser = argparse.ArgumentParser(description='Predict and score a split with saved SDR checkpoints')
+parser.add_argument('checkpoints', type=str, nargs='+',
+                    help='checkpoints saved by train.py or quantize.py')
+parser.add_argument('--data_dir', type=str, default=None,
+                    help='path to data folder where train.json, dev.json, and test.json files')
+parser.add_argument('--image_dir', type=str, default=None,
+                    help='path to `image_features`')
+parser.add_argument('--target_dir', type=str, default=None,
+                    help='path to sdr_targets')
+parser.add_argument('--eval_file', type=str, default='test.json',
+                    help='split to predict')
+parser.add_argument('--output_dir', type=str, default='predictions/',
+                    help='predictions are written to <output_dir>/<checkpoint>.<split>[.shard<i>of<n>].npz')
+parser.add_argument('--batch_size', type=int, default=64,
+                    help='evaluation batch size')
+parser.add_argument('--num_workers', type=int, default=4,
+                    help='data loading worker processes')
+parser.add_argument('--device', type=str, default=None,
+                    help='device to run on (default: cuda if available)')
+parser.add_argument('--quantized', action='store_true',
+                    help='the checkpoints are int8 models written by quantize.py (CPU only, trusted files only)')
+parser.add_argument('--top_k', type=int, default=5,
+                    help='number of heatmap peaks to keep per sample')
+parser.add_argument('--peak_window', type=int, default=5,
+                    help='a peak is the maximum of the peak_window x peak_window pixels around it')
+parser.add_argument('--margin', type=int, default=10,
+                    help='accuracy threshold in pixels')
+parser.add_argument('--num_shards', type=int, default=1,
+                    help='split the samples into this many contiguous shards')
+parser.add_argument('--shard_id', type=int, default=0,
+                    help='shard predicted by this process')
+parser.add_argument('--merge', action='store_true',
+                    help='merge the shard files of every checkpoint instead of predicting')
+
+
+def top_k_peaks(preds, k, window):
+    '''The k highest local maxima of each (H, W) map, as (y, x, score) tensors of shape (B, k).
+
+    A pixel is a local maximum if it equals the max pool of its window, so
+    the peaks of one blob are not all reported next to each other. Maps with
+    fewer than k peaks are padded with -inf scores.
+    '''
+    batch_size, height, width = preds.size()
+    pooled = F.max_pool2d(preds.unsqueeze(1), window, stride=1, padding=window // 2).squeeze(1)
+    peaks = preds.masked_fill(preds < pooled, float('-inf'))
+    scores, pixel_ids = peaks.view(batch_size, -1).topk(min(k, height * width), dim=1)
+    return pixel_ids // width, pixel_ids % width, scores
+
+
+def predict(model, dataset, indices, args, device):
+    '''Run `model` over `dataset[indices]` and return the prediction columns.'''
+    data_iterator = DataLoader(
+        Subset(dataset, indices),
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        pin_memory=device.type == 'cuda'
+    )
+    columns = {name: [] for name in ['pred_y', 'pred_x', 'target_y', 'target_x', 'distance', 'peak_y', 'peak_x', 'peak_score']}
+    route_ids = []
+    with torch.inference_mode():
+        for batch_images, batch_texts, batch_seq_lengths, batch_targets, _, batch_route_ids in data_iterator:
+            batch_images = batch_images.to(device, non_blocking=True)
+            batch_texts = batch_texts.to(device, non_blocking=True)
+            batch_targets = batch_targets.to(device, non_blocking=True)
+            preds = model(batch_images, batch_texts, batch_seq_lengths)
+
+            pred_y, pred_x = argmax_coords(preds)
+            target_y, target_x = argmax_coords(batch_targets)
+            peak_y, peak_x, peak_score = top_k_peaks(preds, args.top_k, args.peak_window)
+            batch_columns = {
+                'pred_y': pred_y, 'pred_x': pred_x, 'target_y': target_y, 'target_x': target_x,
+                'distance': distance_metric(preds, batch_targets),
+                'peak_y': peak_y, 'peak_x': peak_x, 'peak_score': peak_score
+            }
+            # only these few values per sample leave the device
+            for name, values in batch_columns.items():
+                columns[name].append(values.cpu().numpy())
+            if torch.is_tensor(batch_route_ids):
+                batch_route_ids = batch_route_ids.tolist()
+            route_ids += [str(route_id) for route_id in batch_route_ids]
+
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+    for name in ['pred_y', 'pred_x', 'target_y', 'target_x', 'peak_y', 'peak_x']:
+        columns[name] = columns[name].astype(np.int16)
+    columns['index'] = np.asarray(indices, dtype=np.int32)
+    columns['route_id'] = np.asarray(route_ids)
+    return columns
+
+
+def output_path(checkpoint, args, shard_id=None):
+    name = os.path.splitext(os.path.basename(checkpoint))[0]
+    mode = args.eval_file.split('.')[0]
+    if shard_id is None:
+        return os.path.join(args.output_dir, '{}.{}.npz'.format(name, mode))
+    return os.path.join(args.output_dir, '{}.{}.shard{}of{}.npz'.format(name, mode, shard_id, args.num_shards))
+
+
+def summarize(columns, margin):
+    distances = columns['distance']
+    return len(distances), float(np.mean(distances)), float(np.mean(distances < margin))
+
+
+def predict_checkpoint(checkpoint, args, device):
+    model, word2idx, state = load_checkpoint(checkpoint, device, args.data_dir, args.quantized)
+    dataset = build_eval_dataset(
+        args.data_dir, args.image_dir, args.target_dir, args.eval_file, word2idx,
+        gaussian_target=state['args'].get('gaussian_target', True)
+    )
+    indices = np.array_split(np.arange(len(dataset)), args.num_shards)[args.shard_id].tolist()
+
+    start = time.perf_counter()
+    columns = predict(model, dataset, indices, args, device)
+    elapsed = time.perf_counter() - start
+
+    shard_id = args.shard_id if args.num_shards > 1 else None
+    path = output_path(checkpoint, args, shard_id)
+    np.savez_compressed(path, **columns)
+    print('[Sys]:   Predictions saved to', path)
+    return summarize(columns, args.margin) + (elapsed,)
+
+
+def merge_checkpoint(checkpoint, args):
+    '''Concatenate the shard files of a checkpoint in shard order into one file.'''
+    paths = [output_path(checkpoint, args, shard_id) for shard_id in range(args.num_shards)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError('Missing shards: {}'.format(', '.join(missing)))
+    shards = [dict(np.load(path)) for path in paths]
+    columns = {name: np.concatenate([shard[name] for shard in shards]) for name in shards[0]}
+    path = output_path(checkpoint, args)
+    np.savez_compressed(path, **columns)
+    print('[Sys]:   Merged {} shards into {}'.format(len(paths), path))
+    return summarize(columns, args.margin) + (float('nan'),)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert 0 <= args.shard_id < args.num_shards
+    if args.device is not None:
+        device = torch.device(args.device)
+    else:
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    checkpoints = [path for pattern in args.checkpoints for path in sorted(glob.glob(pattern)) or [pattern]]
+    results = []
+    for checkpoint in checkpoints:
+        if args.merge:
+            results.append((checkpoint,) + merge_checkpoint(checkpoint, args))
+        else:
+            results.append((checkpoint,) + predict_checkpoint(checkpoint, args, device))
+
+    print('| checkpoint | samples | mean dist | accuracy | seconds |')
+    print('|------------|--------:|----------:|---------:|--------:|')
+    for checkpoint, num_samples, mean_dist, acc, elapsed in results:
+        print('| {} | {} | {:.4f} | {:.4f} | {:.1f} |'.format(os.path.basename(checkpoint), num_samples, mean_dist, acc, elapsed))
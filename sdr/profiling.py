@@ -0,0 +1,134 @@
+import torch
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+PHASES = ['data', 'transfer', 'forward', 'backward', 'optimizer', 'metrics']
+
+
+def parse_batch_range(batch_range):
+    '''"start:end" -> (start, end), the half-open range of global training steps to trace.'''
+    if batch_range is None:
+        return None
+    start, end = batch_range.split(':')
+    return int(start), int(end)
+
+
+class PhaseTimer:
+    '''Wall time of the phases of every training step.
+
+    `iterate` times the wait for the next batch ('data'), `phase` times any
+    other block, and `step` closes a batch. On CUDA the device is synchronized
+    around each phase so kernels are charged to the phase that launched them,
+    which slows training down; a disabled timer does nothing.
+
+    Steps in `trace_batches` (a half-open (start, end) range of global steps)
+    are also recorded as Chrome trace events written to `trace_file`, and
+    profiled with torch.profiler into the Chrome trace `torch_profile` if given.
+    '''
+    def __init__(self, enabled=True, device=None, trace_batches=None, trace_file=None, torch_profile=None):
+        self.enabled = enabled or trace_batches is not None
+        self.sync = device is not None and device.type == 'cuda'
+        self.trace_batches = trace_batches
+        self.trace_file = trace_file
+        self.torch_profile = torch_profile
+        self.totals = defaultdict(float)
+        self.num_batches = 0
+        self.global_step = 0
+        self.events = []
+        self.profiler = None
+        self.origin = time.perf_counter()
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def _tracing(self):
+        return self.trace_batches is not None and self.trace_batches[0] <= self.global_step < self.trace_batches[1]
+
+    def _record(self, name, start, end):
+        self.totals[name] += end - start
+        if self._tracing():
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': {'step': self.global_step}
+            })
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            self._record(name, start, time.perf_counter())
+
+    def iterate(self, iterable):
+        '''Yield the batches of `iterable`, timing how long each one takes to arrive.'''
+        iterator = iter(iterable)
+        while True:
+            if self.torch_profile and self.trace_batches and self.global_step == self.trace_batches[0]:
+                self._start_profiler()
+            with self.phase('data'):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self):
+        self.num_batches += 1
+        self.global_step += 1
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.global_step == self.trace_batches[1]:
+                self._stop_profiler()
+
+    def averages(self):
+        '''Mean milliseconds per batch of every phase since the last call.'''
+        if not self.num_batches:
+            return {}
+        averages = {name: self.totals[name] * 1000 / self.num_batches for name in PHASES if name in self.totals}
+        self.totals = defaultdict(float)
+        self.num_batches = 0
+        return averages
+
+    def close(self):
+        '''Stop a running profiler and write the trace files.'''
+        self._stop_profiler()
+        if self.trace_file and self.events:
+            with open(self.trace_file, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            print('[Sys]:   Phase trace written to', self.trace_file)
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.sync:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profiler.start()
+
+    def _stop_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profiler.export_chrome_trace(self.torch_profile)
+        print('[Sys]:   torch.profiler trace written to', self.torch_profile)
+        self.profiler = None
+
+
+def format_phases(averages):
+    return ' | '.join('{} {:.1f}ms'.format(name, ms) for name, ms in averages.items())
@@ -0,0 +1,115 @@
+import torch
+from torch.utils.data import DataLoader
+import numpy as np
+
+import argparse
+import io
+import os
+import time
+
+from metrics import DistanceMeter
+from model import quantize_dynamic_int8
+from inference import load_checkpoint
+from inference import build_eval_dataset
+
+
+parser = argparse.ArgumentParser(description='Quantize SDR checkpoints to int8 and evaluate them on CPU')
+parser.add_argument('checkpoints', type=str, nargs='+',
+                    help='checkpoints saved by train.py (concat, concat_conv, rnn2conv or lingunet)')
+parser.add_argument('--data_dir', type=str, default=None,
+                    help='path to data folder where train.json, dev.json, and test.json files')
+parser.add_argument('--image_dir', type=str, default=None,
+                    help='path to `image_features`')
+parser.add_argument('--target_dir', type=str, default=None,
+                    help='path to sdr_targets')
+parser.add_argument('--eval_file', type=str, default='dev.json',
+                    help='split to evaluate on')
+parser.add_argument('--sample_used', type=float, default=1.0,
+                    help='portion of the evaluation split used')
+parser.add_argument('--batch_size', type=int, default=10,
+                    help='evaluation batch size')
+parser.add_argument('--num_threads', type=int, default=None,
+                    help='number of intra-op CPU threads')
+parser.add_argument('--output_dir', type=str, default=None,
+                    help='write the quantized checkpoints here as <name>_int8.pt')
+
+
+def state_dict_bytes(model):
+    '''Size of the serialized parameters, a proxy for checkpoint and weight memory.'''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def evaluate(model, dataset, batch_size):
+    '''Mean distance, accuracy and mean milliseconds per batch of a model on CPU.'''
+    data_iterator = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    meter = DistanceMeter()
+    timings = []
+    with torch.inference_mode():
+        for batch_images, batch_texts, batch_seq_lengths, batch_targets, _, _ in data_iterator:
+            start = time.perf_counter()
+            preds = model(batch_images, batch_texts, batch_seq_lengths)
+            timings.append((time.perf_counter() - start) * 1000)
+            meter.update(preds, batch_targets)
+    mean_dist, acc = meter.compute()
+    return mean_dist, acc, np.mean(timings)
+
+
+def quantize_checkpoint(path, args):
+    model, word2idx, state = load_checkpoint(path, torch.device('cpu'), args.data_dir)
+    quantized_model = quantize_dynamic_int8(model)
+    dataset = build_eval_dataset(
+        args.data_dir, args.image_dir, args.target_dir, args.eval_file, word2idx,
+        gaussian_target=state['args'].get('gaussian_target', True),
+        sample_used=args.sample_used
+    )
+
+    rows = []
+    for variant, variant_model in [('fp32', model), ('int8', quantized_model)]:
+        mean_dist, acc, ms_per_batch = evaluate(variant_model, dataset, args.batch_size)
+        rows.append({
+            'variant': variant,
+            'size_mb': state_dict_bytes(variant_model) / 2 ** 20,
+            'ms_per_batch': ms_per_batch,
+            'mean_dist': mean_dist,
+            'accuracy': acc
+        })
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(path))[0]
+        save_path = os.path.join(args.output_dir, '{}_int8.pt'.format(name))
+        quantized_state = dict(state, quantization='dynamic_int8', state_dict=quantized_model.state_dict())
+        torch.save(quantized_state, save_path)
+        print('[Sys]:   Quantized model saved to', save_path)
+    return state['args']['model'], rows
+
+
+def print_report(results):
+    print('| checkpoint | model | variant | size (MB) | ms/batch | mean dist | accuracy |')
+    print('|------------|-------|---------|----------:|---------:|----------:|---------:|')
+    for path, model_name, rows in results:
+        for row in rows:
+            print('| {} | {} | {} | {:.2f} | {:.2f} | {:.4f} | {:.4f} |'.format(
+                os.path.basename(path), model_name, row['variant'], row['size_mb'],
+                row['ms_per_batch'], row['mean_dist'], row['accuracy']))
+        fp32, int8 = rows
+        print('| {} | {} | change | {:+.1%} | {:+.1%} | {:+.4f} | {:+.4f} |'.format(
+            os.path.basename(path), model_name,
+            int8['size_mb'] / fp32['size_mb'] - 1,
+            int8['ms_per_batch'] / fp32['ms_per_batch'] - 1,
+            int8['mean_dist'] - fp32['mean_dist'],
+            int8['accuracy'] - fp32['accuracy']))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    results = []
+    for path in args.checkpoints:
+        model_name, rows = quantize_checkpoint(path, args)
+        results.append((path, model_name, rows))
+    print_report(results)
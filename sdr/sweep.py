@@ -0,0 +1,305 @@
+import numpy as np
+
+import argparse
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+
+parser = argparse.ArgumentParser(
+    description='Run a grid or random search of train.py configurations in parallel',
+    epilog='Arguments after `--` are passed unchanged to every trial, e.g. `-- --num_epoch 20 --batch_size 10`.'
+)
+parser.add_argument('params', type=str, nargs='+',
+                    help='searched train.py flags as name=v1,v2,... (switches such as amp take on/off); '
+                         'random search also accepts name=uniform:low:high and name=loguniform:low:high')
+parser.add_argument('--data_dir', type=str, default=None,
+                    help='path to data folder where train.json, dev.json, and test.json files')
+parser.add_argument('--image_dir', type=str, default=None,
+                    help='path to `image_features`')
+parser.add_argument('--target_dir', type=str, default=None,
+                    help='path to sdr_targets')
+parser.add_argument('--sweep_dir', type=str, default='sweeps/sweep',
+                    help='every trial logs to <sweep_dir>/trial_<id>, results are written here')
+parser.add_argument('--random', type=int, default=0, metavar='N',
+                    help='sample N random configurations instead of the full grid')
+parser.add_argument('--seed', type=int, default=42,
+                    help='random seed of the random search')
+parser.add_argument('--devices', type=str, default='cpu',
+                    help='comma separated devices the trials run on, e.g. cuda:0,cuda:1')
+parser.add_argument('--trials_per_device', type=int, default=1,
+                    help='concurrent trials on each device')
+parser.add_argument('--threads_per_trial', type=int, default=None,
+                    help='CPU threads of each trial (default: cores / concurrent trials)')
+parser.add_argument('--asha_min_epochs', type=int, default=0,
+                    help='first ASHA rung in epochs, 0 disables ASHA and trials only stop on --patience')
+parser.add_argument('--asha_eta', type=int, default=3,
+                    help='ASHA reduction factor, only the best 1/eta trials continue past each rung')
+parser.add_argument('--poll_every', type=float, default=2.0,
+                    help='seconds between checks of the running trials')
+
+
+def parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_params(params):
+    '''{flag: list of values or ('uniform'|'loguniform', low, high)} from name=... strings.'''
+    space = {}
+    for param in params:
+        name, values = param.split('=', 1)
+        kind = values.split(':')[0]
+        if kind in ('uniform', 'loguniform'):
+            _, low, high = values.split(':')
+            space[name] = (kind, float(low), float(high))
+        else:
+            space[name] = [parse_value(value) for value in values.split(',')]
+    return space
+
+
+def grid_configs(space):
+    for name, values in space.items():
+        assert isinstance(values, list), '{} is a distribution, use --random'.format(name)
+    names = list(space)
+    for values in itertools.product(*[space[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def random_configs(space, num_configs, seed):
+    rng = np.random.RandomState(seed)
+    for _ in range(num_configs):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                config[name] = values[rng.randint(len(values))]
+            elif values[0] == 'uniform':
+                config[name] = float(rng.uniform(values[1], values[2]))
+            else:
+                config[name] = float(math.exp(rng.uniform(math.log(values[1]), math.log(values[2]))))
+        yield config
+
+
+def config_flags(config):
+    flags = []
+    for name, value in config.items():
+        if value == 'on':
+            flags.append('--{}'.format(name))
+        elif value != 'off':
+            flags += ['--{}'.format(name), str(value)]
+    return flags
+
+
+class Trial:
+    def __init__(self, trial_id, config, sweep_dir):
+        self.trial_id = trial_id
+        self.config = config
+        self.name = 'trial_{:03d}'.format(trial_id)
+        self.out_dir = os.path.join(sweep_dir, self.name)
+        self.process = None
+        self.device = None
+        self.status = 'pending'
+        self.metrics = []
+        self.metrics_offset = 0
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def start(self, device, train_args, sweep_dir, threads):
+        os.makedirs(self.out_dir, exist_ok=True)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')]
+        command += ['--name', self.name, '--log', '--log_dir', sweep_dir, '--device', device]
+        command += train_args + config_flags(self.config)
+        env = dict(os.environ)
+        if threads is not None:
+            env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(threads)
+        self.stdout = open(os.path.join(self.out_dir, 'stdout.log'), 'w')
+        self.process = subprocess.Popen(command, stdout=self.stdout, stderr=subprocess.STDOUT, env=env)
+        self.device = device
+        self.status = 'running'
+        self.start_time = time.perf_counter()
+
+    def read_metrics(self):
+        '''New metrics.jsonl lines written by train.py since the last call.'''
+        path = os.path.join(self.out_dir, 'metrics.jsonl')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            f.seek(self.metrics_offset)
+            lines = f.readlines()
+            # keep a partially written last line for the next call
+            if lines and not lines[-1].endswith('\n'):
+                lines = lines[:-1]
+            self.metrics_offset += sum(len(line) for line in lines)
+        new_metrics = [json.loads(line) for line in lines]
+        self.metrics += new_metrics
+        return new_metrics
+
+    def finish(self, status=None):
+        self.read_metrics()
+        self.elapsed = time.perf_counter() - self.start_time
+        self.stdout.close()
+        if status is not None:
+            self.status = status
+        elif self.process.returncode != 0:
+            self.status = 'failed'
+        else:
+            self.status = 'done'
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.finish('stopped (asha)')
+
+    @property
+    def epochs(self):
+        return sum(1 for metrics in self.metrics if 'epoch' in metrics)
+
+    @property
+    def best_tune_acc(self):
+        return max([metrics['best_tune_acc'] for metrics in self.metrics], default=float('nan'))
+
+    @property
+    def dev_acc(self):
+        return next((metrics['dev_acc'] for metrics in self.metrics if 'dev_acc' in metrics), float('nan'))
+
+
+class ASHA:
+    '''Asynchronous successive halving on the best tune accuracy.
+
+    Rungs are at min_epochs * eta^k epochs. A trial reaching a rung continues
+    only if it is in the top 1/eta of the trials that reached that rung so far;
+    until eta trials have reached a rung, every trial continues.
+    '''
+    def __init__(self, min_epochs, eta):
+        if min_epochs < 0:
+            raise ValueError('ASHA min_epochs must be >= 0 (0 disables ASHA), got {}'.format(min_epochs))
+        if min_epochs and eta < 2:
+            raise ValueError('ASHA eta must be >= 2, got {}'.format(eta))
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.rungs = {}
+
+    def is_rung(self, epochs):
+        rung = self.min_epochs
+        while rung < epochs:
+            rung *= self.eta
+        return rung == epochs
+
+    def should_stop(self, epochs, score):
+        if not self.min_epochs or not self.is_rung(epochs):
+            return False
+        scores = self.rungs.setdefault(epochs, [])
+        scores.append(score)
+        if len(scores) < self.eta:
+            return False
+        cutoff = sorted(scores, reverse=True)[len(scores) // self.eta - 1]
+        return score < cutoff
+
+
+def run_sweep(trials, devices, args, train_args):
+    slots = [device for device in devices for _ in range(args.trials_per_device)]
+    threads = args.threads_per_trial
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // len(slots))
+    asha = ASHA(args.asha_min_epochs, args.asha_eta)
+
+    pending = list(trials)
+    running = []
+    while pending or running:
+        while pending and slots:
+            trial = pending.pop(0)
+            trial.start(slots.pop(0), train_args, args.sweep_dir, threads)
+            running.append(trial)
+            print('[Sweep]: {} started on {} | {}'.format(trial.name, trial.device, ' '.join(config_flags(trial.config))))
+
+        time.sleep(args.poll_every)
+        for trial in list(running):
+            for metrics in trial.read_metrics():
+                if 'epoch' in metrics and asha.should_stop(metrics['epoch'] + 1, metrics['best_tune_acc']):
+                    trial.stop()
+                    break
+            if trial.status == 'running' and trial.process.poll() is not None:
+                trial.finish()
+            if trial.status != 'running':
+                running.remove(trial)
+                slots.append(trial.device)
+                print('[Sweep]: {} {} after {} epochs | best tune acc {:.4f}'.format(
+                    trial.name, trial.status, trial.epochs, trial.best_tune_acc))
+
+
+def write_results(trials, sweep_dir):
+    '''Markdown table sorted by best tune accuracy, plus the same rows as results.jsonl.'''
+    trials = sorted(trials, reverse=True,
+                    key=lambda trial: trial.best_tune_acc if not math.isnan(trial.best_tune_acc) else float('-inf'))
+    names = sorted(set(name for trial in trials for name in trial.config))
+
+    lines = ['| trial | ' + ' | '.join(names) + ' | status | epochs | best tune acc | dev acc | time (s) |',
+             '|-------|' + '|'.join('---' for _ in names) + '|--------|-------:|--------------:|--------:|---------:|']
+    for trial in trials:
+        values = [str(trial.config.get(name, '')) for name in names]
+        lines.append('| {} | {} | {} | {} | {:.4f} | {:.4f} | {:.0f} |'.format(
+            trial.name, ' | '.join(values), trial.status, trial.epochs, trial.best_tune_acc, trial.dev_acc, trial.elapsed))
+    table = '\n'.join(lines)
+
+    with open(os.path.join(sweep_dir, 'results.md'), 'w') as f:
+        f.write(table + '\n')
+    with open(os.path.join(sweep_dir, 'results.jsonl'), 'w') as f:
+        for trial in trials:
+            f.write(json.dumps({
+                'trial': trial.name,
+                'config': trial.config,
+                'status': trial.status,
+                'epochs': trial.epochs,
+                'best_tune_acc': trial.best_tune_acc,
+                'dev_acc': trial.dev_acc,
+                'time': trial.elapsed
+            }) + '\n')
+    return table
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    train_args = []
+    if '--' in argv:
+        train_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    try:
+        # checked before any trial starts, --asha_eta only matters with --asha_min_epochs
+        ASHA(args.asha_min_epochs, args.asha_eta)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for name in ['data_dir', 'image_dir', 'target_dir']:
+        if getattr(args, name) is not None:
+            train_args += ['--{}'.format(name), getattr(args, name)]
+    # every trial trains and tunes on the same split, computed by the first one
+    if not any(a == '--split_cache' or a.startswith('--split_cache=') for a in train_args):
+        train_args += ['--split_cache', os.path.join(args.sweep_dir, 'split.json')]
+
+    space = parse_params(args.params)
+    if args.random:
+        configs = random_configs(space, args.random, args.seed)
+    else:
+        configs = grid_configs(space)
+    trials = [Trial(i, config, args.sweep_dir) for i, config in enumerate(configs)]
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    print('[Sweep]: {} trials on {}'.format(len(trials), args.devices))
+
+    try:
+        run_sweep(trials, args.devices.split(','), args, train_args)
+    finally:
+        for trial in trials:
+            if trial.status == 'running':
+                trial.process.terminate()
+                trial.process.wait()
+                trial.finish('interrupted')
+        print(write_results([trial for trial in trials if trial.status != 'pending'], args.sweep_dir))
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data import Subset
 import numpy as np
 from tensorboardX import SummaryWriter
 
@@ -10,13 +10,18 @@ import logging
 import argparse
 import datetime
 import os
-import copy
+import json
+import random
+import time
 
 from loader import Loader
-from model import Concat
-from model import ConcatConv
-from model import RNN2Conv
-from model import LingUNet
+from loader import ResumableSubsetSampler
+from model import build_model
+from metrics import DistanceMeter
+from checkpoint import AsyncCheckpointer
+from profiling import PhaseTimer
+from profiling import parse_batch_range
+from profiling import format_phases
 
 
 parser = argparse.ArgumentParser(description='SDR task')
@@ -41,6 +46,8 @@ parser.add_argument('--conv_dropout', type=float, default=0.0,
                     help='dropout applied to the conv_filters (0 = no dropout)')
 parser.add_argument('--deconv_dropout', type=float, default=0.0,
                     help='dropout applied to the deconv_filters (0 = no dropout)')
+parser.add_argument('--text2conv_rank', type=int, default=None,
+                    help='rank of the factorized text-to-filter generators of rnn2conv and lingunet (None = full linear)')
 # RNN
 parser.add_argument('--embed_size', type=int, default=300,
                     help='size of word embeddings')
@@ -64,6 +71,8 @@ parser.add_argument('--num_rnn2conv_layers', type=int, default=None,
                     help='number of rnn2conv layers')
 parser.add_argument('--num_lingunet_layers', type=int, default=None,
                     help='number of LingUNet layers')
+parser.add_argument('--checkpoint_activations', action='store_true',
+                    help='recompute LingUNet conv and deconv stages in backward to save activation memory')
 parser.add_argument('--num_unet_layers', type=int, default=None,
                     help='number of UNet layers')
 parser.add_argument('--num_reslingunet_layers', type=int, default=None,
@@ -84,16 +93,47 @@ parser.add_argument('--num_epoch', type=int, default=30,
                     help='upper epoch limit')
 parser.add_argument('--batch_size', type=int, default=10, metavar='N',
                     help='batch size')
+parser.add_argument('--num_workers', type=int, default=0,
+                    help='data loading worker processes, kept alive across epochs')
+parser.add_argument('--split_cache', type=str, default=None,
+                    help='json file caching the train/tune split indices, created if missing')
+parser.add_argument('--device', type=str, default=None,
+                    help='device to run on, e.g. cpu or cuda:0 (default: cuda if available)')
 parser.add_argument('--seed', type=int, default=42,
                     help='random seed')
 parser.add_argument('--print_every', type=int, default=50, metavar='N',
                     help='report interval')
+parser.add_argument('--resume', type=str, default=None,
+                    help='resume training from a <name>_last.pt checkpoint (trusted files only)')
+parser.add_argument('--checkpoint_every', type=int, default=0, metavar='N',
+                    help='also write <name>_last.pt every N training batches (0 = only after each epoch), needs --log')
 parser.add_argument('--save', type=str,  default='model.pt',
                     help='path to save the final model')
+parser.add_argument('--amp', action='store_true',
+                    help='mixed precision training (float16 with loss scaling on cuda, bfloat16 on cpu)')
+parser.add_argument('--max_amp_overflows', type=int, default=10,
+                    help='fall back to fp32 after this many non-finite losses under --amp')
+parser.add_argument('--channels_last', action='store_true',
+                    help='use the channels-last memory format for concat_conv and lingunet')
+parser.add_argument('--patience', type=int, default=3,
+                    help='stop after this many epochs without a better tune accuracy')
+parser.add_argument('--profile', action='store_true',
+                    help='time data wait, transfer, forward, backward, optimizer and metrics of every batch '
+                         '(synchronizes cuda, slows training down)')
+parser.add_argument('--trace_batches', type=str, default=None, metavar='START:END',
+                    help='record the phases of training steps START to END-1 (counted over the whole run)')
+parser.add_argument('--trace_file', type=str, default='trace.json',
+                    help='chrome trace json of the phases of --trace_batches')
+parser.add_argument('--torch_profile', type=str, default=None,
+                    help='also profile --trace_batches with torch.profiler and write its chrome trace here')
 parser.add_argument('--log', action='store_true',
                     help='log losses')
+parser.add_argument('--log_dir', type=str, default='logs/',
+                    help='runs log to <log_dir>/<name>')
 parser.add_argument('--summary', action='store_true',
                     help='write summary to tensorboard')
+parser.add_argument('--summary_dir', type=str, default='runs/',
+                    help='tensorboard summaries go to <summary_dir>/<name>')
 parser.add_argument('--no_date', action='store_true', default=True,
                     help='do not append date to the run name')
 
@@ -106,16 +146,39 @@ if not args.no_date:
 else:
     run_name = args.name
 
-device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+if args.device is not None:
+    device = torch.device(args.device)
+else:
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+# mixed precision: float16 needs loss scaling, bfloat16 has the fp32 exponent range
+amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+amp_state = {'enabled': args.amp, 'overflows': 0}
+scaler = torch.amp.GradScaler(device.type, enabled=args.amp and amp_dtype == torch.float16)
+channels_last = args.channels_last and args.model in ('concat_conv', 'lingunet')
+
+torch.manual_seed(args.seed)
+np.random.seed(args.seed)
+random.seed(args.seed)
+timer = PhaseTimer(
+    enabled=args.profile,
+    device=device,
+    trace_batches=parse_batch_range(args.trace_batches),
+    trace_file=args.trace_file,
+    torch_profile=args.torch_profile
+)
+
+# early stopping state, saved with the checkpoints to resume from
+run_state = {'best_tune_acc': float('-inf'), 'best_state': None, 'patience': 0}
 
 # set up summary writer for tensorboard logging
 if args.summary:
-    writer = SummaryWriter(os.path.join('/home/hc839/street-view-navigation/touchdown_location/runs/', run_name))
+    writer = SummaryWriter(os.path.join(args.summary_dir, run_name))
     counters = {'train': 0, 'tune': 0, 'dev': 0}
 
 if args.log:
-    out_dir = os.path.join('/home/hc839/street-view-navigation/touchdown_location/logs/', run_name)
-    os.system('mkdir {}'.format(out_dir))
+    out_dir = os.path.join(args.log_dir, run_name)
+    os.makedirs(out_dir, exist_ok=True)
     print('Log directory created under {}'.format(out_dir))
     
     # log file
@@ -134,7 +197,7 @@ def write_summary(mode, log_dict):
 
 def log(mode, log_info):
     if mode == 'train':
-        log_string = '[Train]: Epoch {:3d} | {:5d}/{:5d} batches | lr {:04.4f} | Loss {:5.6f} | Mean Dist {:5.4f} | Accuracy {:5.4f}'
+        log_string = '[Train]: Epoch {:3d} | {:5d}/{:5d} batches | lr {:04.4f} | Loss {:5.6f} | Mean Dist {:5.4f} | Accuracy {:5.4f} | {:7.2f} samples/s'
     elif mode == 'dev':
         log_string = '[Dev]:   Epoch {:3d} | Loss {:5.6f} | Mean Dist {:5.4f} | Accuracy {:5.4f}'
     elif mode == 'tune':
@@ -144,60 +207,128 @@ def log(mode, log_info):
     print(log_string.format(*log_info))
 
 
-def distance_metric(preds, targets):
-    """Calculate distances between model predictions and targets within a batch."""
-    preds = preds.cpu()
-    targets = targets.cpu()
-    distances = []
-    for pred, target in zip(preds, targets):
-        pred_coord = np.unravel_index(pred.argmax(), pred.size())
-        target_coord = np.unravel_index(target.argmax(), target.size())
-        dist = np.sqrt((target_coord[0] - pred_coord[0]) ** 2 + (target_coord[1] - pred_coord[1]) ** 2)
-        distances.append(dist)
-    return distances
-
-def accuracy(distances, margin=10):
-    """Calculating accuracy at 80 pixel by default"""
-    num_correct = 0
-    for distance in distances:
-        num_correct = num_correct + 1 if distance < margin else num_correct
-    return num_correct / len(distances)
-
-def convert_model_to_state(model, args, rnn_args, cnn_args, out_layer_args):
+def convert_model_to_state(model, args, rnn_args, cnn_args, out_layer_args, vocab=None, state_dict=None):
+    '''Checkpoint format read by inference.py; `state_dict` is an existing CPU snapshot of the model.'''
     state = {
         'args': vars(args),
         'rnn_args': rnn_args,
         'cnn_args': cnn_args,
         'out_layer_args': out_layer_args,
+        'vocab': vocab.word2idx if vocab is not None else None,
         'state_dict': {}
     }
+    if state_dict is not None:
+        state['state_dict'] = state_dict
+        return state
     # use copies instead of references
     for k, v in model.state_dict().items():
         state['state_dict'][k] = v.clone().to(torch.device('cpu'))
     return state
 
+def to_device(batch_images, *tensors):
+    '''Move batch tensors to the training device, sequence lengths stay on the CPU.'''
+    batch_images = batch_images.to(device, non_blocking=True)
+    if channels_last:
+        batch_images = batch_images.contiguous(memory_format=torch.channels_last)
+    return [batch_images] + [tensor.to(device, non_blocking=True) for tensor in tensors]
+
+def autocast():
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_state['enabled'])
+
+def amp_overflow(loss_value):
+    '''Count non-finite losses under AMP, falling back to fp32 when they keep happening.'''
+    if not amp_state['enabled'] or np.isfinite(loss_value):
+        return False
+    amp_state['overflows'] += 1
+    print('[Sys]:   Non-finite loss under AMP, batch skipped ({} so far)'.format(amp_state['overflows']))
+    if amp_state['overflows'] >= args.max_amp_overflows:
+        amp_state['enabled'] = False
+        print('[Sys]:   Too many AMP overflows, falling back to fp32')
+        if args.log:
+            logger.info('[Sys]:   Too many AMP overflows, falling back to fp32')
+    return True
+
+def log_metrics(metrics):
+    '''Append one JSON line to <log_dir>/<name>/metrics.jsonl, read by sweep.py.'''
+    with open(os.path.join(out_dir, 'metrics.jsonl'), 'a') as f:
+        f.write(json.dumps(metrics) + '\n')
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state(model, epoch, next_batch):
+    '''Queue a checkpoint that resumes training at batch `next_batch` of `epoch`.'''
+    last_state = checkpointer.snapshot('last', model, optimizer)
+    best_state = run_state['best_state']
+    state = convert_model_to_state(model, args, rnn_args, cnn_args, out_layer_args, loader.vocab,
+                                   state_dict=last_state['state_dict'])
+    state.update({
+        'optimizer': last_state['optimizer'],
+        'epoch': epoch,
+        'next_batch': next_batch,
+        'patience': run_state['patience'],
+        'best_tune_acc': run_state['best_tune_acc'],
+        'best_state_dict': best_state['state_dict'] if best_state is not None else None,
+        'scaler': scaler.state_dict(),
+        'amp_state': dict(amp_state),
+        'counters': dict(counters) if args.summary else None,
+        'rng': rng_state()
+    })
+    checkpointer.save(state, os.path.join(out_dir, '{}_last.pt'.format(args.name)))
+
+def load_training_state(path, model):
+    '''Restore a checkpoint written by `save_training_state`, returns the epoch and batch to continue from.'''
+    # the RNG states hold numpy arrays, which weights_only loading rejects
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    model.load_state_dict(state['state_dict'])
+    optimizer.load_state_dict(state['optimizer'])
+    scaler.load_state_dict(state['scaler'])
+    amp_state.update(state['amp_state'])
+    if args.summary and state['counters'] is not None:
+        counters.update(state['counters'])
+    run_state['patience'] = state['patience']
+    run_state['best_tune_acc'] = state['best_tune_acc']
+    if state['best_state_dict'] is not None:
+        run_state['best_state'] = {'state_dict': state['best_state_dict']}
+    set_rng_state(state['rng'])
+    print('[Sys]:   Resumed from {} at epoch {} batch {}'.format(path, state['epoch'], state['next_batch']))
+    return state['epoch'], state['next_batch']
+
 def evaluate(model, data_iterator, mode, epoch):
     model.eval()
     total_loss = 0
-    distances = []
+    meter = DistanceMeter()
     num_batches = 0
 
     with torch.no_grad():
         for batch_images, batch_texts, batch_seq_lengths, batch_targets, _, _ in data_iterator:
+            batch_images, batch_texts, batch_targets = to_device(batch_images, batch_texts, batch_targets)
             batch_size, C, H, W = batch_images.size()
 
             batch_size = batch_images.size(0)
-            preds = model(batch_images, batch_texts, batch_seq_lengths)
+            with autocast():
+                preds = model(batch_images, batch_texts, batch_seq_lengths)
+            preds = preds.float()
             loss = loss_func(preds, batch_targets) / batch_size
 
-            total_loss += loss.item()
+            # accumulate on the device, the host only syncs once after the loop
+            total_loss += loss
             num_batches += 1
 
-            distances += distance_metric(preds, batch_targets)
-            
-        avg_loss = total_loss / num_batches
-        mean_dist = np.mean(distances)
-        acc = accuracy(distances)
+            meter.update(preds, batch_targets)
+
+        avg_loss = float(total_loss) / num_batches
+        mean_dist, acc = meter.compute()
     if args.summary:
         log_dict = {'{}_loss'.format(mode): avg_loss, 'accuracy': acc}
         write_summary(mode, log_dict)
@@ -205,56 +336,124 @@ def evaluate(model, data_iterator, mode, epoch):
     return acc
 
 
-def train(model, data_iterator, epoch):
+def train(model, data_iterator, epoch, start_batch=0):
     model.train()
     total_loss = 0
-    batch_idx = 0
-    num_batches = len(data_iterator) 
-
-    for batch_images, batch_texts, batch_seq_lengths, batch_targets, _, _ in data_iterator:
+    batch_idx = start_batch
+    # the sampler already skips the batches seen before a resume
+    num_batches = start_batch + len(data_iterator)
+    num_samples = 0
+    interval_start = time.perf_counter()
+    epoch_start = interval_start
+    epoch_samples = 0
+
+    for batch_images, batch_texts, batch_seq_lengths, batch_targets, _, _ in timer.iterate(data_iterator):
+        with timer.phase('transfer'):
+            batch_images, batch_texts, batch_targets = to_device(batch_images, batch_texts, batch_targets)
         batch_size, C, H, W = batch_images.size()
 
         optimizer.zero_grad()
-        preds = model(batch_images, batch_texts, batch_seq_lengths)
-        loss = loss_func(preds, batch_targets) / batch_size
-
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
+        with timer.phase('forward'):
+            with autocast():
+                preds = model(batch_images, batch_texts, batch_seq_lengths)
+            # the KL loss is computed in fp32 to keep the sum over pixels from overflowing
+            preds = preds.float()
+            loss = loss_func(preds, batch_targets) / batch_size
+            loss_value = loss.item()
+
+        if not amp_overflow(loss_value):
+            with timer.phase('backward'):
+                scaler.scale(loss).backward()
+            with timer.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+            total_loss += loss_value
+        num_samples += batch_size
+        epoch_samples += batch_size
 
         if batch_idx % args.print_every == 0 and batch_idx > 0:
             avg_loss = total_loss / args.print_every
             total_loss = 0
+            samples_per_sec = num_samples / (time.perf_counter() - interval_start)
             
-            distances = distance_metric(preds, batch_targets)
-            mean_dist = np.mean(distances)
-            acc = accuracy(distances)
-            log('train', (epoch, batch_idx, num_batches, optimizer.param_groups[-1]['lr'], avg_loss, mean_dist, acc))
+            with timer.phase('metrics'):
+                meter = DistanceMeter()
+                meter.update(preds, batch_targets)
+                mean_dist, acc = meter.compute()
+            log('train', (epoch, batch_idx, num_batches, optimizer.param_groups[-1]['lr'], avg_loss, mean_dist, acc, samples_per_sec))
+
+            phase_times = timer.averages() if args.profile else {}
+            if phase_times:
+                print('[Prof]:  ' + format_phases(phase_times))
+                if args.log:
+                    logger.info('[Prof]:  ' + format_phases(phase_times))
 
             if args.summary:
-                log_dict = {'train_loss': avg_loss, 'train_acc': acc, 'train_mean_dist': mean_dist}
+                log_dict = {'train_loss': avg_loss, 'train_acc': acc, 'train_mean_dist': mean_dist, 'train_samples_per_sec': samples_per_sec}
+                log_dict.update({'time_{}_ms'.format(name): ms for name, ms in phase_times.items()})
                 write_summary('train', log_dict)
+            num_samples = 0
+            interval_start = time.perf_counter()
         batch_idx += 1
+        timer.step()
+
+        if args.checkpoint_every and batch_idx % args.checkpoint_every == 0 and batch_idx < num_batches:
+            save_training_state(model, epoch, batch_idx)
+
+    epoch_time = time.perf_counter() - epoch_start
+    print('[Train]: Epoch {:3d} | {:.1f}s | {:.2f} samples/s'.format(epoch, epoch_time, epoch_samples / epoch_time))
+
+
+def make_iterator(dataset, batch_size, sampler=None):
+    # persistent workers keep their state between epochs instead of being re-spawned by every iter()
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=sampler,
+        shuffle=False,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        pin_memory=device.type == 'cuda',
+        # a private generator keeps iter() from drawing worker seeds from the global RNG used by dropout
+        generator=torch.Generator().manual_seed(args.seed)
+    )
 
 
-def split_dataset(dataset, split_ratio, batch_size, shuffle_split=False):
-    # creating data indices for training and tuning splits
-    dataset_size = len(dataset)
-    indices = list(range(dataset_size))
+def split_indices(dataset_size, split_ratio, shuffle_split=False, split_cache=None):
+    '''Deterministic train and tune indices, read from or written to `split_cache` if given.'''
     split = int(dataset_size * split_ratio)
+    key = {'dataset_size': dataset_size, 'split_ratio': split_ratio, 'shuffle_split': shuffle_split, 'seed': args.seed}
 
-    if shuffle_split:
-        np.random.seed(args.seed)
-        np.random.shuffle(indices)
+    if split_cache is not None and os.path.exists(split_cache):
+        with open(split_cache) as f:
+            cached = json.load(f)
+        if all(cached.get(k) == v for k, v in key.items()):
+            return cached['train_indices'], cached['tune_indices']
+        print('[Sys]:   Split cache {} does not match the dataset, recomputing'.format(split_cache))
 
+    indices = list(range(dataset_size))
+    if shuffle_split:
+        np.random.RandomState(args.seed).shuffle(indices)
     train_indices = indices[split:]
     tune_indices = indices[:split]
 
-    train_sampler = SubsetRandomSampler(train_indices)
-    tune_sampler = SubsetRandomSampler(tune_indices)
+    if split_cache is not None:
+        # concurrent runs (see sweep.py) may share the cache, never expose a partially written file
+        tmp_path = '{}.{}.tmp'.format(split_cache, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(key, train_indices=train_indices, tune_indices=tune_indices), f)
+        os.replace(tmp_path, split_cache)
+    return train_indices, tune_indices
 
-    train_iterator = DataLoader(dataset, batch_size=batch_size, sampler=train_sampler)
-    tune_iterator = DataLoader(dataset, batch_size=batch_size, sampler=tune_sampler)
+
+def split_dataset(dataset, split_ratio, batch_size, shuffle_split=False, split_cache=None):
+    # creating data indices for training and tuning splits
+    train_indices, tune_indices = split_indices(len(dataset), split_ratio, shuffle_split, split_cache)
+
+    # the train sampler reshuffles every epoch, the tune set is evaluated in a fixed order
+    train_sampler = ResumableSubsetSampler(train_indices, seed=args.seed)
+    train_iterator = make_iterator(dataset, batch_size, sampler=train_sampler)
+    tune_iterator = make_iterator(Subset(dataset, tune_indices), batch_size)
     return train_iterator, tune_iterator
 
 
@@ -293,26 +492,23 @@ if __name__ == '__main__':
     cnn_args = {}
     out_layer_args = {'linear_hidden_size': args.linear_hidden_size, 'num_hidden_layers': args.num_linear_hidden_layers}
 
-    if args.model == 'concat':
-        model = Concat(rnn_args, out_layer_args)
-
-    elif args.model == 'concat_conv':
+    num_layers = None
+    if args.model == 'concat_conv':
         cnn_args = {'kernel_size': 5, 'padding': 2, 'num_conv_layers': args.num_conv_layers, 'conv_dropout': args.conv_dropout}
-        model = ConcatConv(rnn_args, cnn_args, out_layer_args)
 
     elif args.model == 'rnn2conv':
         assert args.num_rnn2conv_layers is not None
         assert args.num_rnn2conv_layers <= args.num_rnn_layers
-        cnn_args = {'kernel_size': 5, 'padding': 2, 'conv_dropout': args.conv_dropout}
-        model = RNN2Conv(rnn_args, cnn_args, out_layer_args, args.num_rnn2conv_layers)
+        cnn_args = {'kernel_size': 5, 'padding': 2, 'conv_dropout': args.conv_dropout, 'text2conv_rank': args.text2conv_rank}
+        num_layers = args.num_rnn2conv_layers
 
     elif args.model == 'lingunet':
         assert args.num_lingunet_layers is not None
-        cnn_args = {'kernel_size': 5, 'padding': 2, 'deconv_dropout': args.deconv_dropout}
-        model = LingUNet(rnn_args, cnn_args, out_layer_args, m=args.num_lingunet_layers)
+        cnn_args = {'kernel_size': 5, 'padding': 2, 'deconv_dropout': args.deconv_dropout, 'text2conv_rank': args.text2conv_rank,
+                    'checkpoint_activations': args.checkpoint_activations}
+        num_layers = args.num_lingunet_layers
 
-    else:
-        raise ValueError('Please specify model.')
+    model = build_model(args.model, rnn_args, cnn_args, out_layer_args, num_layers)
 
     num_params = sum([p.numel() for p in model.parameters() if p.requires_grad])
     print('Number of parameters:', num_params)
@@ -325,53 +521,73 @@ if __name__ == '__main__':
         logger.info('Number of parameters: {}'.format(num_params))
 
     model = model.to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     loss_func = nn.KLDivLoss(reduction='sum')
 
+    # snapshots go to host memory, checkpoint files are written in the background
+    checkpointer = AsyncCheckpointer()
+    if args.checkpoint_every:
+        assert args.log, '--checkpoint_every writes to the log directory, pass --log'
+
+    # the loaders and their workers are built once and reused by every epoch
+    train_iterator, tune_iterator = split_dataset(
+        loader.datasets['train'], args.tuneset_ratio, args.batch_size, split_cache=args.split_cache)
+    dev_iterator = make_iterator(loader.datasets['dev'], args.batch_size)
+
     # start training
-    best_tune_acc = float('-inf')
-    best_model = None
-    patience = 0
-
-    for epoch in range(args.num_epoch):
-        dev_iterator = DataLoader(
-            dataset=loader.datasets['dev'], 
-            batch_size=args.batch_size, 
-            shuffle=False
-        )
-        train_iterator, tune_iterator = split_dataset(loader.datasets['train'], args.tuneset_ratio, args.batch_size)
-
-        train(model, train_iterator, epoch)
+    start_epoch, start_batch = 0, 0
+    if args.resume:
+        start_epoch, start_batch = load_training_state(args.resume, model)
+
+    for epoch in range(start_epoch, args.num_epoch):
+        if run_state['patience'] > args.patience:
+            break
+        if epoch != start_epoch:
+            start_batch = 0
+        epoch_start = time.perf_counter()
+        train_iterator.sampler.set_epoch(epoch, start=start_batch * args.batch_size)
+        train(model, train_iterator, epoch, start_batch)
         tune_acc = evaluate(model, tune_iterator, mode='tune', epoch=epoch)
 
-        if tune_acc > best_tune_acc:
-            best_model = copy.deepcopy(model)
-            best_tune_acc = tune_acc
-            patience = 0
+        if tune_acc > run_state['best_tune_acc']:
+            run_state['best_state'] = checkpointer.snapshot('best', model)
+            run_state['best_tune_acc'] = tune_acc
+            run_state['patience'] = 0
             if args.log:
                 save_path = os.path.join(out_dir, '{}_acc{:.2f}_epoch{}.pt'.format(args.name, tune_acc, epoch))
-                state = convert_model_to_state(best_model, args, rnn_args, cnn_args, out_layer_args)
-                torch.save(state, save_path)
+                state = convert_model_to_state(model, args, rnn_args, cnn_args, out_layer_args, loader.vocab,
+                                               state_dict=run_state['best_state']['state_dict'])
+                checkpointer.save(state, save_path)
                 logger.info('[Sys]:   Model saved')
-            print('[Tune]: Best tune accuracy:', best_tune_acc)
+            print('[Tune]: Best tune accuracy:', run_state['best_tune_acc'])
         else:
             # acc not better, update patience
-            patience += 1
+            run_state['patience'] += 1
             # learning rate scheduling
             for param_group in optimizer.param_groups:
                 param_group['lr'] *= 1.0
-        print('Patience:', patience)
-        if patience > 3:
-            break
-
-    dev_iterator = DataLoader(
-        dataset=loader.datasets['dev'], 
-        batch_size=args.batch_size, 
-        shuffle=False
-    )
-    dev_acc = evaluate(best_model, dev_iterator, mode='dev', epoch=0)
+        print('Patience:', run_state['patience'])
+
+        if args.log:
+            log_metrics({
+                'epoch': epoch,
+                'tune_acc': tune_acc,
+                'best_tune_acc': run_state['best_tune_acc'],
+                'patience': run_state['patience'],
+                'epoch_time': time.perf_counter() - epoch_start
+            })
+            # everything needed to resume training after this epoch
+            save_training_state(model, epoch + 1, 0)
+
+    checkpointer.close()
+    timer.close()
+    model.load_state_dict(run_state['best_state']['state_dict'])
+    dev_acc = evaluate(model, dev_iterator, mode='dev', epoch=0)
 
     if args.log:
         print('Dev accuracy:', dev_acc)
         logger.info('Dev accuracy: {}'.format(dev_acc))
+        log_metrics({'dev_acc': dev_acc, 'best_tune_acc': run_state['best_tune_acc']})
 